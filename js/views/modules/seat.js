@@ -1,5 +1,7 @@
 "use strict";
 
+import Utils from './utils.js';
+
 /**
  * WarpSeat
  * NOTE: book and assignments from seatData is not cloned, it is stored as reference
@@ -69,12 +71,17 @@ function WarpSeatFactory(spriteURL,rootDivId,login) {
     };
 
     this.myConflictingBookings = new Set();
+    this.seatsVersion = 0;
 }
 
 WarpSeatFactory.prototype.getLogin = function() {
     return this.login;
 }
 
+WarpSeatFactory.prototype.getSeatsVersion = function() {
+    return this.seatsVersion;
+}
+
 /**
  * @param {Object[]} selectedDates - list of selected dates [ {from: timestamp, to: timestamp}, ... ]
  */
@@ -99,10 +106,107 @@ WarpSeatFactory.prototype.getLogin = function() {
 
  }
 
+/**
+ * Decodes zoneGetSeats response in the columnar format to the same object as the JSON format
+ * numbers are read directly from the typed array, so only the objects
+ * kept by WarpSeat (seats and bookings) are allocated
+ * @param {ArrayBuffer} buffer
+ * @returns {object} - object described in zoneGetSeats
+ */
+WarpSeatFactory.decodeSeatsData = function(buffer) {
+
+    let {header, columns} = Utils.unpackColumns(buffer);
+
+    let res = {
+        version: header.version,
+        zones: header.zones,
+        users: {},
+        seats: {}
+    };
+
+    if (header.delta) {
+        res.delta = header.delta;
+        res.removed = header.removed;
+    }
+
+    let logins = header.logins;
+    for (let i = 0; i < logins.length; ++i)
+        res.users[logins[i]] = header.userNames[i];
+
+    let baseTS = header.baseTS;
+    let [seatsCount, assignCount, bookCount] = header.counts;
+    let [otherSeatsCount, otherBookCount] = header.otherCounts;
+    let pos = 0;
+    let n;
+
+    // seats: sid, zid, x, y, enabled
+    n = seatsCount;
+    for (let i = 0; i < n; ++i) {
+        res.seats[columns[pos+i]] = {
+            name: header.seatNames[i],
+            zid: columns[pos+n+i],
+            x: columns[pos+2*n+i],
+            y: columns[pos+3*n+i],
+            enabled: columns[pos+4*n+i] != 0,
+            book: []
+        };
+    }
+    pos += 5*n;
+
+    // assignments: sid, login
+    n = assignCount;
+    for (let i = 0; i < n; ++i) {
+        let seat = res.seats[columns[pos+i]];
+        if (!seat)
+            continue;
+        if (!seat.assignments)
+            seat.assignments = [];
+        seat.assignments.push(logins[columns[pos+n+i]]);
+    }
+    pos += 2*n;
+
+    // bookings: sid, bid, fromTS, toTS, login
+    n = bookCount;
+    for (let i = 0; i < n; ++i) {
+        res.seats[columns[pos+i]].book.push({
+            bid: columns[pos+n+i],
+            fromTS: baseTS + columns[pos+2*n+i],
+            toTS: baseTS + columns[pos+3*n+i],
+            login: logins[columns[pos+4*n+i]]
+        });
+    }
+    pos += 5*n;
+
+    // other zones seats: sid, zid
+    n = otherSeatsCount;
+    for (let i = 0; i < n; ++i) {
+        res.seats[columns[pos+i]] = {
+            name: header.otherSeatNames[i],
+            zid: columns[pos+n+i],
+            book: []
+        };
+    }
+    pos += 2*n;
+
+    // other zones bookings: sid, bid, fromTS, toTS
+    n = otherBookCount;
+    for (let i = 0; i < n; ++i) {
+        res.seats[columns[pos+i]].book.push({
+            bid: columns[pos+n+i],
+            fromTS: baseTS + columns[pos+2*n+i],
+            toTS: baseTS + columns[pos+3*n+i]
+        });
+    }
+
+    return res;
+}
+
 // NOTE: seatsData is not cloned
 // you have to call updateAllStates after this method
 WarpSeatFactory.prototype.setSeatsData = function(seatsData = {}) {
 
+    this.seatsVersion = seatsData.version || 0;
+
     var oldSeatsIds = new Set( Object.keys(this.instances))
 
     //create possibly missing seats
@@ -122,6 +226,32 @@ WarpSeatFactory.prototype.setSeatsData = function(seatsData = {}) {
     }
 };
 
+// NOTE: seatsData is not cloned
+// you have to call updateAllStates after this method
+// seatsData contains only changed seats from the current zone,
+// seats from other zones are always sent in full
+WarpSeatFactory.prototype.applySeatsDelta = function(seatsData) {
+
+    this.seatsVersion = seatsData.version || 0;
+
+    //delete removed seats and other zones seats which are gone
+    for (let sid in this.instances) {
+        if (seatsData.removed.includes(sid)
+            || (this.instances[sid].isOtherZone() && !(sid in seatsData.seats))) {
+            this.instances[sid]._destroy();
+            delete this.instances[sid]; //according to the spec it is safe to delete property during iteration
+        }
+    }
+
+    //create or update changed seats
+    for (var sid in seatsData.seats) {
+        if (sid in this.instances)
+            this.instances[sid]._setData(seatsData.seats[sid],seatsData.users);
+        else
+            this.instances[sid] = new WarpSeat(sid,seatsData.seats[sid],seatsData.zones,seatsData.users,this);
+    }
+};
+
 // NOTE: seatsData is not cloned
 // you have to call updateAllStates after this method
 WarpSeatFactory.prototype.updateLogin = function(login, seatsData) {
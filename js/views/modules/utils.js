@@ -98,6 +98,9 @@ Utils.xhr = {
                         let decoder = new TextDecoder('utf-8');
                         content = JSON.parse(decoder.decode(content));
                     }
+                    else if (contentType.startsWith(Utils.COLUMNS_MIMETYPE)) {
+                        //keep ArrayBuffer, see Utils.unpackColumns
+                    }
                     else if (contentType.startsWith('text')) {
                         let decoder = new TextDecoder('utf-8');
                         content = decoder.decode(content);
@@ -130,6 +133,9 @@ Utils.xhr = {
 
             xhr.open(opt.type, opt.url);
 
+            if (opt.accept)
+                xhr.setRequestHeader("Accept", opt.accept);
+
             let data = opt.data;
             if (!(data instanceof FormData)) {
                 data = JSON.stringify(data);
@@ -143,6 +149,26 @@ Utils.xhr = {
 };
 
 
+// compact columnar format of some xhr responses (see utils.py packColumns on the server)
+Utils.COLUMNS_MIMETYPE = "application/vnd.warp.columns";
+
+/**
+ * Splits columnar response to the header and columns
+ * NOTE: columns are little endian, which is the byte order of all platforms browsers run on
+ * @param {ArrayBuffer} buffer
+ * @returns { header: object, columns: Int32Array }
+ */
+Utils.unpackColumns = function(buffer) {
+
+    let headerLength = new DataView(buffer).getUint32(0,true);
+    let decoder = new TextDecoder('utf-8');
+
+    return {
+        header: JSON.parse(decoder.decode(new Uint8Array(buffer,4,headerLength))),
+        columns: new Int32Array(buffer,4+headerLength)
+    };
+}
+
 Utils.Listeners = function(types, async = true) {
 
     this.async = async;
@@ -219,6 +219,29 @@ SeatFactory.prototype._resetSelectionState = function() {
     }
 }
 
+/**
+ * Decodes zonesGetSeats response in the columnar format
+ * @param {ArrayBuffer} buffer
+ * @returns {object} - { sid: { name: "name", x: 10, y: 10 }, ... }
+ */
+SeatFactory.decodeSeatsData = function(buffer) {
+
+    let {header, columns} = Utils.unpackColumns(buffer);
+    let n = header.count;
+    let res = {};
+
+    // columns: sid, x, y
+    for (let i = 0; i < n; ++i) {
+        res[columns[i]] = {
+            name: header.names[i],
+            x: columns[n+i],
+            y: columns[2*n+i]
+        };
+    }
+
+    return res;
+}
+
 SeatFactory.prototype.updateData = function() {
 
     this._resetSelectionState();
@@ -226,11 +249,11 @@ SeatFactory.prototype.updateData = function() {
 
     Utils.xhr.get(
         this.url,
-        {toastOnSuccess:false})
+        {toastOnSuccess:false, accept: Utils.COLUMNS_MIMETYPE})
     .then( (v) => {
 
         let oldIds = new Set( Object.keys(this.instances));
-        let newData = v.response;
+        let newData = SeatFactory.decodeSeatsData(v.response);
 
         for (let sid in newData) {
             if (!oldIds.delete(sid)) {
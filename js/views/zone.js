@@ -12,15 +12,28 @@ import "./css/zone/nouislider_materialize.scss";
 function downloadSeatData(seatFactory) {
 
     var url = window.warpGlobals.URLs['getSeat'];
+    var args = [];
 
     var login = seatFactory.getLogin();
     if (login !== window.warpGlobals.login)
-        url += "?login=" + login;
+        args.push("login=" + login);
 
-    Utils.xhr.get(url, {toastOnSuccess:false})
+    var version = seatFactory.getSeatsVersion();
+    if (version)
+        args.push("since=" + version);
+
+    if (args.length)
+        url += "?" + args.join("&");
+
+    return Utils.xhr.get(url, {toastOnSuccess:false, accept: Utils.COLUMNS_MIMETYPE})
     .then( function(v) {
 
-        seatFactory.setSeatsData(v.response);
+        var seatsData = WarpSeatFactory.decodeSeatsData(v.response);
+
+        if (seatsData.delta)
+            seatFactory.applySeatsDelta(seatsData);
+        else
+            seatFactory.setSeatsData(seatsData);
         seatFactory.updateAllStates( getSelectedDates());
 
     })
@@ -600,14 +613,37 @@ function initZoneSidepanel() {
     });
 }
 
+function initZoneEvents(seatFactory) {
+
+    if (!('zoneEvents' in window.warpGlobals.URLs) || typeof(EventSource) === 'undefined')
+        return;
+
+    var url = window.warpGlobals.URLs['zoneEvents'] + "?since=" + seatFactory.getSeatsVersion();
+    var eventSource = new EventSource(url);
+
+    // collapse bursts of events into a single download
+    var timer = null;
+    var onChange = function() {
+        if (timer !== null)
+            return;
+        timer = setTimeout( function() {
+            timer = null;
+            downloadSeatData(seatFactory);
+        }, 500);
+    };
+
+    for (let e of ['book','enable','disable','assign','zone'])
+        eventSource.addEventListener(e, onChange);
+}
+
 function initBookAs(seatFactory) {
 
     BookAs.getInstance().on('change', function(newLogin) {
 
         var url = window.warpGlobals.URLs['getSeat'] + "?onlyOtherZone=1&login=" + newLogin;
-        Utils.xhr.get(url,{toastOnSuccess: false})
+        Utils.xhr.get(url,{toastOnSuccess: false, accept: Utils.COLUMNS_MIMETYPE})
         .then( function(v) {
-            seatFactory.updateLogin(newLogin, v.response);
+            seatFactory.updateLogin(newLogin, WarpSeatFactory.decodeSeatsData(v.response));
             seatFactory.updateAllStates( getSelectedDates());
 
         });
@@ -627,7 +663,8 @@ document.addEventListener("DOMContentLoaded", function() {
     initZoneHelp();
     initZoneSidepanel();
 
-    downloadSeatData(seatFactory);
+    downloadSeatData(seatFactory)
+    .then( () => initZoneEvents(seatFactory));
 
     if (window.warpGlobals.isZoneAdmin) {
         ZoneUserData.init();
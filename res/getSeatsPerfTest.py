@@ -0,0 +1,204 @@
+#
+# Compares the old (one query per part) and the new (single UNION ALL) query plan
+# of zone/getSeats on SQLite with 5k seats and 100k bookings
+#
+# usage: python getSeatsPerfTest.py [database_file]
+#
+
+import functools
+import os
+import random
+import statistics
+import sys
+import tempfile
+from calendar import timegm
+from time import localtime, perf_counter_ns
+
+from peewee import SqliteDatabase, Table, SQL, Value, Case, fn
+
+NO_OF_SEATS = 5000
+NO_OF_BOOKINGS = 100000
+NO_OF_USERS = 2000
+NO_OF_GROUPS = 20       # nested in chains of GROUP_DEPTH
+GROUP_DEPTH = 4
+DAYS = NO_OF_BOOKINGS // NO_OF_SEATS
+REPEAT = 20
+
+ZID = 1
+OTHER_ZID = 2
+LOGIN = "user1"
+
+SCHEMA = os.path.join(os.path.dirname(__file__), "../warp/sql/sqlite_schema.sql")
+
+dbFile = sys.argv[1] if len(sys.argv) > 1 else os.path.join(tempfile.mkdtemp(), "perf.sqlite")
+DB = SqliteDatabase(dbFile, pragmas={"foreign_keys": "ON"})
+
+Users = Table('users',('login','password','name','account_type')).bind(DB)
+Groups = Table('groups',('group','login')).bind(DB)
+Zone = Table('zone',('id','zone_group','name','iid')).bind(DB)
+ZoneAssign = Table('zone_assign',('zid','login','zone_role')).bind(DB)
+Seat = Table('seat',('id','zid','name','x','y','enabled')).bind(DB)
+SeatAssign = Table('seat_assign',('sid','login')).bind(DB)
+Book = Table('book',('id','login','sid','fromts','tots')).bind(DB)
+ZoneChange = Table('zone_change',('id','zid','sid','kind','ts')).bind(DB)
+UserToZoneRoles = Table('user_to_zone_roles',('login','zid','zone_role')).bind(DB)
+
+NULL = SQL('NULL')
+
+
+def midnight():
+    now = timegm(localtime())
+    return now - now % (24*3600)
+
+
+def generateData():
+
+    # sqlite3 does not accept "AS ROWID" used in the schema file
+    schema = open(SCHEMA).read().replace(" AS ROWID", "")
+    DB.connection().executescript(schema)
+
+    # data is generated without overlaps, so the trigger is not needed
+    DB.execute_sql("DROP TRIGGER book_overlap_insert_check")
+
+    with DB.atomic():
+
+        Users.insert(
+            [ (f"user{u}", None, f"User no {u}", 20) for u in range(NO_OF_USERS) ] + \
+            [ (f"group{g}", None, f"Group no {g}", 100) for g in range(NO_OF_GROUPS) ]).execute()
+
+        groups = []
+        for g in range(NO_OF_GROUPS):
+            if g % GROUP_DEPTH:
+                groups.append( (f"group{g-1}", f"group{g}") )
+        for u in range(NO_OF_USERS):
+            groups.append( (f"group{random.randrange(NO_OF_GROUPS)}", f"user{u}") )
+        Groups.insert(groups).on_conflict_ignore().execute()
+
+        Zone.insert([ (ZID, 1, "Zone 1", None), (OTHER_ZID, 1, "Zone 2", None) ]).execute()
+
+        ZoneAssign.insert(
+            [ (ZID, f"group{g}", 20) for g in range(0, NO_OF_GROUPS, GROUP_DEPTH) ] + \
+            [ (OTHER_ZID, LOGIN, 20) ]).execute()
+
+        Seat.insert(
+            [ (s, ZID, f"S.{s}", (s % 100)*50, (s // 100)*50, 1) for s in range(1, NO_OF_SEATS+1) ] + \
+            [ (NO_OF_SEATS+1, OTHER_ZID, "Other", 0, 0, 1) ]).execute()
+
+        SeatAssign.insert(
+            [ (s, f"user{s % NO_OF_USERS}") for s in range(1, NO_OF_SEATS+1, 50) ]).execute()
+
+        startTS = midnight()
+        bookings = []
+        for day in range(DAYS):
+            dayTS = startTS + day*24*3600
+            for s in range(1, NO_OF_SEATS+1):
+                bookings.append( (f"user{(s+day) % NO_OF_USERS}", s, dayTS + 9*3600, dayTS + 17*3600) )
+        bookings.append( (LOGIN, NO_OF_SEATS+1, startTS + 24*3600, startTS + 25*3600) )
+
+        for i in range(0, len(bookings), 10000):
+            Book.insert(bookings[i:i+10000], columns=[Book.login, Book.sid, Book.fromts, Book.tots]).execute()
+
+
+def oldPlan(tr):
+
+    UserToZoneRoles.select(UserToZoneRoles.zone_role) \
+                   .where( (UserToZoneRoles.zid == ZID) & (UserToZoneRoles.login == LOGIN) ) \
+                   .scalar()
+
+    UserToZoneRoles.select(UserToZoneRoles.zone_role) \
+                   .where( (UserToZoneRoles.zid == ZID) & (UserToZoneRoles.login == LOGIN) ) \
+                   .scalar()
+
+    assignCursor = SeatAssign.select(SeatAssign.sid, Users.login) \
+                             .join(Users,on=(SeatAssign.login == Users.login)) \
+                             .join(Seat, on=(SeatAssign.sid == Seat.id)) \
+                             .where(Seat.zid == ZID)
+    [ *assignCursor.tuples().iterator() ]
+
+    seatsCursor = Seat.select(Seat.id, Seat.name, Seat.x, Seat.y, Seat.zid, Seat.enabled) \
+                      .where(Seat.zid == ZID)
+    [ *seatsCursor.tuples().iterator() ]
+
+    bookQuery = Book.select(Book.id, Book.login, Book.sid, Users.name.alias('username'), Book.fromts, Book.tots) \
+                    .join(Users, on=(Book.login == Users.login)) \
+                    .join(Seat, on=(Book.sid == Seat.id)) \
+                    .where((Book.fromts < tr['toTS']) & (Book.tots > tr['fromTS']) & (Seat.zid == ZID)) \
+                    .order_by(Book.fromts)
+    [ *bookQuery.tuples().iterator() ]
+
+    otherZoneBookQuery = Book.select(Book.sid, Seat.name, Seat.zid, Book.id, Book.fromts, Book.tots) \
+                             .join(Seat, on=(Book.sid == Seat.id)) \
+                             .join(Zone, on=(Seat.zid == Zone.id)) \
+                             .where( (Seat.zid != ZID) & (Seat.enabled == True) ) \
+                             .where(Zone.zone_group == Zone.select(Zone.zone_group).where(Zone.id == ZID)) \
+                             .where(Book.login == LOGIN) \
+                             .order_by(Book.fromts)
+    [ *otherZoneBookQuery.tuples().iterator() ]
+
+    [ *Zone.select(Zone.id,Zone.name).where(Zone.id.in_([ZID, OTHER_ZID])).tuples().iterator() ]
+
+    usedUsers = [ f"user{u}" for u in range(NO_OF_USERS) ]
+    [ *Users.select(Users.login, Users.name).where(Users.login.in_(usedUsers)).tuples().iterator() ]
+
+
+def newPlan(tr):
+
+    rolesQuery = UserToZoneRoles.select(
+                                    UserToZoneRoles.login,
+                                    UserToZoneRoles.zone_role,
+                                    ZoneChange.select(fn.MAX(ZoneChange.id)).where(ZoneChange.zid == ZID)) \
+                                .where(UserToZoneRoles.zid == ZID) \
+                                .where(UserToZoneRoles.login.in_([LOGIN])) \
+                                .tuples()
+    [ *rolesQuery.iterator() ]
+
+    queries = [
+        Seat.select(Value(1), Seat.id, Seat.zid, Seat.x, Seat.y,
+                    Case(None, [(Seat.enabled == True, 1)], 0), Seat.name, NULL) \
+            .where(Seat.zid == ZID),
+        Zone.select(Value(2), Zone.id, NULL, NULL, NULL, NULL, Zone.name, NULL) \
+            .where(Zone.id == ZID),
+        SeatAssign.select(Value(3), SeatAssign.sid, NULL, NULL, NULL, NULL, Users.login, Users.name) \
+                  .join(Users, on=(SeatAssign.login == Users.login)) \
+                  .join(Seat, on=(SeatAssign.sid == Seat.id)) \
+                  .where(Seat.zid == ZID),
+        Book.select(Value(4), Book.sid, Book.id, Book.fromts, Book.tots, NULL, Users.login, Users.name) \
+            .join(Users, on=(Book.login == Users.login)) \
+            .join(Seat, on=(Book.sid == Seat.id)) \
+            .where((Book.fromts < tr['toTS']) & (Book.tots > tr['fromTS']) & (Seat.zid == ZID)),
+        Book.select(Value(5), Book.sid, Book.id, Book.fromts, Book.tots, Seat.zid, Seat.name, Zone.name) \
+            .join(Seat, on=(Book.sid == Seat.id)) \
+            .join(Zone, on=(Seat.zid == Zone.id)) \
+            .where( (Seat.zid != ZID) & (Seat.enabled == True) ) \
+            .where(Zone.zone_group == Zone.select(Zone.zone_group).where(Zone.id == ZID)) \
+            .where(Book.login == LOGIN)
+    ]
+
+    query = functools.reduce(lambda q1,q2: q1.union_all(q2), queries)
+    [ *DB.execute(query) ]
+
+
+def measure(fun, tr):
+
+    res = []
+    for _ in range(REPEAT):
+        t = perf_counter_ns()
+        fun(tr)
+        res.append( (perf_counter_ns() - t)/1e6 )
+
+    return statistics.median(res)
+
+
+with DB.connection_context():
+
+    if len(sys.argv) <= 1:
+        generateData()
+
+    tr = { "fromTS": midnight(), "toTS": midnight() + 14*24*3600 }
+
+    oldMs = measure(oldPlan, tr)
+    newMs = measure(newPlan, tr)
+
+    print(f"seats: {NO_OF_SEATS}, bookings: {NO_OF_BOOKINGS}, median of {REPEAT} runs")
+    print(f"old plan (8 queries): {oldMs:.1f}ms")
+    print(f"new plan (2 queries): {newMs:.1f}ms")
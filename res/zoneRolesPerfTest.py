@@ -0,0 +1,160 @@
+#
+# Compares role checks against the old recursive view of user_to_zone_roles and against
+# the table maintained by triggers on SQLite with 10k users in nested groups,
+# it also measures the cost of the triggers on changes of groups and zone roles
+# (group_closure is written here with SQL, the application does it in group_closure.py)
+#
+# usage: python zoneRolesPerfTest.py [database_file]
+#
+
+import os
+import random
+import statistics
+import sys
+import tempfile
+from time import perf_counter_ns
+
+from peewee import SqliteDatabase, Table
+
+NO_OF_USERS = 10000
+NO_OF_GROUPS = 200      # nested in chains of GROUP_DEPTH
+GROUP_DEPTH = 5
+GROUPS_PER_USER = 3
+NO_OF_ZONES = 50
+REPEAT = 200
+
+ZID = 1
+LOGIN = "user1"
+
+SCHEMA = os.path.join(os.path.dirname(__file__), "../warp/sql/sqlite_schema.sql")
+
+# user_to_zone_roles as it was defined before it was materialized
+OLD_VIEW = """
+CREATE VIEW user_to_zone_roles_view AS
+    WITH RECURSIVE zone_assign_expanded(login, zid, zone_role, account_type, depth) AS (
+        SELECT za.login, za.zid, za.zone_role, u.account_type, 0
+        FROM zone_assign za
+        JOIN users u ON za.login = u.login
+        UNION ALL
+        SELECT g.login, za.zid, za.zone_role, u.account_type, za.depth + 1
+        FROM zone_assign_expanded za
+        JOIN groups g ON g."group" = za.login
+        JOIN users u ON g.login = u.login
+        WHERE za.depth < 100
+    )
+    SELECT login, zid, MIN(zone_role) as zone_role
+    FROM zone_assign_expanded
+    WHERE account_type < 100
+    GROUP BY zid, login;
+"""
+
+# groups are not nested in cycles here, so plain recursion is enough
+CLOSURE_INSERT = """
+INSERT INTO group_closure (ancestor, member, depth)
+    WITH RECURSIVE closure(ancestor, member, depth) AS (
+        SELECT "group", login, 1 FROM groups {where}
+        UNION ALL
+        SELECT g."group", c.member, c.depth + 1
+        FROM closure c
+        JOIN groups g ON g.login = c.ancestor
+    )
+    SELECT ancestor, member, MIN(depth) FROM closure
+    GROUP BY ancestor, member;
+"""
+
+dbFile = sys.argv[1] if len(sys.argv) > 1 else os.path.join(tempfile.mkdtemp(), "perf.sqlite")
+DB = SqliteDatabase(dbFile, pragmas={"foreign_keys": "ON"})
+
+Users = Table('users',('login','password','name','account_type')).bind(DB)
+Groups = Table('groups',('group','login')).bind(DB)
+Zone = Table('zone',('id','zone_group','name','iid')).bind(DB)
+ZoneAssign = Table('zone_assign',('zid','login','zone_role')).bind(DB)
+GroupClosure = Table('group_closure',('ancestor','member','depth')).bind(DB)
+UserToZoneRoles = Table('user_to_zone_roles',('login','zid','zone_role')).bind(DB)
+OldView = Table('user_to_zone_roles_view',('login','zid','zone_role')).bind(DB)
+
+
+def generateData():
+
+    # sqlite3 does not accept "AS ROWID" used in the schema file
+    schema = open(SCHEMA).read().replace(" AS ROWID", "")
+    DB.connection().executescript(schema)
+    DB.execute_sql(OLD_VIEW)
+
+    with DB.atomic():
+
+        Users.insert(
+            [ (f"user{u}", None, f"User no {u}", 20) for u in range(NO_OF_USERS) ] + \
+            [ (f"group{g}", None, f"Group no {g}", 100) for g in range(NO_OF_GROUPS) ]).execute()
+
+        Zone.insert([ (z, 1, f"Zone {z}", None) for z in range(1, NO_OF_ZONES+1) ]).execute()
+
+        # top groups of the chains have roles in all zones
+        ZoneAssign.insert(
+            [ (z, f"group{g}", 10 + 10*(g % 3)) \
+                for z in range(1, NO_OF_ZONES+1) for g in range(0, NO_OF_GROUPS, GROUP_DEPTH) ]).execute()
+
+        groups = []
+        for g in range(NO_OF_GROUPS):
+            if g % GROUP_DEPTH:
+                groups.append( (f"group{g-1}", f"group{g}") )
+        for u in range(NO_OF_USERS):
+            for g in random.sample(range(NO_OF_GROUPS), GROUPS_PER_USER):
+                groups.append( (f"group{g}", f"user{u}") )
+
+        for i in range(0, len(groups), 10000):
+            Groups.insert(groups[i:i+10000]).on_conflict_ignore().execute()
+
+        DB.execute_sql(CLOSURE_INSERT.format(where=""))
+
+
+def roleCheck(table):
+    return lambda: table.select(table.zone_role) \
+                        .where( (table.zid == ZID) & (table.login == LOGIN) ) \
+                        .scalar()
+
+def zoneUsers(table):
+    return lambda: [ *table.select(table.login, table.zone_role) \
+                           .where(table.zid == ZID) \
+                           .tuples().iterator() ]
+
+def changeGroups():
+    with DB.atomic() as tx:
+        Groups.delete().where(Groups.login == LOGIN).execute()
+        Groups.insert([ (f"group{g}", LOGIN) for g in range(1, NO_OF_GROUPS, 7) ]).execute()
+        GroupClosure.delete().where(GroupClosure.member == LOGIN).execute()
+        DB.execute_sql(CLOSURE_INSERT.format(where="WHERE login = ?"), (LOGIN,))
+        tx.rollback()
+
+def changeZoneRole():
+    with DB.atomic() as tx:
+        ZoneAssign.update(zone_role=30) \
+                  .where( (ZoneAssign.zid == ZID) & (ZoneAssign.login == "group0") ) \
+                  .execute()
+        tx.rollback()
+
+
+def measure(fun, repeat = REPEAT):
+
+    res = []
+    for _ in range(repeat):
+        t = perf_counter_ns()
+        fun()
+        res.append( (perf_counter_ns() - t)/1e6 )
+
+    return statistics.median(res)
+
+
+with DB.connection_context():
+
+    if len(sys.argv) <= 1:
+        generateData()
+
+    if sorted(zoneUsers(UserToZoneRoles)()) != sorted(zoneUsers(OldView)()):
+        raise Exception("user_to_zone_roles differs from the old view")
+
+    print(f"users: {NO_OF_USERS}, groups: {NO_OF_GROUPS} (depth {GROUP_DEPTH}), zones: {NO_OF_ZONES}")
+    print(f"role check (login, zid):   view {measure(roleCheck(OldView), 5):9.3f} ms   table {measure(roleCheck(UserToZoneRoles)):9.3f} ms")
+    print(f"users of a zone:           view {measure(zoneUsers(OldView), 5):9.3f} ms   table {measure(zoneUsers(UserToZoneRoles)):9.3f} ms")
+    print(f"change groups of a user:   {measure(changeGroups):9.3f} ms")
+    print(f"change role of top group:  {measure(changeZoneRole, 20):9.3f} ms")
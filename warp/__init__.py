@@ -23,6 +23,21 @@ def create_app():
     from . import xhr
     app.register_blueprint(xhr.bp, url_prefix='/xhr')
 
+    from . import occupancy
+    app.cli.add_command(occupancy.rebuildOccupancyCommand)
+
+    from . import group_closure
+    app.cli.add_command(group_closure.rebuildClosureCommand)
+
+    from . import blob_storage
+    app.cli.add_command(blob_storage.migrateBlobsCommand)
+
+    from . import upgrade
+    app.cli.add_command(upgrade.upgradeDBCommand)
+
+    from . import ldap_sync
+    app.cli.add_command(ldap_sync.ldapSyncCommand)
+
     from . import auth
     from . import auth_mellon
     from . import auth_ldap
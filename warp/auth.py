@@ -1,8 +1,9 @@
 from flask import Blueprint, request, flash, session, redirect, url_for, render_template, g, current_app
-from werkzeug.security import check_password_hash
 import logging
+import time
 from . import utils
-from .db import User, ACCOUNT_TYPE_BLOCKED, ACCOUNT_TYPE_ADMIN, ACCOUNT_TYPE_GROUP
+from . import password_utils
+from .db import db, User, ACCOUNT_TYPE_BLOCKED, ACCOUNT_TYPE_ADMIN, ACCOUNT_TYPE_GROUP
 
 logger = logging.getLogger(__name__)
 bp = Blueprint('auth', __name__)
@@ -34,12 +35,29 @@ def login():
                 flash("Wrong username or password")
                 return render_template('login.html')
             
-            if check_password_hash(user.password, password):
+            try:
+                passwordOk = password_utils.checkPassword(user.password, password)
+            except password_utils.PasswordHashBusy:
+                flash("Server is busy, please try again")
+                return render_template('login.html'), 503
+
+            if passwordOk:
                 if user.account_type == ACCOUNT_TYPE_BLOCKED:
                     logger.warning(f"Blocked user attempted login: {username}")
                     flash("Your account is blocked.")
                 else:
                     logger.info(f"Successful login: {username}")
+
+                    # upgrade the hash to the current PASSWORD_HASH_METHOD, it can be done only now,
+                    # when we know the password, failure is not fatal
+                    if password_utils.needsRehash(user.password):
+                        try:
+                            user.password = password_utils.hashPassword(password)
+                            db.session.commit()
+                            logger.info(f"Password hash of {username} upgraded")
+                        except password_utils.PasswordHashBusy:
+                            pass
+
                     session['login'] = username
                     session['login_time'] = utils.now()
                     return redirect(url_for('view.index'))
@@ -58,6 +76,33 @@ def logout():
 
 bp.route('/logout')(logout)
 
+# account types of logged in users, cached in each worker for USER_STATE_CACHE_TTL seconds,
+# so check_session doesn't hit the database on every request
+_userStateCache = utils.LRUCache('USER_STATE_CACHE_SIZE')
+
+def getAccountType(login):
+    """ Returns account_type of the login (None if it doesn't exist), possibly cached """
+
+    ttl = current_app.config['USER_STATE_CACHE_TTL']
+    now = time.monotonic()
+
+    entry = _userStateCache.get(login)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+
+    user = User.query.filter_by(login=login).first()
+    accountType = user.account_type if user else None
+
+    if ttl > 0:
+        _userStateCache.set(login, (now + ttl, accountType))
+
+    return accountType
+
+def invalidateUserState(login):
+    """ Drops the cached account type of the login (in the current worker only) """
+
+    _userStateCache.invalidate(lambda k: k == login)
+
 def check_session():
     if request.blueprint == 'auth':
         return
@@ -65,6 +110,10 @@ def check_session():
     if request.endpoint == 'static':
         return
 
+    # zone maps under URLs with their token, the token itself is the permission (see view.zoneImageHashed)
+    if request.endpoint == 'view.zoneImageHashed':
+        return
+
     login = session.get('login')
 
     if login is None:
@@ -77,12 +126,12 @@ def check_session():
         return redirect(url_for('auth.login'))
 
     # Check if user still exists and is not blocked
-    user = User.query.filter_by(login=login).first()
+    accountType = getAccountType(login)
 
-    if not user or user.account_type >= ACCOUNT_TYPE_BLOCKED:
+    if accountType is None or accountType >= ACCOUNT_TYPE_BLOCKED:
         return redirect(url_for('auth.login'))
 
-    g.isAdmin = user.account_type == ACCOUNT_TYPE_ADMIN
+    g.isAdmin = accountType == ACCOUNT_TYPE_ADMIN
     g.login = login
 
 bp.before_app_request(check_session)
@@ -3,21 +3,35 @@ from werkzeug.security import check_password_hash
 from warp.db import *
 import warp.auth
 from . import utils
+from . import group_closure
 from ldap3 import Server, Connection, ALL, Tls
+import contextlib
 import ssl
+import threading
+import time
 from ldap3.core.exceptions import LDAPException
 from ldap3.utils.conv import escape_filter_chars
-from ldap3.utils.dn import escape_rdn
+from ldap3.utils.dn import escape_rdn, parse_dn
 import ldap3
+import logging
 import sys
 
+logger = logging.getLogger(__name__)
 bp = flask.Blueprint('auth', __name__)
 
-def ldapConnect(login, password):
+# ldap3.Server objects, reused by all connections of the worker (key is the server configuration)
+_ldapServers = {}
+
+def ldapServer():
 
     validateCert = flask.current_app.config.get('LDAP_VALIDATE_CERT',None)
     tlsVersion = flask.current_app.config.get('LDAP_TLS_VERSION',None)
     tlsCiphers = flask.current_app.config.get('LDAP_TLS_CIPHERS',None)
+    url = flask.current_app.config.get('LDAP_SERVER_URL')
+
+    key = (url, validateCert, tlsVersion, tlsCiphers)
+    if key in _ldapServers:
+        return _ldapServers[key]
 
     tls_params = {}
     if validateCert is not None:
@@ -34,14 +48,17 @@ def ldapConnect(login, password):
     if tls_params:
         tls = ldap3.Tls(**tls_params)
 
-    url = flask.current_app.config.get('LDAP_SERVER_URL')
     if not url.lower().startswith('ldap://') and not url.lower().startswith('ldaps://'):
         print(f"LDAP_SERVER_URL must be either ldap:// or ldaps:// specified: {url}",file=sys.stderr)
         raise Exception("LDAP_SERVER_URL must be either ldap:// or ldaps://")
-    ldapServer = ldap3.Server(url,tls=tls,get_info=ALL)
 
-    userName = flask.current_app.config.get("LDAP_USER_TEMPLATE")
-    userName = userName.format(login=escape_rdn(login))
+    # schema and server info are not used, so don't fetch them on every connection
+    _ldapServers[key] = ldap3.Server(url,tls=tls,get_info=ldap3.NONE)
+
+    return _ldapServers[key]
+
+def ldapBind(userName, password):
+    """ Returns a new connection bound as userName or None if the bind failed """
 
     ldapAuthType = flask.current_app.config.get('LDAP_AUTH_TYPE')
     if ldapAuthType.upper() == "SIMPLE":
@@ -54,11 +71,10 @@ def ldapConnect(login, password):
         print(f"Wrong LDAP_AUTH_TYPE specified {ldapAuthType}",file=sys.stderr)
         raise Exception("Wrong LDAP_AUTH_TYPE specified")
 
-    if '\\' in userName and not flask.current_app.config.get("LDAP_USER_SEARCH_BASE",None):
-        print("For AD authentication LDAP_USER_SEARCH_BASE should be configured.",file=sys.stderr)
+    server = ldapServer()
 
     ldapConnection = ldap3.Connection(
-        ldapServer,
+        server,
         authentication=ldapAuthType,
         lazy=False,
         read_only=True,
@@ -66,19 +82,143 @@ def ldapConnect(login, password):
         user=userName,
         password=password)
 
+    url = flask.current_app.config.get('LDAP_SERVER_URL')
     if flask.current_app.config.get('LDAP_STARTTLS') and url.lower().startswith('ldap://'):
         ldapConnection.start_tls()
 
-    if not ldapServer.ssl and not ldapConnection.tls_started:
+    if not server.ssl and not ldapConnection.tls_started:
         print("WARNING: Non-secure LDAP connection used")
 
     if not ldapConnection.bind():
+        ldapConnection.unbind()
         return None
 
     return ldapConnection
 
+def ldapConnect(login, password):
+
+    userName = flask.current_app.config.get("LDAP_USER_TEMPLATE")
+    userName = userName.format(login=escape_rdn(login))
+
+    if '\\' in userName and not flask.current_app.config.get("LDAP_USER_SEARCH_BASE",None):
+        print("For AD authentication LDAP_USER_SEARCH_BASE should be configured.",file=sys.stderr)
+
+    return ldapBind(userName, password)
+
+
+class _ServiceConnectionPool:
+    """ Connections bound with LDAP_SERVICE_USER, used for searches instead of user's own connection """
+    """ at most LDAP_SERVICE_POOL_SIZE idle connections are kept in each worker """
+
+    def __init__(self):
+        self.idle = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+
+        with self.lock:
+            ldapConnection = self.idle.pop() if self.idle else None
+
+        if ldapConnection is None:
+            ldapConnection = ldapBind(flask.current_app.config['LDAP_SERVICE_USER'],
+                                      flask.current_app.config.get('LDAP_SERVICE_PASSWORD'))
+            if ldapConnection is None:
+                # the credentials may have changed, don't keep connections bound with the old ones
+                self.clear()
+                raise Exception("LDAP: bind of LDAP_SERVICE_USER failed")
+
+        # only connections which finished without an exception go back to the pool
+        try:
+            yield ldapConnection
+        except LDAPException:
+            # the connection may be broken (e.g. closed by the server), and so may be the idle ones,
+            # so a retry binds a new connection
+            self.clear()
+            raise
+        else:
+            with self.lock:
+                if len(self.idle) < flask.current_app.config['LDAP_SERVICE_POOL_SIZE']:
+                    self.idle.append(ldapConnection)
+                    ldapConnection = None
+        finally:
+            if ldapConnection is not None:
+                ldapConnection.unbind()
+
+    def clear(self):
+        """ Unbinds all the idle connections """
+
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        for c in idle:
+            c.unbind()
+
+_servicePool = _ServiceConnectionPool()
+
+def _ldapGroupsOneQuery(login, ldapConnection, searchBase, ldapGroups):
+    """ Returns set of ldapGroups (lowercase) the login is member of, with a single OR search """
+
+    searchFilterTemplate = flask.current_app.config.get('LDAP_GROUP_SEARCH_FILTER_TEMPLATE')
+    groupNameAtt = flask.current_app.config.get('LDAP_GROUP_NAME_ATTRIBUTE')
+
+    searchFilter = "(|" + "".join(
+        searchFilterTemplate.format(group=escape_filter_chars(g),login=escape_filter_chars(login)) for g in ldapGroups) + ")"
+    ldapConnection.search(search_base=searchBase,search_filter=searchFilter,attributes=groupNameAtt)
+
+    res = set()
+    for entry in ldapConnection.entries:
+        res.update( str(v).lower() for v in entry.entry_attributes_as_dict.get(groupNameAtt, []) )
+
+    return res
+
+def ldapGroupsMemberOf(memberOf):
+    """ Returns set of groups (lowercase) from memberOf values, both full DNs and values of their first RDN """
+
+    res = set()
+    for dn in memberOf:
+        res.add(dn.lower())
+        try:
+            res.add(parse_dn(dn)[0][1].lower())
+        except LDAPException:
+            pass
+
+    return res
+
+def ldapMapGroups(isMember):
+    """ Evaluates LDAP_GROUP_MAP, isMember(ldapGroup) tells if the user is member of the LDAP group """
+    """ returns list of Warp groups or None if the user is not allowed to log in """
+
+    loginAllowed = False
+    res = []
+
+    for ldapGroup,warpGroup in flask.current_app.config.get('LDAP_GROUP_MAP'):
+
+        if ldapGroup is None and warpGroup is None:
+            loginAllowed = True
+            continue
+
+        if ldapGroup is None:
+            res.append(warpGroup)
+            continue
+
+        if not isMember(ldapGroup):
+            continue
+
+        loginAllowed = True
+        if warpGroup:
+            res.append(warpGroup)
+
+    if not loginAllowed:
+        return None
+
+    return res
+
 def ldapGetUserMetadata(login,ldapConnection):
 
+    groupSearchMode = flask.current_app.config.get('LDAP_GROUP_SEARCH_MODE').upper()
+    if groupSearchMode not in ("PER_GROUP", "ONE_QUERY", "MEMBER_OF"):
+        raise Exception(f"Wrong LDAP_GROUP_SEARCH_MODE specified {groupSearchMode}")
 
     userSearchBase = flask.current_app.config.get("LDAP_USER_SEARCH_BASE",None)
     if not userSearchBase:
@@ -89,9 +229,10 @@ def ldapGetUserMetadata(login,ldapConnection):
     userSearchFilter = userSearchFilter.format(login=escape_rdn(login))
 
     ldapNameAtt = flask.current_app.config.get('LDAP_USER_NAME_ATTRIBUTE')
+    memberOfAtt = flask.current_app.config.get('LDAP_MEMBER_OF_ATTRIBUTE')
     ldapConnection.search(search_base=userSearchBase,
                           search_filter=userSearchFilter,
-                          attributes=ldapNameAtt)
+                          attributes=[ldapNameAtt, memberOfAtt] if groupSearchMode == "MEMBER_OF" else ldapNameAtt)
 
     if len(ldapConnection.entries) != 1:
         raise Exception(f"LDAP: Wrong number of enties returned for the user: {len(ldapConnection.entries)}")
@@ -103,39 +244,76 @@ def ldapGetUserMetadata(login,ldapConnection):
     }
 
     searchBase = flask.current_app.config.get('LDAP_GROUP_SEARCH_BASE', None)
-    if searchBase is None:
+    ldapGroupMap = flask.current_app.config.get('LDAP_GROUP_MAP')
+
+    # in PER_GROUP mode each mapped group is searched separately,
+    # in other modes all groups of the user are fetched at once and the mapping is evaluated locally
+    memberships = None
+    if groupSearchMode == "MEMBER_OF":
+        memberships = ldapGroupsMemberOf(ldapConnection.entries[0].entry_attributes_as_dict.get(memberOfAtt, []))
+    elif searchBase is None:
         return ret
+    elif groupSearchMode == "ONE_QUERY":
+        ldapGroups = { g for g,_ in ldapGroupMap if g is not None }
+        memberships = _ldapGroupsOneQuery(login, ldapConnection, searchBase, ldapGroups) if ldapGroups else set()
 
-    loginAllowed = False
     searchFilterTemplate = flask.current_app.config.get('LDAP_GROUP_SEARCH_FILTER_TEMPLATE')
-    ldapGroupMap = flask.current_app.config.get('LDAP_GROUP_MAP')
-    for ldapGroup,warpGroup in ldapGroupMap:
 
-        if ldapGroup is None and warpGroup is None:
-            loginAllowed = True
-            continue
+    def isMember(ldapGroup):
 
-        if ldapGroup is None:
-            ret["groups"].append(warpGroup)
-            continue
+        if memberships is not None:
+            return ldapGroup.lower() in memberships
 
         searchFilter = searchFilterTemplate.format(group=escape_filter_chars(ldapGroup),login=escape_filter_chars(login))
         ldapConnection.search(search_base=searchBase,search_filter=searchFilter)
 
-        if len(ldapConnection.entries) == 0:
-            continue
-        elif len(ldapConnection.entries) > 1:
+        if len(ldapConnection.entries) > 1:
             print("LDAP group search returned more than one entry. Probably LDAP_GROUP_SEARCH_FILTER is wrongly defined.",file=sys.stderr)
 
-        loginAllowed = True
-        if warpGroup:
-            ret["groups"].append(warpGroup)
+        return len(ldapConnection.entries) > 0
 
-    if not loginAllowed:
+    groups = ldapMapGroups(isMember)
+    if groups is None:
         return None
 
+    ret["groups"].extend(groups)
+
     return ret
 
+# metadata (name and groups) of logins which were allowed to log in, cached in each worker
+# for LDAP_METADATA_CACHE_TTL seconds, so a login costs just the bind of the user
+_metadataCache = utils.LRUCache('LDAP_METADATA_CACHE_SIZE')
+
+def ldapUserMetadata(login, userConnection):
+    """ Returns ldapGetUserMetadata of the login, searched with the service connection """
+    """ if LDAP_SERVICE_USER is configured (otherwise with userConnection), possibly cached """
+
+    ttl = flask.current_app.config['LDAP_METADATA_CACHE_TTL']
+    now = time.monotonic()
+
+    entry = _metadataCache.get(login)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+
+    if flask.current_app.config.get('LDAP_SERVICE_USER'):
+
+        # pooled connection can be closed by the server meanwhile, then retry with a new one
+        try:
+            with _servicePool.connection() as ldapConnection:
+                res = ldapGetUserMetadata(login, ldapConnection)
+        except LDAPException:
+            with _servicePool.connection() as ldapConnection:
+                res = ldapGetUserMetadata(login, ldapConnection)
+
+    else:
+        res = ldapGetUserMetadata(login, userConnection)
+
+    # denied logins are not cached, so adding a user to LDAP group takes effect immediately
+    if res is not None and ttl > 0:
+        _metadataCache.set(login, (now + ttl, res))
+
+    return res
+
 def ldapApplyUserMetadata(login,userData):
 
     with DB.atomic():
@@ -171,6 +349,8 @@ def ldapApplyUserMetadata(login,userData):
                 .where( Groups.group.not_in(existingGroups) ) \
                 .execute()
 
+        group_closure.refreshClosure([login])
+
 
 
 def ldapLogin(login, password):
@@ -178,15 +358,33 @@ def ldapLogin(login, password):
     if password is None or login is None:
         return flask.abort(400)
 
+    t0 = time.perf_counter()
+
     connection = ldapConnect(login,password)
+    t1 = time.perf_counter()
+
     if not connection:
+        logger.info(f"LDAP login {login} failed: bind {(t1-t0)*1000:.1f} ms")
         return False
 
-    userMetadata = ldapGetUserMetadata(login,connection)
+    try:
+        userMetadata = ldapUserMetadata(login,connection)
+    finally:
+        connection.unbind()
+    t2 = time.perf_counter()
+
     if not userMetadata:
+        logger.info(f"LDAP login {login} denied: bind {(t1-t0)*1000:.1f} ms, metadata {(t2-t1)*1000:.1f} ms")
         return False
 
-    ldapApplyUserMetadata(login,userMetadata)
+    # with LDAP_SYNC_ON_LOGIN disabled, users already synchronized by flask ldap-sync are not updated
+    if flask.current_app.config['LDAP_SYNC_ON_LOGIN'] \
+       or Users.select(SQL_ONE).where(Users.login == login).scalar() is None:
+        ldapApplyUserMetadata(login,userMetadata)
+    t3 = time.perf_counter()
+
+    logger.info(f"LDAP login {login}: bind {(t1-t0)*1000:.1f} ms, metadata {(t2-t1)*1000:.1f} ms, "
+                f"apply {(t3-t2)*1000:.1f} ms")
 
     flask.session['login'] = login
     flask.session['login_time'] = utils.now()
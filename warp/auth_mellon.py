@@ -1,10 +1,121 @@
+import atexit
 import flask
+import logging
+import threading
 from .db import *
 from warp.auth import session
+from warp import auth
 from . import utils
+from . import group_closure
 
+logger = logging.getLogger(__name__)
 bp = flask.Blueprint('auth', __name__)
 
+# Fingerprints of SAML attributes already written to the database, cached in each worker,
+# so a repeated login with unchanged attributes doesn't touch the database
+# (the existence of the user is checked via auth.getAccountType, which is cached as well).
+#
+# New users are added to MELLON_DEFAULT_GROUP only once, when they are created (a user removed
+# from the group by an admin is not added again). Until then the users row is marked with
+# _PASSWORD_UNPROVISIONED (instead of '*', both can't be used to log in with a password) and the
+# fingerprint is not cached, so provisioning lost in a failed flush or with a recycled worker
+# is retried on the next login of the user.
+_fingerprintCache = utils.LRUCache('MELLON_FINGERPRINT_CACHE_SIZE')
+
+_PASSWORD_UNPROVISIONED = '*unprovisioned'
+
+class _Provisioning:
+    """ Users waiting to be added to MELLON_DEFAULT_GROUP, when no other user is being provisioned, """
+    """ the user is added right away (in the login request), otherwise they are flushed in one transaction """
+    """ by a timer thread after MELLON_PROVISION_FLUSH_INTERVAL or when MELLON_PROVISION_BATCH_SIZE is reached, """
+    """ so a wave of first logins doesn't refresh the closure (and zone roles) once per user, """
+    """ the users of the wave just don't see zones of the group for up to MELLON_PROVISION_FLUSH_INTERVAL """
+
+    def __init__(self):
+        self.pending = {}           # login -> fingerprint
+        self.flushing = 0
+        self.lock = threading.Lock()
+        self.timer = None
+        self.app = None
+
+    def _schedule(self):
+        """ Starts the timer if it is not running, has to be called with the lock held """
+
+        if self.timer is None:
+            self.timer = threading.Timer(self.app.config['MELLON_PROVISION_FLUSH_INTERVAL'], self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def add(self, login, fingerprint):
+
+        app = flask.current_app._get_current_object()
+
+        with self.lock:
+
+            if self.app is None:
+                atexit.register(self.flush)
+            self.app = app
+
+            self.pending[login] = fingerprint
+            now = len(self.pending) == 1 and not self.flushing
+            full = len(self.pending) >= app.config['MELLON_PROVISION_BATCH_SIZE']
+
+            if not (now or full):
+                self._schedule()
+
+        if now or full:
+            self.flush()
+
+    def flush(self):
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not pending:
+                return
+            self.flushing += 1
+
+        try:
+            self._write(pending)
+        finally:
+            with self.lock:
+                self.flushing -= 1
+
+    def _write(self, pending):
+
+        with self.app.app_context():
+
+            defaultGroup = self.app.config.get('MELLON_DEFAULT_GROUP')
+            logins = list(pending)
+
+            try:
+                with DB.atomic():
+                    for i in range(0, len(logins), 300):
+                        batch = logins[i:i+300]
+                        Groups.insert([ {Groups.group: defaultGroup, Groups.login: l} for l in batch ]) \
+                              .on_conflict_ignore() \
+                              .execute()
+                        Users.update({Users.password: '*'}) \
+                             .where(Users.login.in_(batch)) \
+                             .where(Users.password == _PASSWORD_UNPROVISIONED) \
+                             .execute()
+                    group_closure.refreshClosure(logins)
+            except Exception:
+                logger.exception(f"Adding {len(pending)} new users to {defaultGroup} failed, will be retried")
+                with self.lock:
+                    for l,f in pending.items():
+                        self.pending.setdefault(l, f)
+                    self._schedule()
+                return
+
+            for l,f in pending.items():
+                _fingerprintCache.set(l, f)
+
+_provisioning = _Provisioning()
+
+
 @bp.route('/login')
 def login():
 
@@ -27,31 +138,37 @@ def login():
 
     userName = bytes(userName,'ISO-8859-1').decode('utf-8')
 
-    c = Users.select(Users.name).where(Users.login == login).scalar()
+    fingerprint = utils.makeETag(login, userName)
+
+    if _fingerprintCache.get(login) != fingerprint or auth.getAccountType(login) is None:
 
-    if c is None:
+        defaultGroup = flask.current_app.config.get('MELLON_DEFAULT_GROUP')
 
-        with DB.atomic():
+        row = Users.select(Users.name, Users.password).where(Users.login == login).scalar(as_tuple = True)
+
+        if row is None:
 
             Users.insert({
                 Users.login: login,
                 Users.name: userName,
                 Users.account_type: ACCOUNT_TYPE_USER,
-                Users.password: '*'
-            }).execute()
+                Users.password: _PASSWORD_UNPROVISIONED if defaultGroup is not None else '*'
+            }).on_conflict_ignore().execute()
+
+            auth.invalidateUserState(login)
 
-            defaultGroup = flask.current_app.config.get('MELLON_DEFAULT_GROUP')
-            if defaultGroup is not None:
-                Groups.insert({
-                    Groups.group: defaultGroup,
-                    Groups.login: login
-                }).execute()
+            # re-read, in case of a concurrent first login
+            row = Users.select(Users.name, Users.password).where(Users.login == login).scalar(as_tuple = True)
 
-    elif c != userName:
+        elif row[0] != userName:
 
-        with DB.atomic():
             Users.update({Users.name: userName}).where(Users.login == login).execute()
 
+        if defaultGroup is not None and row is not None and row[1] == _PASSWORD_UNPROVISIONED:
+            _provisioning.add(login, fingerprint)
+        else:
+            _fingerprintCache.set(login, fingerprint)
+
 
     flask.session['login'] = login
     flask.session['login_time'] = utils.now()
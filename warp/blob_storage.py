@@ -1,11 +1,82 @@
+import click
+import hashlib
+import hmac
 import io
+import os
+import tempfile
+import time
 
 import flask
+from flask.cli import with_appcontext
 from flask.wrappers import Response
+from peewee import fn
 from warp.db import *
+from warp import utils
+
+# Blob contents are stored either in the database (blobs.data) or, with BLOB_STORAGE = "FILESYSTEM",
+# in content-addressed files BLOB_STORAGE_PATH/<sha256[:2]>/<sha256>, then the row keeps only
+# the metadata, its sha256 and empty data.
+#
+# Files are sent without reading them into Python, depending on BLOB_SEND_MODE:
+#   SENDFILE          - via wsgi.file_wrapper, uwsgi uses sendfile() and offload threads for it
+#                       (or X-Sendfile header, if USE_X_SENDFILE is set, see Flask docs)
+#   X_ACCEL_REDIRECT  - nginx sends the file, see BLOB_ACCEL_REDIRECT_PREFIX and res/nginx.conf
+#
+# Existing blobs are moved to the configured storage with: flask migrate-blobs
+# (it also adds the sha256 column, which is required, to databases created before, and removes unused files
+# older than BLOB_ORPHAN_GRACE_PERIOD).
+
+# sha256 of blob contents, cached in each worker as (id, etag) -> hex digest,
+# etag is bumped on every update of the blob, so the entries never get stale
+_sha256Cache = utils.LRUCache('BLOB_HASH_CACHE_SIZE')
+
+def _filesystemStorage():
+
+    return flask.current_app.config['BLOB_STORAGE'].upper() == "FILESYSTEM"
+
+def _blobPath(sha256):
+
+    return os.path.join(flask.current_app.config['BLOB_STORAGE_PATH'], sha256[:2], sha256)
+
+def _writeFile(data):
+    """ Stores data in a content-addressed file (if it doesn't exist yet), returns its sha256 """
+
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = _blobPath(sha256)
+
+    # an existing file may be unused, its mtime is refreshed, so it's not removed as an orphan
+    # before the blob using it is committed (see migrateBlobs)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # written to a temporary file first, so a file under the final name is always complete
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmpPath, path)
+        except BaseException:
+            os.unlink(tmpPath)
+            raise
+
+    return sha256
+
+def _dataColumns(data):
+    """ Returns columns of blobs table storing data in the configured storage """
+
+    if _filesystemStorage():
+        return { Blobs.data: b'', Blobs.sha256: _writeFile(data) }
+
+    return { Blobs.data: data }
+
 
 def deleteBlob(blobId = None, blobIdQuery = None):
 
+    # files are not removed here, they can be shared by more blobs, see flask migrate-blobs
+
     if blobId is not None:
         query = Blobs.delete() \
                      .where(Blobs.id == blobId)
@@ -24,13 +95,15 @@ def deleteBlob(blobId = None, blobIdQuery = None):
 
 def addOrUpdateBlob(mimeType, data, blobId = None):
 
+    dataColumns = _dataColumns(data)
+
     with DB.atomic():
 
         if blobId is not None:
 
             rowCount = Blobs.update({
                             Blobs.mimetype: mimeType,
-                            Blobs.data: data,
+                            **dataColumns,
                             Blobs.etag: Blobs.etag + 1
                         }).where(Blobs.id == blobId).execute()
 
@@ -41,7 +114,7 @@ def addOrUpdateBlob(mimeType, data, blobId = None):
 
             insertCursor = Blobs.insert({
                                 Blobs.mimetype: mimeType,
-                                Blobs.data: data,
+                                **dataColumns,
                                 Blobs.etag: 1
                                 }) \
                             .returning(Blobs.id) \
@@ -52,6 +125,42 @@ def addOrUpdateBlob(mimeType, data, blobId = None):
     return blobId
 
 
+def _sendBlob(query, etag, maxAge = None):
+    """ Returns response with the contents of the blob selected by query """
+
+    row = query.columns(Blobs.data, Blobs.mimetype, Blobs.sha256).scalar(as_tuple = True)
+
+    if row is None:
+        flask.abort(404)
+
+    data, mimetype, sha256 = row
+
+    # the storage is given by the row, not by BLOB_STORAGE, it may be changed before migrate-blobs
+    if not (len(data) == 0 and sha256 is not None):
+        return flask.send_file(
+            io.BytesIO(data),
+            mimetype=mimetype,
+            etag=etag,
+            max_age=maxAge)
+
+    if flask.current_app.config['BLOB_SEND_MODE'].upper() == "X_ACCEL_REDIRECT":
+
+        resp = Response(mimetype=mimetype)
+        resp.headers['X-Accel-Redirect'] = flask.current_app.config['BLOB_ACCEL_REDIRECT_PREFIX'] + f"{sha256[:2]}/{sha256}"
+        resp.set_etag(etag)
+
+        return resp
+
+    try:
+        return flask.send_file(
+            _blobPath(sha256),
+            mimetype=mimetype,
+            etag=etag,
+            conditional=False,
+            max_age=maxAge)
+    except FileNotFoundError:
+        flask.abort(404)
+
 
 def createBlobResponse(blobId = None, blobIdQuery = None):
 
@@ -76,19 +185,172 @@ def createBlobResponse(blobId = None, blobIdQuery = None):
     if r304.status_code != 200:
         return r304
 
-    row = query.columns(Blobs.data, Blobs.mimetype).scalar(as_tuple = True)
+    resp = _sendBlob(query, blobEtag)
+
+    resp.cache_control.no_cache = True
+    resp.cache_control.private = True
+
+    return resp
+
+
+def getBlobHash(blobId, blobEtag = None):
+    """ Returns sha256 (hex) of the contents of the blob (None if it doesn't exist), """
+    """ blobEtag is its current etag, if already known """
+
+    if blobEtag is None:
+        blobEtag = Blobs.select(Blobs.etag).where(Blobs.id == blobId).scalar()
+        if blobEtag is None:
+            return None
+
+    key = (int(blobId), int(blobEtag))
+
+    res = _sha256Cache.get(key)
+    if res is None:
+
+        query = Blobs.select() \
+                     .where( (Blobs.id == blobId) & (Blobs.etag == blobEtag) )
+
+        row = query.columns(fn.LENGTH(Blobs.data), Blobs.sha256).scalar(as_tuple = True)
+        if row is None:
+            return None
+
+        # files are content-addressed, no need to read them
+        length, res = row
+        if not (length == 0 and res is not None):
+            data = query.columns(Blobs.data).scalar()
+            if data is None:
+                return None
+            res = hashlib.sha256(data).hexdigest()
 
+        _sha256Cache.set(key, res)
+
+    return res
+
+
+def getBlobToken(blobId, blobEtag = None):
+    """ Returns token of the contents of the blob for URLs (None if it doesn't exist), """
+    """ HMAC of its sha256 with SECRET_KEY, so it can't be derived from the contents """
+
+    sha256 = getBlobHash(blobId, blobEtag)
+    if sha256 is None:
+        return None
+
+    key = flask.current_app.config['SECRET_KEY']
+    if isinstance(key, str):
+        key = key.encode()
+
+    return hmac.new(key, sha256.encode(), hashlib.sha256).hexdigest()
+
+
+def createImmutableBlobResponse(token, blobId = None, blobIdQuery = None):
+    """ Returns the blob if token matches its contents (404 otherwise, see getBlobToken), as the URL """
+    """ changes with the contents, it can be cached by browsers and proxies forever """
+
+    if blobId is not None:
+        query = Blobs.select() \
+                     .where(Blobs.id == blobId)
+    elif blobIdQuery is not None:
+        query = Blobs.select() \
+                     .where(Blobs.id.in_(blobIdQuery))
+    else:
+        flask.abort(400)
+
+    row = query.columns(Blobs.id, Blobs.etag).scalar(as_tuple = True)
     if row is None:
         flask.abort(404)
 
-    resp = flask.send_file(
-        io.BytesIO(row[0]),
-        mimetype=row[1],
-        etag=blobEtag)
+    blobToken = getBlobToken(*row)
+    if blobToken is None or not hmac.compare_digest(blobToken, token):
+        flask.abort(404)
 
-    resp.cache_control.no_cache = True
-    resp.cache_control.private = True
+    maxAge = flask.current_app.config['BLOB_IMMUTABLE_MAX_AGE']
+
+    # the contents can't be different, no need for revalidation
+    if token in flask.request.if_none_match:
+        resp = Response(status=304)
+    else:
+        resp = _sendBlob(query, token, maxAge)
+
+    resp.set_etag(token)
+    resp.cache_control.no_cache = None
+    resp.cache_control.public = True
+    resp.cache_control.max_age = maxAge
+    resp.cache_control.immutable = True
 
     return resp
 
 
+def addHashColumn():
+    """ Adds sha256 column to blobs table of databases created before it existed """
+
+    if 'sha256' not in [ c.name for c in DB.get_columns('blobs') ]:
+        DB.execute_sql("ALTER TABLE blobs ADD COLUMN sha256 TEXT")
+
+
+def migrateBlobs():
+    """ Moves blobs to the storage configured in BLOB_STORAGE, one by one, in separate transactions, """
+    """ removes files not used by any blob (with filesystem storage), returns (moved, removed) """
+
+    addHashColumn()
+
+    toFilesystem = _filesystemStorage()
+
+    if toFilesystem:
+        idsQuery = Blobs.select(Blobs.id).where(fn.LENGTH(Blobs.data) > 0)
+    else:
+        idsQuery = Blobs.select(Blobs.id).where(Blobs.sha256.is_null(False) & (fn.LENGTH(Blobs.data) == 0))
+
+    moved = 0
+    for blobId, in list(idsQuery.tuples().iterator()):
+
+        with DB.atomic():
+
+            row = Blobs.select(Blobs.data, Blobs.sha256) \
+                       .where(Blobs.id == blobId) \
+                       .scalar(as_tuple = True)
+            if row is None:
+                continue
+
+            if toFilesystem:
+                columns = { Blobs.data: b'', Blobs.sha256: _writeFile(row[0]) }
+            else:
+                with open(_blobPath(row[1]), 'rb') as f:
+                    columns = { Blobs.data: f.read(), Blobs.sha256: None }
+
+            # etag is not changed, the contents is the same
+            Blobs.update(columns).where(Blobs.id == blobId).execute()
+            moved += 1
+
+    removed = 0
+    storagePath = flask.current_app.config.get('BLOB_STORAGE_PATH')
+
+    if toFilesystem and os.path.isdir(storagePath):
+
+        used = { s for s, in Blobs.select(Blobs.sha256).where(Blobs.sha256.is_null(False)).tuples().iterator() }
+
+        # files written (or reused) after used was read belong to blobs not committed yet
+        cutoff = time.time() - flask.current_app.config['BLOB_ORPHAN_GRACE_PERIOD']
+
+        for dirPath, _, fileNames in os.walk(storagePath):
+            for f in fileNames:
+                # skip temporary files of blobs being written
+                if len(f) != 64 or f in used:
+                    continue
+                path = os.path.join(dirPath, f)
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.unlink(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+
+    return moved, removed
+
+
+@click.command('migrate-blobs')
+@with_appcontext
+def migrateBlobsCommand():
+    """ Moves blobs (zone maps) to the storage configured in BLOB_STORAGE """
+
+    moved, removed = migrateBlobs()
+    click.echo(f"Moved {moved} blobs to {flask.current_app.config['BLOB_STORAGE'].lower()} storage, removed {removed} unused files.")
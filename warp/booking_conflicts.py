@@ -0,0 +1,143 @@
+import bisect
+
+from warp.db import *
+
+# Overlap check of bookings done in Python, before the bookings are inserted.
+#
+# The rule is the same as in the trigger on book table: a booking conflicts with bookings
+# of the same seat or of the same login in the same zone group, which overlap in time.
+#
+# Bookings of the zone groups in the checked time window are loaded with a single query
+# and kept sorted per seat and per login, so each checked range is just a binary search.
+# The trigger stays as a safety net (e.g. for bookings made concurrently by other workers).
+
+class _Intervals:
+    """ Intervals sorted on fromTS, with running maximum of toTS, so overlapping """
+    """ intervals are found with binary search even if the intervals overlap each other """
+
+    def __init__(self):
+        self.froms = []
+        self.maxTos = []
+        self.items = []
+
+    def add(self, fromTS, toTS, info):
+
+        i = bisect.bisect_right(self.froms, fromTS)
+
+        self.froms.insert(i, fromTS)
+        self.items.insert(i, (fromTS, toTS, info))
+        self.maxTos.insert(i, 0)
+
+        maxTo = self.maxTos[i-1] if i > 0 else toTS
+        for j in range(i, len(self.items)):
+            maxTo = max(maxTo, self.items[j][1])
+            self.maxTos[j] = maxTo
+
+    def overlapping(self, fromTS, toTS):
+        """ Returns infos of intervals overlapping the range """
+
+        # intervals before i all end before (or at) fromTS
+        i = bisect.bisect_right(self.maxTos, fromTS)
+        end = bisect.bisect_left(self.froms, toTS)
+
+        return [ info for f,t,info in self.items[i:end] if t > fromTS ]
+
+
+class BookingConflicts:
+    """ Bookings of the zone groups in the time window, of the seats and of the logins, """
+    """ bookings in ignoreBids are left out (e.g. these which are going to be removed) """
+
+    def __init__(self, zoneGroups, sids, logins, fromTS, toTS, ignoreBids = ()):
+
+        self.intervals = {}
+
+        if not zoneGroups or fromTS >= toTS:
+            return
+
+        query = Book.select(Book.id, Book.sid, Book.login, Book.fromts, Book.tots, Zone.zone_group) \
+                    .join(Seat, on=(Book.sid == Seat.id)) \
+                    .join(Zone, on=(Seat.zid == Zone.id)) \
+                    .where(Zone.zone_group.in_(list(zoneGroups))) \
+                    .where(Book.sid.in_(list(sids)) | Book.login.in_(list(logins))) \
+                    .where( (Book.fromts < toTS) & (Book.tots > fromTS) ) \
+                    .tuples()
+
+        ignoreBids = set(ignoreBids)
+
+        for bid,sid,login,f,t,zoneGroup in query.iterator():
+            if bid not in ignoreBids:
+                self.add(zoneGroup, sid, login, f, t, { "bid": bid })
+
+    def _keys(self, zoneGroup, sid, login):
+        return [ ('sid', zoneGroup, sid), ('login', zoneGroup, login) ]
+
+    def add(self, zoneGroup, sid, login, fromTS, toTS, info = None):
+        """ Adds a booking, so it is taken into account by the following checks """
+
+        info = { "sid": sid, "login": login, "fromTS": fromTS, "toTS": toTS, **(info or {}) }
+
+        for k in self._keys(zoneGroup, sid, login):
+            self.intervals.setdefault(k, _Intervals()).add(fromTS, toTS, info)
+
+    def find(self, zoneGroup, sid, login, fromTS, toTS):
+        """ Returns bookings conflicting with the range """
+
+        res = {}
+        for k in self._keys(zoneGroup, sid, login):
+            intervals = self.intervals.get(k)
+            if intervals is not None:
+                for info in intervals.overlapping(fromTS, toTS):
+                    res[id(info)] = info
+
+        return list(res.values())
+
+    def check(self, zoneGroup, sid, login, dates, info = None):
+        """ Checks the dates ({ fromTS, toTS }) of a booking of the seat for the login """
+        """ returns list of { fromTS, toTS, bookings: [ conflicting bookings ] } for conflicting dates, """
+        """ dates overlapping each other or with fromTS >= toTS are conflicting as well """
+        """ if there is no conflict, dates are added (with info) """
+
+        res = []
+        own = _Intervals()
+
+        for d in dates:
+
+            f,t = d['fromTS'], d['toTS']
+
+            if f >= t:
+                res.append({ "fromTS": f, "toTS": t, "bookings": [] })
+                continue
+
+            bookings = self.find(zoneGroup, sid, login, f, t) + own.overlapping(f, t)
+            if bookings:
+                res.append({ "fromTS": f, "toTS": t, "bookings": bookings })
+
+            own.add(f, t, { "sid": sid, "login": login, "fromTS": f, "toTS": t, **(info or {}) })
+
+        if not res:
+            for d in dates:
+                self.add(zoneGroup, sid, login, d['fromTS'], d['toTS'], info)
+
+        return res
+
+
+def loadForDates(bookings, ignoreBids = ()):
+    """ Returns BookingConflicts for bookings (zoneGroup, sid, login, dates) to be checked """
+
+    zoneGroups = set()
+    sids = set()
+    logins = set()
+    fromTS = toTS = None
+
+    for zoneGroup,sid,login,dates in bookings:
+        zoneGroups.add(zoneGroup)
+        sids.add(sid)
+        logins.add(login)
+        for d in dates:
+            fromTS = d['fromTS'] if fromTS is None else min(fromTS, d['fromTS'])
+            toTS = d['toTS'] if toTS is None else max(toTS, d['toTS'])
+
+    if fromTS is None:
+        return BookingConflicts(set(), sids, logins, 0, 0)
+
+    return BookingConflicts(zoneGroups, sids, logins, fromTS, toTS, ignoreBids)
@@ -21,6 +21,66 @@ class DefaultSettings(object):
 
     MAX_REPORT_ROWS = 5000
 
+    # maximum length (in days) of a recurring booking series (see zone/apply)
+    RECURRENCE_MAX_DAYS = 366
+
+    # number of serialized zone seat maps cached in each worker
+    ZONE_SEATS_CACHE_SIZE = 64
+
+    # number of sha256 hashes of blobs (zone maps) cached in each worker
+    BLOB_HASH_CACHE_SIZE = 256
+    # max-age (seconds) of zone maps served under URLs containing their token (HMAC of their hash)
+    BLOB_IMMUTABLE_MAX_AGE = 365*24*3600
+
+    # where zone maps are stored: DATABASE or FILESYSTEM (files in BLOB_STORAGE_PATH, see blob_storage.py)
+    # after changing it run: flask migrate-blobs
+    BLOB_STORAGE = "DATABASE"
+    BLOB_STORAGE_PATH = "/var/lib/warp/blobs"
+    # how files are sent: SENDFILE (wsgi.file_wrapper, offloaded by uwsgi) or X_ACCEL_REDIRECT (nginx)
+    BLOB_SEND_MODE = "SENDFILE"
+    # internal nginx location mapped to BLOB_STORAGE_PATH, used with X_ACCEL_REDIRECT
+    BLOB_ACCEL_REDIRECT_PREFIX = "/blobs/"
+    # unused files are removed by flask migrate-blobs only if not modified for this long (seconds),
+    # blobs being written at the same time are not committed yet
+    BLOB_ORPHAN_GRACE_PERIOD = 24*3600
+
+    # for how many seconds each worker caches account types of logged in users (see auth.check_session)
+    # i.e. how long it takes until blocking or deleting a user takes effect in other workers
+    # 0 disables the cache
+    USER_STATE_CACHE_TTL = 10
+    USER_STATE_CACHE_SIZE = 10000
+
+    # number of (login, zone) roles cached in each worker (see zone_roles.py)
+    ZONE_ROLES_CACHE_SIZE = 10000
+
+    # number of logins whose header navigation is cached in each worker (see view.headerDataInit)
+    HEADER_CACHE_SIZE = 1000
+
+    # push zone changes to open zone pages (Server-Sent Events)
+    # each open page keeps one worker thread busy, so make sure uwsgi has enough
+    # threads (or async workers) before enabling it
+    ZONE_EVENTS = False
+    # after how many seconds the event stream is closed (browser reconnects automatically)
+    ZONE_EVENTS_TIMEOUT = 55
+    # how often (in seconds) the stream checks for changes made by other workers
+    ZONE_EVENTS_POLL_INTERVAL = 2
+
+    # width (in seconds) of the slots in seat occupancy bitmaps, it must divide 24 hours
+    # after changing it run: flask rebuild-occupancy
+    OCCUPANCY_SLOT = 15*60
+
+    # werkzeug method of new password hashes (e.g. "scrypt:32768:8:1"), hashes created with
+    # other parameters are upgraded on the next login, None uses werkzeug's default and upgrades nothing
+    PASSWORD_HASH_METHOD = None
+    # number of processes hashing passwords in each worker, 0 hashes in the request thread
+    PASSWORD_HASH_WORKERS = 2
+    # max. number of pending hashes in each worker, further logins are rejected as busy
+    PASSWORD_HASH_QUEUE_SIZE = 8
+    # how many seconds a request waits for a hash
+    PASSWORD_HASH_TIMEOUT = 5
+    # how often (in seconds) each worker logs the counters of password hashing, 0 disables it
+    PASSWORD_HASH_METRICS_INTERVAL = 300
+
     DATABASE_INIT_SCRIPT = "sql/schema.sql"
 
     # number of connection retries to DB on initialization
@@ -43,8 +103,27 @@ class DefaultSettings(object):
     LDAP_USER_SEARCH_FILTER_TEMPLATE = "(objectClass=person)"
     LDAP_GROUP_SEARCH_FILTER_TEMPLATE = "(&(memberUid={login})(cn={group}))"
     LDAP_GROUP_MAP = [ [None,None] ]
+    # how LDAP_GROUP_MAP is checked: PER_GROUP (one search per mapped group),
+    # ONE_QUERY (one OR search of all mapped groups) or MEMBER_OF (memberOf attribute of the user)
+    LDAP_GROUP_SEARCH_MODE = "PER_GROUP"
+    LDAP_GROUP_NAME_ATTRIBUTE = "cn"
+    LDAP_MEMBER_OF_ATTRIBUTE = "memberOf"
     LDAP_GROUP_STRICT_MAPPING = False
     LDAP_EXCLUDED_USERS = []
+    # max. number of idle LDAP_SERVICE_USER connections kept in each worker
+    LDAP_SERVICE_POOL_SIZE = 4
+    # for how many seconds user name and groups from LDAP are cached in each worker, 0 disables the cache
+    LDAP_METADATA_CACHE_TTL = 300
+    LDAP_METADATA_CACHE_SIZE = 10000
+    # write name and groups from LDAP to the database on each login,
+    # it can be disabled when users are synchronized with: flask ldap-sync
+    LDAP_SYNC_ON_LOGIN = True
+    # bulk sync (flask ldap-sync) settings, LDAP_SERVICE_USER and LDAP_SYNC_USER_SEARCH_BASE are required
+    LDAP_SYNC_USER_SEARCH_FILTER = "(objectClass=person)"
+    LDAP_SYNC_LOGIN_ATTRIBUTE = "uid"
+    # attribute of group entries with logins or DNs of the members (not used in MEMBER_OF mode)
+    LDAP_SYNC_GROUP_MEMBER_ATTRIBUTE = "memberUid"
+    LDAP_SYNC_PAGE_SIZE = 500
 
     ### LDAP variables to be configured
     # AUTH_LDAP = True
@@ -54,6 +133,9 @@ class DefaultSettings(object):
     # LDAP_GROUP_SEARCH_BASE = "ou=groups,dc=example,dc=org"
     # LDAP_TLS_VERSION (optional)
     # LDAP_TLS_CIPHERS (optional)
+    # LDAP_SERVICE_USER (optional, account used for searches)
+    # LDAP_SERVICE_PASSWORD (optional)
+    # LDAP_SYNC_USER_SEARCH_BASE = "ou=users,dc=example,dc=org" (optional, for flask ldap-sync)
 
     # these settings are available, but should not have default value
     # set them up in DevelopmentSettings or via environment
@@ -66,6 +148,14 @@ class DefaultSettings(object):
     # MELLON_ENDPOINT
     # MELLON_DEFAULT_GROUP
 
+    # number of fingerprints of SAML attributes (login, name) cached in each worker,
+    # logins with unchanged attributes don't write to the database
+    MELLON_FINGERPRINT_CACHE_SIZE = 10000
+    # new users are added to MELLON_DEFAULT_GROUP right away, but if more of them log in at once,
+    # in batches, after at most this many seconds or when the batch is full
+    MELLON_PROVISION_FLUSH_INTERVAL = 2
+    MELLON_PROVISION_BATCH_SIZE = 300
+
 class DevelopmentSettings(DefaultSettings):
 
     # Comment out or remove PostgreSQL connection
@@ -27,6 +27,11 @@ class Group(db.Model):
     group = db.Column(db.String)
     login = db.Column(db.String)
 
+class GroupClosure(db.Model):
+    ancestor = db.Column(db.String, primary_key=True)
+    member = db.Column(db.String, primary_key=True, index=True)
+    depth = db.Column(db.Integer)
+
 class Zone(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     zone_group = db.Column(db.String, index=True)
@@ -67,11 +72,28 @@ class Book(db.Model):
     fromts = db.Column(db.Integer)
     tots = db.Column(db.Integer)
 
+class SeatOccupancy(db.Model):
+    sid = db.Column(db.Integer, db.ForeignKey('seat.id'), primary_key=True)
+    day = db.Column(db.Integer, primary_key=True, index=True)
+    slots = db.Column(db.LargeBinary)
+
+class ZoneChange(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    zid = db.Column(db.Integer, db.ForeignKey('zone.id'), index=True)
+    sid = db.Column(db.Integer, nullable=True)
+    kind = db.Column(db.String)
+    ts = db.Column(db.Integer, index=True)
+
+class Generation(db.Model):
+    name = db.Column(db.String, primary_key=True)
+    value = db.Column(db.Integer)
+
 class Blob(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     mimetype = db.Column(db.String)
     data = db.Column(db.LargeBinary)
     etag = db.Column(db.String)
+    sha256 = db.Column(db.String)
 
 def init_db(app):
     """Initialize database and ensure admin user exists if configured"""
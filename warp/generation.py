@@ -0,0 +1,25 @@
+from warp.db import *
+
+# Generation counters are kept in generation table and bumped by DB triggers
+# (see schema), so every write is counted, no matter which worker or module made it.
+#
+#   GENERATION_USERS - users (names and account types), groups, zone roles and zones
+#
+# Databases created only from the models (db.create_all) have neither the rows nor the triggers,
+# then getGeneration returns None and the caches depending on it are not used.
+
+GENERATION_USERS = 'users'
+
+def generationQuery(name = GENERATION_USERS):
+    """ Returns a query of the counter, can be used as a scalar subquery """
+
+    return Generation.select(Generation.value) \
+                     .where(Generation.name == name)
+
+
+def getGeneration(name = GENERATION_USERS):
+    """ Returns the counter, None if it is not maintained in the database """
+
+    return db.session.query(Generation.value) \
+                     .filter(Generation.name == name) \
+                     .scalar()
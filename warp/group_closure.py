@@ -0,0 +1,169 @@
+import click
+import heapq
+from flask.cli import with_appcontext
+from peewee import Tuple
+
+from warp.db import *
+
+# Transitive closure of group membership, stored in group_closure table, one row
+# (ancestor, member, depth) for each group the member belongs to, directly (depth 1)
+# or via nested groups (depth is the length of the shortest path).
+#
+# Zone roles are resolved with a flat join of group_closure and zone_assign,
+# (see user_to_zone_roles in the schema), instead of recursing over groups table.
+#
+# The closure is updated in Python (see refreshClosure) by all the code changing groups,
+# only the changed rows are written. If groups table is changed directly in the database,
+# the closure can be rebuilt with: flask rebuild-group-closure
+
+_BATCH_SIZE = 300
+
+def _ancestors(login, parents, known):
+    """ Returns { ancestor: depth } of the login, parents are direct groups of the logins """
+    """ being recomputed, known are already computed ancestors of other logins """
+
+    res = {}
+    heap = [ (1, p) for p in parents.get(login, ()) ]
+
+    while heap:
+
+        depth,n = heapq.heappop(heap)
+        if n in res:
+            continue
+
+        res[n] = depth
+
+        if n in known:
+            for a,d in known[n].items():
+                if a not in res:
+                    heapq.heappush(heap, (depth + d, a))
+        else:
+            for p in parents.get(n, ()):
+                if p not in res:
+                    heapq.heappush(heap, (depth + 1, p))
+
+    # in case of a cycle
+    res.pop(login, None)
+
+    return res
+
+
+def _writeDiff(old, new):
+    """ Writes the difference between old and new { member: { ancestor: depth } } """
+
+    deleteData = []
+    insertData = []
+
+    for member in old.keys() | new.keys():
+
+        o = old.get(member, {})
+        n = new.get(member, {})
+
+        deleteData.extend( (member, a) for a,d in o.items() if n.get(a) != d )
+
+        insertData.extend( {
+                GroupClosure.ancestor: a,
+                GroupClosure.member: member,
+                GroupClosure.depth: d
+            } for a,d in n.items() if o.get(a) != d )
+
+    # user_to_zone_roles is updated by statement triggers on PostgreSQL (see group_closure_roles),
+    # so the rows are deleted in batches, not per member,
+    # keep the statements small enough for SQLite variable limit
+    for i in range(0, len(deleteData), _BATCH_SIZE):
+        GroupClosure.delete() \
+                    .where(Tuple(GroupClosure.member, GroupClosure.ancestor).in_(deleteData[i:i+_BATCH_SIZE])) \
+                    .execute()
+
+    for i in range(0, len(insertData), _BATCH_SIZE):
+        GroupClosure.insert(insertData[i:i+_BATCH_SIZE]).execute()
+
+
+def refreshClosure(logins):
+    """ Recomputes ancestors of the logins and of all their members, has to be called in the same """
+    """ transaction, after the groups of the logins were changed (or after a group was deleted, """
+    """ then with its direct members) """
+
+    logins = set(logins)
+    if not logins:
+        return
+
+    with DB.atomic():
+
+        # only paths going through the logins can change, so the closure of the members
+        # (down to the logins) is still valid
+        affected = set(logins)
+        for i in range(0, len(logins), _BATCH_SIZE):
+            membersQuery = GroupClosure.select(GroupClosure.member) \
+                                       .where(GroupClosure.ancestor.in_(list(logins)[i:i+_BATCH_SIZE])) \
+                                       .tuples()
+            affected.update( m for m, in membersQuery.iterator() )
+
+        affected = list(affected)
+        parents = {}
+        old = {}
+
+        for i in range(0, len(affected), _BATCH_SIZE):
+
+            batch = affected[i:i+_BATCH_SIZE]
+
+            groupsQuery = Groups.select(Groups.login, Groups.group) \
+                                .where(Groups.login.in_(batch)) \
+                                .tuples()
+            for l,g in groupsQuery.iterator():
+                parents.setdefault(l, []).append(g)
+
+            closureQuery = GroupClosure.select(GroupClosure.member, GroupClosure.ancestor, GroupClosure.depth) \
+                                       .where(GroupClosure.member.in_(batch)) \
+                                       .tuples()
+            for m,a,d in closureQuery.iterator():
+                old.setdefault(m, {})[a] = d
+
+        affectedSet = set(affected)
+        outside = list({ g for groups in parents.values() for g in groups if g not in affectedSet })
+        known = { g: {} for g in outside }
+
+        for i in range(0, len(outside), _BATCH_SIZE):
+            closureQuery = GroupClosure.select(GroupClosure.member, GroupClosure.ancestor, GroupClosure.depth) \
+                                       .where(GroupClosure.member.in_(outside[i:i+_BATCH_SIZE])) \
+                                       .tuples()
+            for m,a,d in closureQuery.iterator():
+                known[m][a] = d
+
+        new = {}
+        for login in affected:
+            new[login] = known[login] = _ancestors(login, parents, known)
+
+        _writeDiff(old, new)
+
+
+def rebuildClosure():
+    """ Rebuilds the whole closure from groups table, returns the number of rows """
+
+    with DB.atomic():
+
+        parents = {}
+        for l,g in Groups.select(Groups.login, Groups.group).tuples().iterator():
+            parents.setdefault(l, []).append(g)
+
+        old = {}
+        closureQuery = GroupClosure.select(GroupClosure.member, GroupClosure.ancestor, GroupClosure.depth).tuples()
+        for m,a,d in closureQuery.iterator():
+            old.setdefault(m, {})[a] = d
+
+        known = {}
+        for login in parents:
+            known[login] = _ancestors(login, parents, known)
+
+        _writeDiff(old, known)
+
+    return sum( len(i) for i in known.values() )
+
+
+@click.command('rebuild-group-closure')
+@with_appcontext
+def rebuildClosureCommand():
+    """ Rebuilds group membership closure from groups table """
+
+    count = rebuildClosure()
+    click.echo(f"Rebuilt group closure with {count} rows.")
@@ -0,0 +1,242 @@
+import click
+import flask
+import time
+from flask.cli import with_appcontext
+from peewee import Tuple
+from ldap3.utils.conv import escape_filter_chars
+
+from warp.db import *
+from warp import auth_ldap
+from warp import group_closure
+
+# Bulk synchronization of users and their groups from LDAP, run periodically (e.g. from cron):
+#   flask ldap-sync
+#
+# All users matching LDAP_SYNC_USER_SEARCH_FILTER are read with paged searches using the
+# LDAP_SERVICE_USER account, LDAP_GROUP_MAP is evaluated locally (as in ONE_QUERY / MEMBER_OF
+# modes of the login) and the result is compared with users and groups tables. Only the
+# differences are written, in batches, in two transactions (users, then groups) and the group
+# closure is refreshed once for all changed logins (zone roles follow via triggers).
+#
+# Users who are no longer in LDAP (or no longer allowed by the mapping) are not removed,
+# they just can't log in anymore. With LDAP_GROUP_STRICT_MAPPING they are removed from all
+# Warp groups used in LDAP_GROUP_MAP (users in LDAP_EXCLUDED_USERS are never touched).
+# With LDAP_SYNC_ON_LOGIN = False, the login of an already synchronized user does not write
+# anything to the database.
+
+_BATCH_SIZE = 300
+
+def _values(attributes, name):
+    """ Returns values of the attribute of a search result as a list """
+
+    v = attributes.get(name, [])
+    if isinstance(v, list):
+        return v
+    return [v]
+
+def _pagedSearch(ldapConnection, searchBase, searchFilter, attributes):
+    """ Returns a generator of (dn, attributes) of all the entries found, page by page """
+
+    pageSize = flask.current_app.config['LDAP_SYNC_PAGE_SIZE']
+
+    for entry in ldapConnection.extend.standard.paged_search(search_base=searchBase,
+                                                             search_filter=searchFilter,
+                                                             attributes=attributes,
+                                                             paged_size=pageSize,
+                                                             generator=True):
+        if entry.get('type') == 'searchResEntry':
+            yield entry['dn'], entry['attributes']
+
+
+def ldapDirectoryUsers(ldapConnection):
+    """ Returns { login: { "userName": name, "groups": [ warp groups ] } } of all users allowed """
+    """ to log in according to LDAP_GROUP_MAP """
+
+    config = flask.current_app.config
+
+    groupSearchMode = config.get('LDAP_GROUP_SEARCH_MODE').upper()
+    loginAtt = config['LDAP_SYNC_LOGIN_ATTRIBUTE']
+    nameAtt = config['LDAP_USER_NAME_ATTRIBUTE']
+    memberOfAtt = config['LDAP_MEMBER_OF_ATTRIBUTE']
+    excludedUsers = set(config.get('LDAP_EXCLUDED_USERS', []))
+
+    attributes = [loginAtt, nameAtt]
+    if groupSearchMode == "MEMBER_OF":
+        attributes.append(memberOfAtt)
+
+    users = {}
+    dnToLogin = {}
+
+    for dn,att in _pagedSearch(ldapConnection, config['LDAP_SYNC_USER_SEARCH_BASE'], config['LDAP_SYNC_USER_SEARCH_FILTER'], attributes):
+
+        login = _values(att, loginAtt)
+        if len(login) != 1:
+            print(f"LDAP sync: skipping entry without a single {loginAtt}: {dn}")
+            continue
+
+        login = str(login[0])
+        if login in excludedUsers:
+            continue
+
+        name = _values(att, nameAtt)
+        users[login] = {
+            "userName": str(name[0]) if name else login,
+            "memberships": auth_ldap.ldapGroupsMemberOf(_values(att, memberOfAtt)) if groupSearchMode == "MEMBER_OF" else set()
+        }
+        dnToLogin[dn.lower()] = login
+
+    # in other modes, members are read from the entries of the mapped groups
+    searchBase = config.get('LDAP_GROUP_SEARCH_BASE', None)
+    ldapGroups = { g for g,_ in config.get('LDAP_GROUP_MAP') if g is not None }
+
+    if groupSearchMode != "MEMBER_OF" and searchBase is not None and ldapGroups:
+
+        groupNameAtt = config['LDAP_GROUP_NAME_ATTRIBUTE']
+        memberAtt = config['LDAP_SYNC_GROUP_MEMBER_ATTRIBUTE']
+        searchFilter = "(|" + "".join(f"({groupNameAtt}={escape_filter_chars(g)})" for g in ldapGroups) + ")"
+
+        for dn,att in _pagedSearch(ldapConnection, searchBase, searchFilter, [groupNameAtt, memberAtt]):
+
+            names = { str(v).lower() for v in _values(att, groupNameAtt) }
+
+            # members are either logins (memberUid) or DNs of the users (member)
+            for m in _values(att, memberAtt):
+                login = dnToLogin.get(str(m).lower(), str(m))
+                if login in users:
+                    users[login]["memberships"].update(names)
+
+    res = {}
+    for login,u in users.items():
+        groups = auth_ldap.ldapMapGroups(lambda g: g.lower() in u["memberships"])
+        if groups is not None:
+            res[login] = { "userName": u["userName"], "groups": groups }
+
+    return res
+
+
+def ldapSync(dryRun = False):
+    """ Synchronizes users and groups tables with LDAP, returns dict with the numbers of changes """
+
+    config = flask.current_app.config
+
+    if not config.get('LDAP_SERVICE_USER') or not config.get('LDAP_SYNC_USER_SEARCH_BASE'):
+        raise Exception("LDAP_SERVICE_USER and LDAP_SYNC_USER_SEARCH_BASE must be configured for LDAP sync")
+
+    ldapConnection = auth_ldap.ldapBind(config['LDAP_SERVICE_USER'], config.get('LDAP_SERVICE_PASSWORD'))
+    if ldapConnection is None:
+        raise Exception("LDAP: bind of LDAP_SERVICE_USER failed")
+
+    try:
+        directory = ldapDirectoryUsers(ldapConnection)
+    finally:
+        ldapConnection.unbind()
+
+    stats = { "directory": len(directory), "inserted": 0, "renamed": 0, "groupsAdded": 0, "groupsRemoved": 0, "skipped": 0 }
+
+    existingUsers = {}
+    existingGroups = set()
+    for login,name,accountType in Users.select(Users.login, Users.name, Users.account_type).tuples().iterator():
+        if accountType == ACCOUNT_TYPE_GROUP:
+            existingGroups.add(login)
+        else:
+            existingUsers[login] = name
+
+    currentGroups = {}
+    for login,group in Groups.select(Groups.login, Groups.group).tuples().iterator():
+        currentGroups.setdefault(login, set()).add(group)
+
+    insertUsers = []
+    renameUsers = []
+    insertGroups = []
+    deleteGroups = {}
+    missingGroups = set()
+
+    strictMapping = config.get('LDAP_GROUP_STRICT_MAPPING')
+
+    for login,userData in directory.items():
+
+        if login in existingGroups:
+            print(f"LDAP sync: {login} is a group in Warp, skipping")
+            stats["skipped"] += 1
+            continue
+
+        if login not in existingUsers:
+            insertUsers.append( {
+                Users.login: login,
+                Users.name: userData["userName"],
+                Users.account_type: ACCOUNT_TYPE_USER,
+                Users.password: '*'
+            })
+        elif existingUsers[login] != userData["userName"]:
+            renameUsers.append( (login, userData["userName"]) )
+
+        mapped = set(userData["groups"])
+        missingGroups.update(mapped - existingGroups)
+        mapped &= existingGroups
+
+        current = currentGroups.get(login, set())
+        insertGroups.extend( {Groups.login: login, Groups.group: g} for g in mapped - current )
+
+        if strictMapping and current - mapped:
+            deleteGroups[login] = list(current - mapped)
+
+    # users no longer in LDAP lose the memberships given by the mapping, but only if the search
+    # returned anything at all, so a wrong search base doesn't empty all the groups
+    if strictMapping and directory:
+
+        excludedUsers = set(config.get('LDAP_EXCLUDED_USERS', []))
+        mappedGroups = { g for _,g in config.get('LDAP_GROUP_MAP') if g is not None }
+
+        for login in existingUsers.keys() - directory.keys() - excludedUsers:
+            stale = currentGroups.get(login, set()) & mappedGroups
+            if stale:
+                deleteGroups[login] = list(stale)
+
+    if missingGroups:
+        print("LDAP WARNING: groups mapped via LDAP_GROUP_MAP which doesn't exist in Warp: "+", ".join(sorted(missingGroups)))
+
+    stats["inserted"] = len(insertUsers)
+    stats["renamed"] = len(renameUsers)
+    stats["groupsAdded"] = len(insertGroups)
+    stats["groupsRemoved"] = sum( len(i) for i in deleteGroups.values() )
+
+    if dryRun:
+        return stats
+
+    with DB.atomic():
+
+        for i in range(0, len(insertUsers), _BATCH_SIZE):
+            Users.insert(insertUsers[i:i+_BATCH_SIZE]).execute()
+
+        for login,name in renameUsers:
+            Users.update({Users.name: name}).where(Users.login == login).execute()
+
+    with DB.atomic():
+
+        deleteData = [ (login, g) for login,groups in deleteGroups.items() for g in groups ]
+        for i in range(0, len(deleteData), _BATCH_SIZE):
+            Groups.delete() \
+                  .where( Tuple(Groups.login, Groups.group).in_(deleteData[i:i+_BATCH_SIZE]) ) \
+                  .execute()
+
+        for i in range(0, len(insertGroups), _BATCH_SIZE):
+            Groups.insert(insertGroups[i:i+_BATCH_SIZE]).on_conflict_ignore().execute()
+
+        group_closure.refreshClosure( [ i[Groups.login] for i in insertGroups ] + list(deleteGroups.keys()) )
+
+    return stats
+
+
+@click.command('ldap-sync')
+@click.option('--dry-run', is_flag=True, help="Only report the changes.")
+@with_appcontext
+def ldapSyncCommand(dry_run):
+    """ Synchronizes users and their groups from LDAP """
+
+    t = time.perf_counter()
+    stats = ldapSync(dry_run)
+    t = time.perf_counter() - t
+
+    click.echo(f"LDAP sync{' (dry run)' if dry_run else ''}: {stats['directory']} users in LDAP, "
+               f"{stats['inserted']} added, {stats['renamed']} renamed, {stats['skipped']} skipped, "
+               f"group memberships: {stats['groupsAdded']} added, {stats['groupsRemoved']} removed ({t:.1f} s)")
@@ -0,0 +1,240 @@
+import click
+import flask
+from flask.cli import with_appcontext
+
+from warp.db import *
+from warp import utils
+
+# Occupancy bitmaps of seats, stored in seat_occupancy table, one row per seat and day
+# with at least one booking (no row means the seat is free the whole day).
+#
+# The day is split into slots of OCCUPANCY_SLOT seconds, bit i of the bitmap is set
+# if any booking overlaps the i-th slot. Bitmaps are stored as little endian bytes
+# and used as python ints, so availability checks are just bitwise operations.
+#
+# Bits of slots fully covered by a checked time range are exact, bits of slots covered
+# only partially (range is not aligned to slots) mean that the seat may be occupied,
+# these seats are checked against book table (see getBusySids).
+#
+# Only days from today on are kept. Bitmaps are updated with bookings (see refreshOccupancy)
+# and can be rebuilt from book table with: flask rebuild-occupancy
+
+DAY = 24*3600
+
+def slotWidth():
+
+    slot = flask.current_app.config['OCCUPANCY_SLOT']
+
+    if slot <= 0 or DAY % slot:
+        raise ValueError("OCCUPANCY_SLOT must divide 24 hours")
+
+    return slot
+
+
+def _days(fromTS, toTS):
+    """ Returns midnights of all days overlapped by the range """
+
+    return range(fromTS - fromTS % DAY, toTS, DAY)
+
+
+def _slotsMask(first, last):
+    """ Returns bitmap with slots first..last-1 set """
+
+    if last <= first:
+        return 0
+
+    return ((1 << (last - first)) - 1) << first
+
+
+def rangeMasks(fromTS, toTS, slot):
+    """ Returns { day: (touchedMask, coveredMask) } of the time range """
+    """ touchedMask has all the slots overlapped by the range set, """
+    """ coveredMask only the slots fully inside of the range """
+
+    res = {}
+
+    for day in _days(fromTS, toTS):
+
+        f = max(fromTS, day) - day
+        t = min(toTS, day + DAY) - day
+
+        touched = _slotsMask(f // slot, -(-t // slot))
+        covered = _slotsMask(-(-f // slot), t // slot)
+
+        res[day] = (touched, covered)
+
+    return res
+
+
+def _bookingsBitmaps(bookings, slot, days = None):
+    """ Returns { (sid, day): bitmap } of (sid, fromTS, toTS) bookings, only for days if given """
+
+    res = {}
+
+    for sid,fromTS,toTS in bookings:
+        for day,(touched,_) in rangeMasks(fromTS, toTS, slot).items():
+            if days is None or day in days:
+                res[(sid, day)] = res.get((sid, day), 0) | touched
+
+    return res
+
+
+def _toBytes(bitmap, slot):
+    return bitmap.to_bytes((DAY // slot + 7) // 8, 'little')
+
+
+def _insertBitmaps(bitmaps, slot):
+
+    insertData = [ {
+            SeatOccupancy.sid: sid,
+            SeatOccupancy.day: day,
+            SeatOccupancy.slots: _toBytes(bitmap, slot)
+        } for (sid, day),bitmap in bitmaps.items() ]
+
+    # keep the statements small enough for SQLite variable limit
+    for i in range(0, len(insertData), 300):
+        SeatOccupancy.insert(insertData[i:i+300]).execute()
+
+
+def refreshOccupancy(bookings):
+    """ Recomputes bitmaps of seats and days touched by the bookings (sid, fromTS, toTS) """
+    """ has to be called in the same transaction, after the bookings are inserted or deleted """
+
+    slot = slotWidth()
+    today = utils.today()
+
+    sids = set()
+    days = set()
+    for sid,fromTS,toTS in bookings:
+        sids.add(sid)
+        days.update( d for d in _days(fromTS, toTS) if d >= today )
+
+    if not sids or not days:
+        return
+
+    with DB.atomic():
+
+        SeatOccupancy.delete() \
+                     .where(SeatOccupancy.day < today) \
+                     .execute()
+
+        SeatOccupancy.delete() \
+                     .where(SeatOccupancy.sid.in_(list(sids))) \
+                     .where(SeatOccupancy.day.in_(list(days))) \
+                     .execute()
+
+        bookQuery = Book.select(Book.sid, Book.fromts, Book.tots) \
+                        .where(Book.sid.in_(list(sids))) \
+                        .where( (Book.fromts < max(days) + DAY) & (Book.tots > min(days)) ) \
+                        .tuples()
+
+        _insertBitmaps(_bookingsBitmaps(bookQuery.iterator(), slot, days), slot)
+
+
+def rebuildOccupancy():
+    """ Rebuilds all bitmaps from book table, returns the number of bitmaps """
+
+    slot = slotWidth()
+    today = utils.today()
+
+    bookQuery = Book.select(Book.sid, Book.fromts, Book.tots) \
+                    .where(Book.tots > today) \
+                    .tuples()
+
+    with DB.atomic():
+
+        SeatOccupancy.delete().execute()
+
+        bitmaps = _bookingsBitmaps(bookQuery.iterator(), slot)
+        bitmaps = { k: v for k,v in bitmaps.items() if k[1] >= today }
+
+        _insertBitmaps(bitmaps, slot)
+
+    return len(bitmaps)
+
+
+def getBitmaps(sidsQuery, fromTS, toTS):
+    """ Returns { sid: { day: bitmap } } of the seats (query or list of sids) in the time range """
+
+    query = SeatOccupancy.select(SeatOccupancy.sid, SeatOccupancy.day, SeatOccupancy.slots) \
+                         .where(SeatOccupancy.sid.in_(sidsQuery)) \
+                         .where( (SeatOccupancy.day < toTS) & (SeatOccupancy.day > fromTS - DAY) ) \
+                         .tuples()
+
+    res = {}
+    for sid,day,slots in query.iterator():
+        res.setdefault(sid, {})[day] = int.from_bytes(slots, 'little')
+
+    return res
+
+
+def _bookedSids(sidsQuery, ranges):
+    """ Returns set of sids booked in any of the ranges, checked directly in book table """
+
+    overlaps = [ (Book.fromts < t) & (Book.tots > f) for f,t in ranges ]
+    cond = overlaps[0]
+    for o in overlaps[1:]:
+        cond = cond | o
+
+    bookQuery = Book.select(Book.sid).distinct() \
+                    .where(Book.sid.in_(sidsQuery)) \
+                    .where(cond) \
+                    .tuples()
+
+    return { i[0] for i in bookQuery.iterator() }
+
+
+def getBusySids(sidsQuery, ranges):
+    """ Returns set of sids (from query or list of sids) booked in any of the ranges (fromTS, toTS) """
+
+    slot = slotWidth()
+    today = utils.today()
+
+    busy = set()
+
+    # there are no bitmaps for the past days
+    pastRanges = [ (f, min(t, today)) for f,t in ranges if f < today ]
+    if pastRanges:
+        busy = _bookedSids(sidsQuery, pastRanges)
+
+    ranges = [ (max(f, today), t) for f,t in ranges if t > today ]
+    if not ranges:
+        return busy
+
+    masks = {}
+    for fromTS,toTS in ranges:
+        for day,(touched,covered) in rangeMasks(fromTS, toTS, slot).items():
+            t,c = masks.get(day, (0, 0))
+            masks[day] = (t | touched, c | covered)
+
+    fromTS = min( r[0] for r in ranges )
+    toTS = max( r[1] for r in ranges )
+
+    uncertain = set()
+
+    for sid,bitmaps in getBitmaps(sidsQuery, fromTS, toTS).items():
+        for day,bitmap in bitmaps.items():
+
+            touched,covered = masks.get(day, (0, 0))
+
+            if bitmap & covered:
+                busy.add(sid)
+                break
+            elif bitmap & touched:
+                uncertain.add(sid)
+
+    uncertain -= busy
+
+    if uncertain:
+        busy.update(_bookedSids(list(uncertain), ranges))
+
+    return busy
+
+
+@click.command('rebuild-occupancy')
+@with_appcontext
+def rebuildOccupancyCommand():
+    """ Rebuilds seat occupancy bitmaps from bookings """
+
+    count = rebuildOccupancy()
+    click.echo(f"Rebuilt {count} seat occupancy bitmaps.")
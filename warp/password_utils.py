@@ -0,0 +1,163 @@
+import flask
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import check_password_hash, generate_password_hash
+
+logger = logging.getLogger(__name__)
+
+# Password hashing (scrypt by default) takes ~100ms of CPU and holds the GIL, so it is done
+# in a small pool of processes (PASSWORD_HASH_WORKERS per uwsgi worker, created on the first use),
+# the request thread only waits for the result.
+#
+# Admission control: at most PASSWORD_HASH_QUEUE_SIZE hashes can be pending in each worker,
+# further requests are rejected immediately with PasswordHashBusy (instead of piling up
+# and blocking all the threads). The counters of the pool, including the queue depth, are logged
+# by each worker every PASSWORD_HASH_METRICS_INTERVAL seconds (on the next hash after it elapsed).
+#
+# If PASSWORD_HASH_METHOD is set, hashes created with other parameters are replaced on the next
+# successful login (see needsRehash), so the cost can be tuned at any time.
+
+class PasswordHashBusy(Exception):
+    pass
+
+
+class _HashPool:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+        self.pending = 0
+        self.nextMetrics = None
+        self.stats = { "submitted": 0, "rejected": 0, "timeouts": 0, "broken": 0, "maxPending": 0, "totalMs": 0.0 }
+
+    def _executor(self, workers):
+
+        # uwsgi forks the workers after the app is loaded, the pool must not be shared
+        if self.executor is None or self.pid != os.getpid():
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+            self.pid = os.getpid()
+
+        return self.executor
+
+    def _dropExecutor(self, executor):
+        """ Forgets the executor after one of its processes died (e.g. killed by OOM killer), """
+        """ the next hash creates a new one """
+
+        with self.lock:
+            self.stats["broken"] += 1
+            if self.executor is executor:
+                self.executor = None
+
+        logger.error("Password hashing process died, the pool will be recreated")
+        executor.shutdown(wait=False)
+
+    def _done(self, _future = None):
+
+        with self.lock:
+            self.pending -= 1
+
+    def _logMetrics(self, interval):
+
+        now = time.monotonic()
+
+        with self.lock:
+            if interval <= 0:
+                return
+            if self.nextMetrics is None or now < self.nextMetrics:
+                # the first period starts with the first hash
+                self.nextMetrics = self.nextMetrics or now + interval
+                return
+            self.nextMetrics = now + interval
+
+        logger.info(f"Password hashing metrics: {self.metrics()}")
+
+    def run(self, fn, *args):
+
+        config = flask.current_app.config
+        workers = config['PASSWORD_HASH_WORKERS']
+
+        self._logMetrics(config['PASSWORD_HASH_METRICS_INTERVAL'])
+
+        with self.lock:
+
+            if self.pending >= config['PASSWORD_HASH_QUEUE_SIZE']:
+                self.stats["rejected"] += 1
+                logger.warning(f"Password hashing rejected, {self.pending} pending")
+                raise PasswordHashBusy()
+
+            self.pending += 1
+            self.stats["submitted"] += 1
+            self.stats["maxPending"] = max(self.stats["maxPending"], self.pending)
+
+            executor = self._executor(workers) if workers > 0 else None
+
+        t = time.perf_counter()
+
+        if executor is None:
+            try:
+                return fn(*args)
+            finally:
+                self._done()
+                self._addTime(t)
+
+        # the slot is released when the hash is really done, not when we stop waiting
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._done()
+            self._dropExecutor(executor)
+            raise PasswordHashBusy()
+
+        future.add_done_callback(self._done)
+
+        try:
+            return future.result(timeout=config['PASSWORD_HASH_TIMEOUT'])
+        except TimeoutError:
+            with self.lock:
+                self.stats["timeouts"] += 1
+            raise PasswordHashBusy()
+        except BrokenProcessPool:
+            self._dropExecutor(executor)
+            raise PasswordHashBusy()
+        finally:
+            self._addTime(t)
+
+    def _addTime(self, t):
+
+        with self.lock:
+            self.stats["totalMs"] += (time.perf_counter() - t) * 1000
+
+    def metrics(self):
+        """ Returns counters of the hashing in the current worker (pending is the current queue depth) """
+
+        with self.lock:
+            return { "pending": self.pending, **self.stats }
+
+_pool = _HashPool()
+
+
+def checkPassword(pwhash, password):
+    """ Returns True if the password matches pwhash, raises PasswordHashBusy if the pool is full """
+
+    return _pool.run(check_password_hash, pwhash, password)
+
+def hashPassword(password):
+    """ Returns hash of the password created with PASSWORD_HASH_METHOD, raises PasswordHashBusy if the pool is full """
+
+    method = flask.current_app.config['PASSWORD_HASH_METHOD']
+    if method is None:
+        return _pool.run(generate_password_hash, password)
+
+    return _pool.run(generate_password_hash, password, method)
+
+def needsRehash(pwhash):
+    """ Returns True if pwhash was not created with PASSWORD_HASH_METHOD """
+
+    method = flask.current_app.config['PASSWORD_HASH_METHOD']
+
+    return method is not None and pwhash.split('$', 1)[0] != method
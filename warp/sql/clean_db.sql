@@ -1,18 +1,36 @@
-DROP MATERIALIZED VIEW IF EXISTS user_to_zone_roles;
+-- user_to_zone_roles was a materialized view in older versions
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_matviews WHERE matviewname = 'user_to_zone_roles') THEN
+        DROP MATERIALIZED VIEW user_to_zone_roles;
+    END IF;
+END
+$$;
+DROP TABLE IF EXISTS user_to_zone_roles;
+DROP TABLE IF EXISTS zone_change;
+DROP TABLE IF EXISTS generation;
+DROP TABLE IF EXISTS seat_occupancy;
 DROP TABLE IF EXISTS seat_assign;
 DROP TABLE IF EXISTS book;
 DROP TABLE IF EXISTS seat;
 DROP TABLE IF EXISTS zone_assign;
 DROP TABLE IF EXISTS zone;
+DROP TABLE IF EXISTS group_closure;
 DROP TABLE IF EXISTS groups;
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS blobs;
 
 DROP TRIGGER IF EXISTS zone_assign_update on zone_assign;
 DROP TRIGGER IF EXISTS groups_update on groups;
+DROP TRIGGER IF EXISTS group_closure_update on group_closure;
 DROP TRIGGER IF EXISTS book_overlap_insert_trig on book;
 
 DROP FUNCTION IF EXISTS update_user_to_zone_roles;
+DROP FUNCTION IF EXISTS zone_assign_roles;
+DROP FUNCTION IF EXISTS group_closure_roles;
+DROP FUNCTION IF EXISTS users_roles;
+DROP FUNCTION IF EXISTS recompute_user_to_zone_roles;
 DROP FUNCTION IF EXISTS book_overlap_insert;
+DROP FUNCTION IF EXISTS bump_users_generation;
 
 DROP TABLE IF EXISTS db_initialized;
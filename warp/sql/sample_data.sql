@@ -18,6 +18,9 @@ INSERT INTO users VALUES ('group_parking',NULL,'Group Parking',100);
 INSERT INTO groups VALUES ('group_1b','user1');
 INSERT INTO groups VALUES ('group_1a','user2');
 
+-- there are no nested groups here, so the closure is just the direct membership
+INSERT INTO group_closure SELECT "group",login,1 FROM groups;
+
 INSERT INTO zone_assign VALUES (1,'user1',10);
 INSERT INTO zone_assign VALUES (1,'group_1a',20);
 INSERT INTO zone_assign VALUES (2,'group_1b',20);
@@ -2,7 +2,8 @@ CREATE TABLE blobs (
     id INTEGER PRIMARY KEY AUTOINCREMENT AS ROWID,
     mimetype TEXT NOT NULL,
     data BLOB NOT NULL,
-    etag INTEGER NOT NULL
+    etag INTEGER NOT NULL,
+    sha256 TEXT
 );
 
 CREATE TABLE users (
@@ -25,6 +26,21 @@ CREATE TABLE groups (
     FOREIGN KEY (login) REFERENCES users(login) ON DELETE CASCADE
 );
 
+CREATE INDEX groups_login ON groups(login);
+
+-- transitive closure of groups (see group_closure.py), maintained by the application
+-- depth is 1 for direct membership, otherwise the length of the shortest path
+CREATE TABLE group_closure (
+    ancestor TEXT NOT NULL,
+    member TEXT NOT NULL,
+    depth INTEGER NOT NULL,
+    PRIMARY KEY (ancestor, member),
+    FOREIGN KEY (ancestor) REFERENCES users(login) ON DELETE CASCADE,
+    FOREIGN KEY (member) REFERENCES users(login) ON DELETE CASCADE
+);
+
+CREATE INDEX group_closure_member ON group_closure(member);
+
 CREATE TABLE zone (
     id INTEGER PRIMARY KEY AUTOINCREMENT AS ROWID,
     zone_group INTEGER NOT NULL,
@@ -42,6 +58,8 @@ CREATE TABLE zone_assign (
     FOREIGN KEY (login) REFERENCES users(login) ON DELETE CASCADE
 );
 
+CREATE INDEX zone_assign_login ON zone_assign(login);
+
 CREATE TABLE seat (
     id INTEGER PRIMARY KEY AUTOINCREMENT AS ROWID,
     zid INTEGER NOT NULL,
@@ -76,24 +94,243 @@ CREATE INDEX book_login ON book(login);
 CREATE INDEX book_sid ON book(sid);
 CREATE INDEX book_fromTS ON book(fromts);
 CREATE INDEX book_toTS ON book(tots);
+-- covers the bookings part of zone/getSeats (no lookups into book table)
+CREATE INDEX book_sid_toTS ON book(sid, tots, fromts, login);
+
+-- occupancy bitmaps of seats per day (see occupancy.py), day is the midnight timestamp
+-- bit i of slots is set if any booking overlaps i-th OCCUPANCY_SLOT of the day
+CREATE TABLE seat_occupancy (
+    sid INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    slots BLOB NOT NULL,
+    PRIMARY KEY (sid, day),
+    FOREIGN KEY (sid) REFERENCES seat(id) ON DELETE CASCADE
+);
+
+CREATE INDEX seat_occupancy_day ON seat_occupancy(day);
+
+-- log of changes visible in zone/getSeats, id of the newest entry is the zone version
+-- sid is NULL when the whole zone has to be reloaded (layout or role changes)
+-- kind is one of: book, enable, disable, assign, zone
+CREATE TABLE zone_change (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    zid INTEGER NOT NULL,
+    sid INTEGER,
+    kind TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    FOREIGN KEY (zid) REFERENCES zone(id) ON DELETE CASCADE
+);
+
+CREATE INDEX zone_change_zid ON zone_change(zid, id);
+CREATE INDEX zone_change_ts ON zone_change(ts);
+
+-- generation counters, bumped by triggers on every change of the data, so caches and
+-- ETags (in all workers) can cheaply check whether the data has changed
+--   users - users (names and account types), groups, zone roles and zones
+CREATE TABLE generation (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+INSERT INTO generation VALUES ('users', 0);
+
+CREATE TRIGGER users_generation_update AFTER UPDATE OF name, account_type ON users
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+CREATE TRIGGER users_generation_delete AFTER DELETE ON users
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+CREATE TRIGGER groups_generation_insert AFTER INSERT ON groups
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+CREATE TRIGGER groups_generation_update AFTER UPDATE ON groups
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+CREATE TRIGGER groups_generation_delete AFTER DELETE ON groups
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+-- group_closure changes with groups, except when it is rebuilt
+CREATE TRIGGER group_closure_generation_insert AFTER INSERT ON group_closure
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
 
--- Replace materialized view with a regular view for SQLite
-CREATE VIEW user_to_zone_roles AS
-    WITH RECURSIVE zone_assign_expanded(login, zid, zone_role, account_type, depth) AS (
-        SELECT za.login, za.zid, za.zone_role, u.account_type, 0 
+CREATE TRIGGER group_closure_generation_delete AFTER DELETE ON group_closure
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+CREATE TRIGGER zone_assign_generation_insert AFTER INSERT ON zone_assign
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+CREATE TRIGGER zone_assign_generation_update AFTER UPDATE ON zone_assign
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+CREATE TRIGGER zone_assign_generation_delete AFTER DELETE ON zone_assign
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+CREATE TRIGGER zone_generation_update AFTER UPDATE OF name, zone_group ON zone
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+CREATE TRIGGER zone_generation_delete AFTER DELETE ON zone
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+-- user_to_zone_roles is a table maintained by the triggers below (on PostgreSQL by statement
+-- triggers doing the same), it contains the resolved (via nested groups) zone roles of users
+--
+-- nested groups are taken from group_closure, so each trigger is a flat join recomputing
+-- only the rows of the affected logins (the changed login and all its members)
+-- and of the affected zones (the changed zone, or zones of the ancestor for group_closure)
+-- rows of deleted users and zones are removed by the foreign keys
+CREATE TABLE user_to_zone_roles (
+    login TEXT NOT NULL,
+    zid INTEGER NOT NULL,
+    zone_role INTEGER NOT NULL,
+    PRIMARY KEY (login, zid),
+    FOREIGN KEY (login) REFERENCES users(login) ON DELETE CASCADE,
+    FOREIGN KEY (zid) REFERENCES zone(id) ON DELETE CASCADE
+);
+
+CREATE INDEX user_to_zone_roles_zid ON user_to_zone_roles(zid);
+
+CREATE TRIGGER zone_assign_roles_insert AFTER INSERT ON zone_assign
+BEGIN
+    DELETE FROM user_to_zone_roles
+    WHERE login IN (
+            SELECT NEW.login UNION SELECT member FROM group_closure WHERE ancestor = NEW.login)
+      AND zid = NEW.zid;
+    INSERT INTO user_to_zone_roles (login, zid, zone_role)
+    SELECT r.login, r.zid, MIN(r.zone_role) FROM (
+        SELECT za.login, za.zid, za.zone_role
+        FROM zone_assign za
+        WHERE za.login IN (
+            SELECT NEW.login UNION SELECT member FROM group_closure WHERE ancestor = NEW.login)
+          AND za.zid = NEW.zid
+        UNION ALL
+        SELECT gc.member, za.zid, za.zone_role
+        FROM group_closure gc
+        JOIN zone_assign za ON za.login = gc.ancestor
+        WHERE gc.member IN (
+            SELECT NEW.login UNION SELECT member FROM group_closure WHERE ancestor = NEW.login)
+          AND za.zid = NEW.zid
+    ) r
+    JOIN users u ON u.login = r.login
+    JOIN zone z ON z.id = r.zid
+    WHERE u.account_type < 100
+    GROUP BY r.login, r.zid;
+END;
+
+CREATE TRIGGER zone_assign_roles_update AFTER UPDATE ON zone_assign
+BEGIN
+    DELETE FROM user_to_zone_roles
+    WHERE login IN (
+            SELECT OLD.login UNION SELECT member FROM group_closure WHERE ancestor = OLD.login
+            UNION
+            SELECT NEW.login UNION SELECT member FROM group_closure WHERE ancestor = NEW.login)
+      AND zid IN (OLD.zid, NEW.zid);
+    INSERT INTO user_to_zone_roles (login, zid, zone_role)
+    SELECT r.login, r.zid, MIN(r.zone_role) FROM (
+        SELECT za.login, za.zid, za.zone_role
         FROM zone_assign za
-        JOIN users u ON za.login = u.login
+        WHERE za.login IN (
+            SELECT OLD.login UNION SELECT member FROM group_closure WHERE ancestor = OLD.login
+            UNION
+            SELECT NEW.login UNION SELECT member FROM group_closure WHERE ancestor = NEW.login)
+          AND za.zid IN (OLD.zid, NEW.zid)
         UNION ALL
-        SELECT g.login, za.zid, za.zone_role, u.account_type, za.depth + 1
-        FROM zone_assign_expanded za
-        JOIN groups g ON g."group" = za.login
-        JOIN users u ON g.login = u.login
-        WHERE za.depth < 100  -- Prevent infinite recursion
-    )
-    SELECT login, zid, MIN(zone_role) as zone_role
-    FROM zone_assign_expanded
-    WHERE account_type < 100
-    GROUP BY zid, login;
+        SELECT gc.member, za.zid, za.zone_role
+        FROM group_closure gc
+        JOIN zone_assign za ON za.login = gc.ancestor
+        WHERE gc.member IN (
+            SELECT OLD.login UNION SELECT member FROM group_closure WHERE ancestor = OLD.login
+            UNION
+            SELECT NEW.login UNION SELECT member FROM group_closure WHERE ancestor = NEW.login)
+          AND za.zid IN (OLD.zid, NEW.zid)
+    ) r
+    JOIN users u ON u.login = r.login
+    JOIN zone z ON z.id = r.zid
+    WHERE u.account_type < 100
+    GROUP BY r.login, r.zid;
+END;
+
+CREATE TRIGGER zone_assign_roles_delete AFTER DELETE ON zone_assign
+BEGIN
+    DELETE FROM user_to_zone_roles
+    WHERE login IN (
+            SELECT OLD.login UNION SELECT member FROM group_closure WHERE ancestor = OLD.login)
+      AND zid = OLD.zid;
+    INSERT INTO user_to_zone_roles (login, zid, zone_role)
+    SELECT r.login, r.zid, MIN(r.zone_role) FROM (
+        SELECT za.login, za.zid, za.zone_role
+        FROM zone_assign za
+        WHERE za.login IN (
+            SELECT OLD.login UNION SELECT member FROM group_closure WHERE ancestor = OLD.login)
+          AND za.zid = OLD.zid
+        UNION ALL
+        SELECT gc.member, za.zid, za.zone_role
+        FROM group_closure gc
+        JOIN zone_assign za ON za.login = gc.ancestor
+        WHERE gc.member IN (
+            SELECT OLD.login UNION SELECT member FROM group_closure WHERE ancestor = OLD.login)
+          AND za.zid = OLD.zid
+    ) r
+    JOIN users u ON u.login = r.login
+    JOIN zone z ON z.id = r.zid
+    WHERE u.account_type < 100
+    GROUP BY r.login, r.zid;
+END;
+
+CREATE TRIGGER group_closure_roles_insert AFTER INSERT ON group_closure
+BEGIN
+    INSERT INTO user_to_zone_roles (login, zid, zone_role)
+    SELECT u.login, za.zid, za.zone_role
+    FROM zone_assign za
+    JOIN users u ON u.login = NEW.member
+    WHERE za.login = NEW.ancestor
+      AND u.account_type < 100
+    ON CONFLICT (login, zid) DO UPDATE SET zone_role = MIN(zone_role, excluded.zone_role);
+END;
+
+CREATE TRIGGER group_closure_roles_delete AFTER DELETE ON group_closure
+BEGIN
+    DELETE FROM user_to_zone_roles
+    WHERE login = OLD.member
+      AND zid IN (SELECT zid FROM zone_assign WHERE login = OLD.ancestor);
+    INSERT INTO user_to_zone_roles (login, zid, zone_role)
+    SELECT r.login, r.zid, MIN(r.zone_role) FROM (
+        SELECT za.login, za.zid, za.zone_role
+        FROM zone_assign za
+        WHERE za.login = OLD.member
+        UNION ALL
+        SELECT gc.member, za.zid, za.zone_role
+        FROM group_closure gc
+        JOIN zone_assign za ON za.login = gc.ancestor
+        WHERE gc.member = OLD.member
+    ) r
+    JOIN users u ON u.login = r.login
+    JOIN zone z ON z.id = r.zid
+    WHERE u.account_type < 100
+      AND r.zid IN (SELECT zid FROM zone_assign WHERE login = OLD.ancestor)
+    GROUP BY r.login, r.zid;
+END;
+
+-- account type is checked only for the login itself, not for its members
+CREATE TRIGGER users_roles_update AFTER UPDATE OF account_type ON users
+BEGIN
+    DELETE FROM user_to_zone_roles
+    WHERE login = NEW.login;
+    INSERT INTO user_to_zone_roles (login, zid, zone_role)
+    SELECT r.login, r.zid, MIN(r.zone_role) FROM (
+        SELECT za.login, za.zid, za.zone_role
+        FROM zone_assign za
+        WHERE za.login = NEW.login
+        UNION ALL
+        SELECT gc.member, za.zid, za.zone_role
+        FROM group_closure gc
+        JOIN zone_assign za ON za.login = gc.ancestor
+        WHERE gc.member = NEW.login
+    ) r
+    JOIN users u ON u.login = r.login
+    JOIN zone z ON z.id = r.zid
+    WHERE u.account_type < 100
+    GROUP BY r.login, r.zid;
+END;
 
 -- Replace PostgreSQL trigger with SQLite trigger for booking validation
 CREATE TRIGGER book_overlap_insert_check
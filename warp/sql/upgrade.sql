@@ -0,0 +1,273 @@
+-- Upgrades a database created with an older sqlite_schema.sql to the current one, it can be run
+-- repeatedly, all the objects are created only if they don't exist (triggers are replaced). It is run by: flask upgrade-db (see upgrade.py), which also drops
+-- the old user_to_zone_roles view and rebuilds group_closure and seat_occupancy.
+
+CREATE INDEX IF NOT EXISTS groups_login ON groups(login);
+
+CREATE TABLE IF NOT EXISTS group_closure (
+    ancestor TEXT NOT NULL,
+    member TEXT NOT NULL,
+    depth INTEGER NOT NULL,
+    PRIMARY KEY (ancestor, member),
+    FOREIGN KEY (ancestor) REFERENCES users(login) ON DELETE CASCADE,
+    FOREIGN KEY (member) REFERENCES users(login) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS group_closure_member ON group_closure(member);
+
+CREATE INDEX IF NOT EXISTS zone_assign_login ON zone_assign(login);
+
+CREATE INDEX IF NOT EXISTS book_sid_toTS ON book(sid, tots, fromts, login);
+
+CREATE TABLE IF NOT EXISTS seat_occupancy (
+    sid INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    slots BLOB NOT NULL,
+    PRIMARY KEY (sid, day),
+    FOREIGN KEY (sid) REFERENCES seat(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS seat_occupancy_day ON seat_occupancy(day);
+
+CREATE TABLE IF NOT EXISTS zone_change (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    zid INTEGER NOT NULL,
+    sid INTEGER,
+    kind TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    FOREIGN KEY (zid) REFERENCES zone(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS zone_change_zid ON zone_change(zid, id);
+
+CREATE INDEX IF NOT EXISTS zone_change_ts ON zone_change(ts);
+
+CREATE TABLE IF NOT EXISTS generation (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+INSERT OR IGNORE INTO generation VALUES ('users', 0);
+
+DROP TRIGGER IF EXISTS users_generation_update;
+CREATE TRIGGER users_generation_update AFTER UPDATE OF name, account_type ON users
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+DROP TRIGGER IF EXISTS users_generation_delete;
+CREATE TRIGGER users_generation_delete AFTER DELETE ON users
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+DROP TRIGGER IF EXISTS groups_generation_insert;
+CREATE TRIGGER groups_generation_insert AFTER INSERT ON groups
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+DROP TRIGGER IF EXISTS groups_generation_update;
+CREATE TRIGGER groups_generation_update AFTER UPDATE ON groups
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+DROP TRIGGER IF EXISTS groups_generation_delete;
+CREATE TRIGGER groups_generation_delete AFTER DELETE ON groups
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+DROP TRIGGER IF EXISTS group_closure_generation_insert;
+CREATE TRIGGER group_closure_generation_insert AFTER INSERT ON group_closure
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+DROP TRIGGER IF EXISTS group_closure_generation_delete;
+CREATE TRIGGER group_closure_generation_delete AFTER DELETE ON group_closure
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+DROP TRIGGER IF EXISTS zone_assign_generation_insert;
+CREATE TRIGGER zone_assign_generation_insert AFTER INSERT ON zone_assign
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+DROP TRIGGER IF EXISTS zone_assign_generation_update;
+CREATE TRIGGER zone_assign_generation_update AFTER UPDATE ON zone_assign
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+DROP TRIGGER IF EXISTS zone_assign_generation_delete;
+CREATE TRIGGER zone_assign_generation_delete AFTER DELETE ON zone_assign
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+DROP TRIGGER IF EXISTS zone_generation_update;
+CREATE TRIGGER zone_generation_update AFTER UPDATE OF name, zone_group ON zone
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+DROP TRIGGER IF EXISTS zone_generation_delete;
+CREATE TRIGGER zone_generation_delete AFTER DELETE ON zone
+BEGIN UPDATE generation SET value = value + 1 WHERE name = 'users'; END;
+
+CREATE TABLE IF NOT EXISTS user_to_zone_roles (
+    login TEXT NOT NULL,
+    zid INTEGER NOT NULL,
+    zone_role INTEGER NOT NULL,
+    PRIMARY KEY (login, zid),
+    FOREIGN KEY (login) REFERENCES users(login) ON DELETE CASCADE,
+    FOREIGN KEY (zid) REFERENCES zone(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS user_to_zone_roles_zid ON user_to_zone_roles(zid);
+
+DROP TRIGGER IF EXISTS zone_assign_roles_insert;
+CREATE TRIGGER zone_assign_roles_insert AFTER INSERT ON zone_assign
+BEGIN
+    DELETE FROM user_to_zone_roles
+    WHERE login IN (
+            SELECT NEW.login UNION SELECT member FROM group_closure WHERE ancestor = NEW.login)
+      AND zid = NEW.zid;
+    INSERT INTO user_to_zone_roles (login, zid, zone_role)
+    SELECT r.login, r.zid, MIN(r.zone_role) FROM (
+        SELECT za.login, za.zid, za.zone_role
+        FROM zone_assign za
+        WHERE za.login IN (
+            SELECT NEW.login UNION SELECT member FROM group_closure WHERE ancestor = NEW.login)
+          AND za.zid = NEW.zid
+        UNION ALL
+        SELECT gc.member, za.zid, za.zone_role
+        FROM group_closure gc
+        JOIN zone_assign za ON za.login = gc.ancestor
+        WHERE gc.member IN (
+            SELECT NEW.login UNION SELECT member FROM group_closure WHERE ancestor = NEW.login)
+          AND za.zid = NEW.zid
+    ) r
+    JOIN users u ON u.login = r.login
+    JOIN zone z ON z.id = r.zid
+    WHERE u.account_type < 100
+    GROUP BY r.login, r.zid;
+END;
+
+DROP TRIGGER IF EXISTS zone_assign_roles_update;
+CREATE TRIGGER zone_assign_roles_update AFTER UPDATE ON zone_assign
+BEGIN
+    DELETE FROM user_to_zone_roles
+    WHERE login IN (
+            SELECT OLD.login UNION SELECT member FROM group_closure WHERE ancestor = OLD.login
+            UNION
+            SELECT NEW.login UNION SELECT member FROM group_closure WHERE ancestor = NEW.login)
+      AND zid IN (OLD.zid, NEW.zid);
+    INSERT INTO user_to_zone_roles (login, zid, zone_role)
+    SELECT r.login, r.zid, MIN(r.zone_role) FROM (
+        SELECT za.login, za.zid, za.zone_role
+        FROM zone_assign za
+        WHERE za.login IN (
+            SELECT OLD.login UNION SELECT member FROM group_closure WHERE ancestor = OLD.login
+            UNION
+            SELECT NEW.login UNION SELECT member FROM group_closure WHERE ancestor = NEW.login)
+          AND za.zid IN (OLD.zid, NEW.zid)
+        UNION ALL
+        SELECT gc.member, za.zid, za.zone_role
+        FROM group_closure gc
+        JOIN zone_assign za ON za.login = gc.ancestor
+        WHERE gc.member IN (
+            SELECT OLD.login UNION SELECT member FROM group_closure WHERE ancestor = OLD.login
+            UNION
+            SELECT NEW.login UNION SELECT member FROM group_closure WHERE ancestor = NEW.login)
+          AND za.zid IN (OLD.zid, NEW.zid)
+    ) r
+    JOIN users u ON u.login = r.login
+    JOIN zone z ON z.id = r.zid
+    WHERE u.account_type < 100
+    GROUP BY r.login, r.zid;
+END;
+
+DROP TRIGGER IF EXISTS zone_assign_roles_delete;
+CREATE TRIGGER zone_assign_roles_delete AFTER DELETE ON zone_assign
+BEGIN
+    DELETE FROM user_to_zone_roles
+    WHERE login IN (
+            SELECT OLD.login UNION SELECT member FROM group_closure WHERE ancestor = OLD.login)
+      AND zid = OLD.zid;
+    INSERT INTO user_to_zone_roles (login, zid, zone_role)
+    SELECT r.login, r.zid, MIN(r.zone_role) FROM (
+        SELECT za.login, za.zid, za.zone_role
+        FROM zone_assign za
+        WHERE za.login IN (
+            SELECT OLD.login UNION SELECT member FROM group_closure WHERE ancestor = OLD.login)
+          AND za.zid = OLD.zid
+        UNION ALL
+        SELECT gc.member, za.zid, za.zone_role
+        FROM group_closure gc
+        JOIN zone_assign za ON za.login = gc.ancestor
+        WHERE gc.member IN (
+            SELECT OLD.login UNION SELECT member FROM group_closure WHERE ancestor = OLD.login)
+          AND za.zid = OLD.zid
+    ) r
+    JOIN users u ON u.login = r.login
+    JOIN zone z ON z.id = r.zid
+    WHERE u.account_type < 100
+    GROUP BY r.login, r.zid;
+END;
+
+DROP TRIGGER IF EXISTS group_closure_roles_insert;
+CREATE TRIGGER group_closure_roles_insert AFTER INSERT ON group_closure
+BEGIN
+    INSERT INTO user_to_zone_roles (login, zid, zone_role)
+    SELECT u.login, za.zid, za.zone_role
+    FROM zone_assign za
+    JOIN users u ON u.login = NEW.member
+    WHERE za.login = NEW.ancestor
+      AND u.account_type < 100
+    ON CONFLICT (login, zid) DO UPDATE SET zone_role = MIN(zone_role, excluded.zone_role);
+END;
+
+DROP TRIGGER IF EXISTS group_closure_roles_delete;
+CREATE TRIGGER group_closure_roles_delete AFTER DELETE ON group_closure
+BEGIN
+    DELETE FROM user_to_zone_roles
+    WHERE login = OLD.member
+      AND zid IN (SELECT zid FROM zone_assign WHERE login = OLD.ancestor);
+    INSERT INTO user_to_zone_roles (login, zid, zone_role)
+    SELECT r.login, r.zid, MIN(r.zone_role) FROM (
+        SELECT za.login, za.zid, za.zone_role
+        FROM zone_assign za
+        WHERE za.login = OLD.member
+        UNION ALL
+        SELECT gc.member, za.zid, za.zone_role
+        FROM group_closure gc
+        JOIN zone_assign za ON za.login = gc.ancestor
+        WHERE gc.member = OLD.member
+    ) r
+    JOIN users u ON u.login = r.login
+    JOIN zone z ON z.id = r.zid
+    WHERE u.account_type < 100
+      AND r.zid IN (SELECT zid FROM zone_assign WHERE login = OLD.ancestor)
+    GROUP BY r.login, r.zid;
+END;
+
+DROP TRIGGER IF EXISTS users_roles_update;
+CREATE TRIGGER users_roles_update AFTER UPDATE OF account_type ON users
+BEGIN
+    DELETE FROM user_to_zone_roles
+    WHERE login = NEW.login;
+    INSERT INTO user_to_zone_roles (login, zid, zone_role)
+    SELECT r.login, r.zid, MIN(r.zone_role) FROM (
+        SELECT za.login, za.zid, za.zone_role
+        FROM zone_assign za
+        WHERE za.login = NEW.login
+        UNION ALL
+        SELECT gc.member, za.zid, za.zone_role
+        FROM group_closure gc
+        JOIN zone_assign za ON za.login = gc.ancestor
+        WHERE gc.member = NEW.login
+    ) r
+    JOIN users u ON u.login = r.login
+    JOIN zone z ON z.id = r.zid
+    WHERE u.account_type < 100
+    GROUP BY r.login, r.zid;
+END;
+
+-- all the roles, from now on kept up to date by the triggers
+DELETE FROM user_to_zone_roles;
+INSERT INTO user_to_zone_roles (login, zid, zone_role)
+SELECT r.login, r.zid, MIN(r.zone_role) FROM (
+    SELECT za.login, za.zid, za.zone_role
+    FROM zone_assign za
+    UNION ALL
+    SELECT gc.member, za.zid, za.zone_role
+    FROM group_closure gc
+    JOIN zone_assign za ON za.login = gc.ancestor
+) r
+JOIN users u ON u.login = r.login
+JOIN zone z ON z.id = r.zid
+WHERE u.account_type < 100
+GROUP BY r.login, r.zid;
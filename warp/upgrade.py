@@ -0,0 +1,74 @@
+import click
+import os
+import peewee
+from flask.cli import with_appcontext
+
+from warp.db import *
+from warp import blob_storage
+from warp import group_closure
+from warp import occupancy
+
+# Upgrade of databases created with an older schema, run once after the update:
+#   flask upgrade-db
+#
+# The tables, indexes and triggers added since then are created by sql/upgrade.sql
+# (sql/upgrade.sql.postgres), which can be run repeatedly. The derived data, which was not
+# maintained before, is rebuilt here: group_closure (otherwise all zone roles inherited via
+# groups are missing), seat_occupancy and user_to_zone_roles (a view in older versions).
+# Blobs are left in the database, see flask migrate-blobs.
+
+def _isPostgres():
+
+    return isinstance(DB, peewee.PostgresqlDatabase)
+
+def _dropOldView():
+    """ Drops user_to_zone_roles if it is still a view, returns True if it was dropped """
+
+    if _isPostgres():
+        if DB.execute_sql("SELECT 1 FROM pg_matviews WHERE matviewname = 'user_to_zone_roles'").fetchone() is None:
+            return False
+        DB.execute_sql("DROP MATERIALIZED VIEW user_to_zone_roles")
+    else:
+        if DB.execute_sql("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = 'user_to_zone_roles'").fetchone() is None:
+            return False
+        DB.execute_sql("DROP VIEW user_to_zone_roles")
+
+    return True
+
+def _runScript(name):
+
+    with open(os.path.join(os.path.dirname(__file__), 'sql', name)) as f:
+        script = f.read()
+
+    if _isPostgres():
+        with DB.atomic():
+            DB.execute_sql(script)
+    else:
+        # executescript commits on its own
+        DB.connection().executescript(script)
+
+
+def upgradeDB():
+    """ Upgrades the database to the current schema, returns dict with what was done """
+
+    with DB.atomic():
+        droppedView = _dropOldView()
+        blob_storage.addHashColumn()
+
+    _runScript('upgrade.sql.postgres' if _isPostgres() else 'upgrade.sql')
+
+    return {
+        "droppedView": droppedView,
+        "closure": group_closure.rebuildClosure(),
+        "occupancy": occupancy.rebuildOccupancy()
+    }
+
+
+@click.command('upgrade-db')
+@with_appcontext
+def upgradeDBCommand():
+    """ Upgrades a database created with an older schema """
+
+    res = upgradeDB()
+    click.echo(f"Database upgraded{', user_to_zone_roles view replaced with a table' if res['droppedView'] else ''}, "
+               f"rebuilt group closure with {res['closure']} rows and {res['occupancy']} seat occupancy bitmaps.")
@@ -3,7 +3,14 @@ import flask
 from calendar import timegm
 from time import localtime,strftime,gmtime
 from jsonschema import validate, ValidationError
+from collections import OrderedDict
+from array import array
 import functools
+import hashlib
+import orjson
+import struct
+import sys
+import threading
 
 def now():
     """ Returns number of seconds since midnight 1970-1-1 in the current timezone until now"""
@@ -70,6 +77,37 @@ def getNextWeek():
 
     return res
 
+# format (see zone/apply)
+#   { "weekdays": mask, "fromTime": seconds, "toTime": seconds, "fromDate": ts, "toDate": ts }
+def expandRecurrence(recurrence):
+    """ Returns a list of { fromTS, toTS } of the series sorted on fromTS, or None if it is invalid """
+    """ dates are computed for each weekday with a 7 days step, not day by day """
+
+    DAY = 24*3600
+    WEEK = 7*DAY
+
+    fromDate = recurrence['fromDate']
+    toDate = recurrence['toDate']
+    fromTime = recurrence['fromTime']
+    toTime = recurrence['toTime']
+
+    if fromDate % DAY or toDate % DAY or fromDate > toDate or fromTime >= toTime \
+        or toDate - fromDate >= flask.current_app.config['RECURRENCE_MAX_DAYS'] * DAY:
+        return None
+
+    # 1970-01-01 was Thursday (weekday 4)
+    firstWeekday = (fromDate // DAY + 4) % 7
+
+    starts = []
+    for weekday in range(7):
+        if recurrence['weekdays'] & (1 << weekday):
+            first = fromDate + ((weekday - firstWeekday) % 7) * DAY
+            starts.extend(range(first + fromTime, toDate + fromTime + 1, WEEK))
+
+    starts.sort()
+
+    return [ { "fromTS": f, "toTS": f - fromTime + toTime } for f in starts ]
+
 def formatTimestamp(ts):
 
     t = gmtime(ts)
@@ -111,3 +149,102 @@ def validateJSONInput(jsonSchema, isAdmin = False):
         return wrapper
 
     return inner
+
+
+class LRUCache:
+    """ Bounded in-process cache, it is not shared between workers """
+    """ maxSizeConfig is the name of the config variable with the maximum number of entries """
+
+    def __init__(self, maxSizeConfig):
+        self.maxSizeConfig = maxSizeConfig
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default = None):
+
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+                return self.data[key]
+            except KeyError:
+                return default
+
+    def set(self, key, value):
+
+        maxSize = flask.current_app.config[self.maxSizeConfig]
+
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > maxSize:
+                self.data.popitem(last=False)
+
+    def invalidate(self, keyFilter = None):
+        """ Removes all entries or only these for which keyFilter(key) is true """
+
+        with self.lock:
+            if keyFilter is None:
+                self.data.clear()
+            else:
+                for k in [ k for k in self.data if keyFilter(k) ]:
+                    del self.data[k]
+
+
+# Compact columnar format, used instead of JSON when requested via Accept header
+# (see zone/getSeats and zones/getSeats), layout:
+#   uint32 (little endian)  - length of the header
+#   header                  - JSON object (string tables, counts, ...) padded with spaces to 4 bytes
+#   int32[] (little endian) - columns, one after another, their lengths are in the header
+COLUMNS_MIMETYPE = "application/vnd.warp.columns"
+
+def acceptsColumns():
+    """ Returns True if the client prefers the columnar format over JSON """
+
+    best = flask.request.accept_mimetypes.best_match(['application/json', COLUMNS_MIMETYPE])
+    return best == COLUMNS_MIMETYPE
+
+def int32Columns(*columns):
+    """ Returns columns (iterables of ints) packed one after another as little endian int32 """
+
+    res = array('i')
+    for c in columns:
+        res.extend(c)
+
+    if sys.byteorder != 'little':
+        res.byteswap()
+
+    return res.tobytes()
+
+def packColumns(header, columns):
+    """ Returns the response body in the columnar format, columns are from int32Columns """
+
+    header = orjson.dumps(header)
+    header += b' ' * (-len(header) % 4)
+
+    return struct.pack('<I', len(header)) + header + columns
+
+
+def makeETag(*parts):
+    """ Returns ETag derived from the parts (everything the response depends on) """
+
+    return hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=16).hexdigest()
+
+def setETag(response, etag):
+    """ Sets ETag of the response, browsers will revalidate it on each request """
+
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    response.cache_control.private = True
+
+    return response
+
+def notModifiedResponse(etag):
+    """ Returns 304 response if the request If-None-Match matches the etag, otherwise None """
+
+    r304 = setETag(flask.current_app.response_class(), etag)
+    r304.make_conditional(flask.request)
+
+    if r304.status_code == 304:
+        return r304
+
+    return None
@@ -8,16 +8,22 @@ from warp.db import (
 )
 from . import utils
 from . import blob_storage
+from . import zone_roles
 
 bp = flask.Blueprint('view', __name__)
 
-@bp.context_processor
-def headerDataInit():
+# header navigation (zones of the login and the links) of each login, cached in each worker,
+# entries are tagged with GENERATION_USERS which is bumped on changes of zone assignments
+# and zones (see zone_roles.py), the active item is marked in the template via headerActiveUrl
+_headerCache = utils.LRUCache('HEADER_CACHE_SIZE')
+
+def _headerData(login):
+
     headerDataL = []
 
     zoneCursor = db.session.query(Zone.id, Zone.name)\
         .join(ZoneAssign, Zone.id == ZoneAssign.zid)\
-        .filter(ZoneAssign.login == g.login)\
+        .filter(ZoneAssign.login == login)\
         .order_by(Zone.name)\
         .all()
 
@@ -35,19 +41,31 @@ def headerDataInit():
         {"text": "Zones", "endpoint": "view.zones", "view_args": {} }
     ]
 
-    #generate urls and selected
+    #generate urls
     for hdata in [headerDataL,headerDataR]:
-
         for h in hdata:
-
             h['url'] = flask.url_for(h['endpoint'],**h['view_args'])
-            a = flask.request.endpoint == h['endpoint']
-            b = flask.request.view_args == h['view_args']
-            h['active'] = flask.request.endpoint == h['endpoint'] and flask.request.view_args == h['view_args']
 
+    return headerDataL, headerDataR
+
+@bp.context_processor
+def headerDataInit():
+
+    gen = zone_roles.currentGeneration()
+
+    entry = _headerCache.get(g.login) if gen is not None else None
+    if entry is None or entry[0] != gen:
+        entry = (gen, *_headerData(g.login))
+        if gen is not None:
+            _headerCache.set(g.login, entry)
 
-    return { "headerDataL": headerDataL,
-             "headerDataR": headerDataR,
+    headerActiveUrl = None
+    if flask.request.endpoint is not None:
+        headerActiveUrl = flask.url_for(flask.request.endpoint, **flask.request.view_args)
+
+    return { "headerDataL": entry[1],
+             "headerDataR": entry[2],
+             "headerActiveUrl": headerActiveUrl,
              'hasLogout': 'auth.logout' in flask.current_app.view_functions
     }
 
@@ -69,9 +87,7 @@ def bookings(report):
 @bp.route("/zone/<zid>")
 def zone(zid):
 
-    zoneRole = db.session.query(ZoneAssign.zone_role)\
-        .filter(ZoneAssign.zid == zid, ZoneAssign.login == g.login)\
-        .scalar()
+    zoneRole = zone_roles.getZoneRole(zid, g.login)
 
     if zoneRole is None:
         flask.abort(403)
@@ -99,23 +115,48 @@ def zone(zid):
     return flask.render_template('zone.html',
         **zoneRole,
         zid = zid,
+        zoneImageURL = zoneImageURL(zid),
         nextWeek=nextWeek,
         defaultSelectedDates=defaultSelectedDates)
 
+def zoneImageURL(zid):
+    """ Returns URL of the zone map containing token of the image, so it can be cached forever """
+    """ (see zoneImageHashed), falls back to zoneImage if the zone has no image """
+
+    iid = db.session.query(Zone.iid).filter(Zone.id == zid).scalar()
+
+    token = blob_storage.getBlobToken(iid) if iid is not None else None
+    if token is None:
+        return flask.url_for('view.zoneImage', zid=zid)
+
+    return flask.url_for('view.zoneImageHashed', zid=zid, token=token)
+
+@bp.route("/zone/image/<zid>/<token>")
+def zoneImageHashed(zid, token):
+
+    # no session nor zone role check (see auth.check_session), the token (HMAC of the image hash)
+    # can be known only from a page the user had access to, even with the image itself it can't
+    # be forged, so the response can be cached by proxies (see res/nginx.conf)
+    iid = db.session.query(Zone.iid).filter(Zone.id == zid).scalar()
+    if iid is None:
+        flask.abort(404)
+
+    return blob_storage.createImmutableBlobResponse(token, blobId=iid)
+
 @bp.route("/zone/image/<zid>")
 def zoneImage(zid):
 
     if not flask.g.isAdmin:
 
-        zoneRole = db.session.query(ZoneAssign.zone_role)\
-            .filter(ZoneAssign.zid == zid, ZoneAssign.login == flask.g.login)\
-            .scalar()
+        zoneRole = zone_roles.getZoneRole(zid, flask.g.login)
         if zoneRole is None:
             flask.abort(403)
 
-    blobIdQuery = db.session.query(Zone.iid.label('id')).filter(Zone.id == zid)
+    iid = db.session.query(Zone.iid).filter(Zone.id == zid).scalar()
+    if iid is None:
+        flask.abort(404)
 
-    return blob_storage.createBlobResponse(blobIdQuery=blobIdQuery)
+    return blob_storage.createBlobResponse(blobId=iid)
 
 
 @bp.route("/users")
@@ -194,6 +235,7 @@ def zoneModify(zid):
 
     return flask.render_template('zone_modify.html',
                     zid = zid,
+                    zoneImageURL = zoneImageURL(zid),
                     returnURL = returnURL)
 
 @bp.route("/up")
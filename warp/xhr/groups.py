@@ -3,6 +3,7 @@ from jsonschema import validate, ValidationError
 
 from warp.db import *
 from warp import utils
+from warp import group_closure
 from warp.utils_tabulator import *
 
 bp = flask.Blueprint('groups', __name__, url_prefix='groups')
@@ -98,5 +99,7 @@ def assign():
             except IntegrityError as err:
                 return {"msg": "Error", "code": 213 }, 400
 
+        group_closure.refreshClosure(action_data.get('add',[]) + action_data.get('remove',[]))
+
     return {"msg": "ok" }, 200
 
@@ -3,7 +3,12 @@ from jsonschema import validate, ValidationError
 import orjson
 
 from warp.db import *
+from warp import auth
 from warp import utils
+from warp import group_closure
+from warp import password_utils
+from warp import occupancy
+from warp import zone_changes
 from warp.utils_tabulator import *
 
 bp = flask.Blueprint('users', __name__, url_prefix='users')
@@ -55,13 +60,19 @@ editSchema = {
 @utils.validateJSONInput(editSchema,isAdmin=True)
 def edit():
 
-    from werkzeug.security import generate_password_hash
-
     action_data = flask.request.get_json()
 
     class ApplyError(Exception):
         pass
 
+    # hash before the transaction is opened
+    passwordHash = None
+    if len(action_data.get('password','')) > 0 and action_data['account_type'] < ACCOUNT_TYPE_GROUP:
+        try:
+            passwordHash = password_utils.hashPassword(action_data['password'])
+        except password_utils.PasswordHashBusy:
+            return {"msg": "Server busy", "code": 157 }, 503
+
     try:
         with DB.atomic():
 
@@ -70,8 +81,8 @@ def edit():
                 Users.account_type: action_data['account_type'],
             }
 
-            if len(action_data.get('password','')) > 0 and action_data['account_type'] < ACCOUNT_TYPE_GROUP:
-                updColumns[Users.password] = generate_password_hash(action_data['password'])
+            if passwordHash is not None:
+                updColumns[Users.password] = passwordHash
 
             if action_data['action'] == "update":
 
@@ -111,6 +122,8 @@ def edit():
                         .on_conflict_ignore() \
                         .execute()
 
+                group_closure.refreshClosure([action_data['login']])
+
     except IntegrityError as err:
         if action_data['action'] == "add":
             return {"msg": "Login exits", "code": 155 }, 400
@@ -119,6 +132,8 @@ def edit():
     except ApplyError as err:
         return {"msg": "Error", "code": err.args[1] }, 400
 
+    auth.invalidateUserState(action_data['login'])
+
     return {"msg": "ok" }, 200
 
 
@@ -157,13 +172,34 @@ def delete():
     try:
         with DB.atomic():
 
+            # bookings and seat assignments are removed by cascade
+            bookSidsQ = Book.select(Book.sid).where(Book.login == login)
+            assignSidsQ = SeatAssign.select(SeatAssign.sid).where(SeatAssign.login == login)
+            zone_changes.logSeatsChange([ i[0] for i in bookSidsQ.union(assignSidsQ).tuples().iterator() ])
+
+            bookQ = Book.select(Book.sid, Book.fromts, Book.tots) \
+                        .where(Book.login == login) \
+                        .where(Book.tots > utils.today()) \
+                        .tuples()
+            removed = [ *bookQ.iterator() ]
+
+            # closure rows of the login are removed by cascade, but members of a group
+            # can be in other groups via it
+            membersQ = Groups.select(Groups.login).where(Groups.group == login).tuples()
+            members = [ i[0] for i in membersQ.iterator() ]
+
             # rowCount ?
             Users.delete().where(Users.login == login) \
                  .execute()
 
+            occupancy.refreshOccupancy(removed)
+            group_closure.refreshClosure(members)
+
     except IntegrityError:
         return {"msg": "Error", "code":  174}, 400
 
+    auth.invalidateUserState(login)
+
     return {"msg": "ok" }, 200
 
 
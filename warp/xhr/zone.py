@@ -1,11 +1,20 @@
-from collections import defaultdict
+import functools
 import flask
+import itertools
 from jsonschema import validate, ValidationError
+import operator
 import orjson
 import peewee
+from peewee import Case, JOIN, SQL, Value, fn
+import time
 
 from warp import auth
+from warp import booking_conflicts
+from warp import generation
+from warp import occupancy
 from warp import utils
+from warp import zone_changes
+from warp import zone_roles
 from warp.db import *
 
 bp = flask.Blueprint('zone', __name__, url_prefix='zone')
@@ -30,21 +39,57 @@ bp = flask.Blueprint('zone', __name__, url_prefix='zone')
 #          book: [
 #              { bid: 10, fromTS: 1, toTS: 2 }
 #
+#   version: 123                    # version of the zone data, can be passed as since
+#   delta: true                     # only if since was accepted
+#   removed: [ sidN, ... ]          # only in delta, seats of the current zone which are gone
+#
 #  note that book array is sorted on fromTS
 #
+#Format columns (if Accept: application/vnd.warp.columns, see utils.packColumns)
+#   header: {
+#       version, delta, removed     # the same as in JSON
+#       baseTS: 123                 # fromTS and toTS columns are relative to it
+#       zones: { zidN: "Zone name" }
+#       logins: [ login, ... ]      # login columns are indexes to logins (and userNames)
+#       userNames: [ name, ... ]
+#       seatNames: [ name, ... ]    # names of sidN... in the order of seat columns
+#       otherSeatNames: [ ... ]     # names of sidM... in the order of other seat columns
+#       counts: [ seats, assignments, bookings ]
+#       otherCounts: [ otherSeats, otherBookings ]
+#   columns:
+#       seats:          sid, zid, x, y, enabled
+#       assignments:    sid, login
+#       bookings:       sid, bid, fromTS, toTS, login   # sorted on fromTS
+#       otherSeats:     sid, zid
+#       otherBookings:  sid, bid, fromTS, toTS          # sorted on fromTS
+#
 # this route accepts the following optional arguments:
 #   login=string - sidM... will be for a given user (requires zoneAdmin)
 #   onlyOtherZone=0|1 - returns only zones, users for other zones (sidM...)
+#   since=version - returns only seats of the current zone changed after the version
+#                   (plus all sidM...), if the version is too old the full data is returned
+#   stream=0|1 - JSON is generated and sent in chunks while the rows are read, so memory
+#                doesn't grow with the zone size (always JSON, Accept is ignored, no cache)
+#
+# response has ETag, If-None-Match is answered with 304 before any seat data is read
 @bp.route("getSeats/<int:zid>")
 def getSeats(zid):
 
-    res = {
-        "seats": {}
-    }
+    argLogin = flask.request.args.get('login')
 
-    zoneRole = UserToZoneRoles.select(UserToZoneRoles.zone_role) \
-                              .where( (UserToZoneRoles.zid == zid) & (UserToZoneRoles.login == flask.g.login) ) \
-                              .scalar()
+    # versions for ETag in one query, roles of both the caller and the login (if given) are cached
+    usersGeneration, version, groupVersion = generation.generationQuery() \
+                                                       .select_extend(
+                                                            zone_changes.zoneVersionQuery(zid),
+                                                            zone_changes.zoneGroupVersionQuery(zid)) \
+                                                       .scalar(as_tuple = True) or (0, None, None)
+    version, groupVersion = version or 0, groupVersion or 0
+    zone_roles.currentGeneration(usersGeneration)
+
+    roles = zone_roles.getRoles([ (l, zid) for l in (flask.g.login, argLogin) if l is not None ])
+    roles = { l: r for (l,_),r in roles.items() }
+
+    zoneRole = roles.get(flask.g.login)
 
     if zoneRole is None:
         return {"msg": "Forbidden", "code": 130 }, 403
@@ -54,121 +99,636 @@ def getSeats(zid):
         if zoneRole > ZONE_ROLE_ADMIN:
             return {"msg": "Forbidden", "code": 131 }, 403
 
-        isLoginInZone = UserToZoneRoles.select(UserToZoneRoles.zone_role) \
-                              .where(UserToZoneRoles.zid == zid) \
-                              .where(UserToZoneRoles.login == flask.request.args.get('login') ) \
-                              .scalar()
-
-        if isLoginInZone is None:
+        if argLogin not in roles:
             return {"msg": "Forbidden", "code": 132 }, 403
 
     tr = utils.getTimeRange()
-    usedZones = set()
-    usedUsers = set()
+    login = flask.request.args.get('login',flask.g.login)
+    onlyOtherZone = flask.request.args.get('onlyOtherZone') in {'1','True','true'}
+    stream = flask.request.args.get('stream') in {'1','True','true'}
+    columns = not stream and utils.acceptsColumns()
+    encode = _zoneSeatsColumns if columns else _zoneSeatsJSON
+    res = {}
 
-    if flask.request.args.get('onlyOtherZone') not in {'1','True','true'}:
+    # versions are only valid for the current day (see zone_changes), fromTS is the day
+    etag = utils.makeETag(
+        'getSeats', zid, groupVersion, usersGeneration, tr['fromTS'], tr['toTS'], zoneRole, columns,
+        login, flask.request.args.get('onlyOtherZone'), flask.request.args.get('since'))
 
-        assignCursor = SeatAssign.select(SeatAssign.sid, Users.login) \
-                                .join(Users,on=(SeatAssign.login == Users.login)) \
-                                .join(Seat, on=(SeatAssign.sid == Seat.id)) \
-                                .where(Seat.zid == zid)
+    r304 = utils.notModifiedResponse(etag)
+    if r304 is not None:
+        r304.vary.add('Accept')
+        return r304
 
-        assignments = defaultdict(set)
-        for r in assignCursor:
-            assignments[r['sid']].add(r['login'])
-            usedUsers.add(r['login'])
+    if stream:
 
-        seatsCursor = Seat.select(Seat.id, Seat.name, Seat.x, Seat.y, Seat.zid, Seat.enabled) \
-                            .where(Seat.zid == zid)
+        sids = None
+        if not onlyOtherZone:
+            changes = zone_changes.getSeatsChangedSince(zid, flask.request.args.get('since', type=int))
+            if changes is not None:
+                res['version'], sids = changes
+                res['delta'] = True
+            else:
+                res['version'] = version
 
-        if zoneRole != ZONE_ROLE_ADMIN:
-            seatsCursor = seatsCursor.where(Seat.enabled == True)
+        resR = flask.current_app.response_class(
+            response=flask.stream_with_context(
+                _streamSeatsJSON(zid, tr, zoneRole == ZONE_ROLE_ADMIN, login, res, sids, onlyOtherZone)),
+            status=200,
+            mimetype='application/json')
+        resR.vary.add('Accept')
 
-        for s in seatsCursor.iterator():
+        return utils.setETag(resR, etag)
 
-            seatD = {
-                "name": s['name'],
-                "x": s['x'],
-                "y": s['y'],
-                "zid": s['zid'],
-                "enabled": s['enabled'] != 0,
-                "book": []
-            }
+    if not onlyOtherZone:
 
-            if s['id'] in assignments:
-                seatD['assignments'] = [*assignments[s['id']]]
+        # version has to be read before the data, so in the worst case
+        # the client will get some changes twice
+        changes = zone_changes.getSeatsChangedSince(zid, flask.request.args.get('since', type=int))
 
-            res['seats'][ str(s['id']) ] = seatD
+        if changes is not None:
 
+            res['version'], changedSids = changes
+            res['delta'] = True
 
-        bookQuery = Book.select(Book.id, Book.login, Book.sid, Users.name.alias('username'), Book.fromts, Book.tots) \
-                            .join(Users, on=(Book.login == Users.login)) \
-                            .join(Seat, on=(Book.sid == Seat.id)) \
-                            .where((Book.fromts < tr['toTS']) & (Book.tots > tr['fromTS']) & (Seat.zid == zid)) \
-                            .order_by(Book.fromts)
+            rows = _getSeatsRows(
+                _zoneSeatsQueries(zid, tr, zoneRole == ZONE_ROLE_ADMIN, changedSids) \
+                + [ _otherZoneSeatsQuery(zid, login) ])
 
-        if zoneRole != ZONE_ROLE_ADMIN:
-            bookQuery = bookQuery.where(Seat.enabled == True)
+            returnedSids = { r[1] for r in rows[_ROW_SEAT] }
+            res['removed'] = [ str(i) for i in changedSids if i not in returnedSids ]
+            zoneData = encode(rows, tr['fromTS'])
 
-        for b in DB.execute(bookQuery):
+        else:
 
-            sid = str(b[2])
+            res['version'] = version
 
-            res['seats'][sid]['book'].append({
-                "bid": b[0],
-                "login": b[1],
-                "fromTS": b[4],
-                "toTS": b[5] })
+            # the shared part is the same for all zone users (or all zone admins)
+            cacheKey = _seatsCacheKey(zid, tr, version, usersGeneration, zoneRole == ZONE_ROLE_ADMIN, columns)
+            zoneData = zone_changes.seatsCache.get(cacheKey)
 
-            usedUsers.add(b[1])
+            if zoneData is None:
+                rows = _getSeatsRows(
+                    _zoneSeatsQueries(zid, tr, zoneRole == ZONE_ROLE_ADMIN) \
+                    + [ _otherZoneSeatsQuery(zid, login) ])
+                zoneData = encode(rows, tr['fromTS'])
+                zone_changes.seatsCache.set(cacheKey, zoneData)
+            else:
+                rows = _getSeatsRows([ _otherZoneSeatsQuery(zid, login) ])
 
-        usedZones.add(zid)
+    else:
+        rows = _getSeatsRows([ _otherZoneSeatsQuery(zid, login) ])
+        zoneData = encode(rows, tr['fromTS'], onlyEmpty=True)
 
-    login = flask.request.args.get('login',flask.g.login)
+    if columns:
+        zoneHeader, zoneColumns = zoneData
+        otherHeader, otherColumns = _otherSeatsColumns(rows, tr['fromTS'])
+
+        header = { **res, **zoneHeader, **otherHeader }
+        header['zones'] = { **zoneHeader['zones'], **otherHeader['zones'] }
+
+        body = utils.packColumns(header, zoneColumns + otherColumns)
+        mimetype = utils.COLUMNS_MIMETYPE
+
+    else:
+        body = _seatsJSONBody(res, zoneData, _otherSeatsJSON(rows))
+        mimetype = 'application/json'
+
+    resR = flask.current_app.response_class(
+        response=body,
+        status=200,
+        mimetype=mimetype)
+    resR.vary.add('Accept')
+
+    return utils.setETag(resR, etag)
+
+
+#Format JSON
+#   {
+#       zidN: {
+#           version: 123,
+#           seats: { ... },         # the same as zone/getSeats/zidN
+#           zones: { ... },
+#           users: { ... }
+#       }, ...
+#   }
+#
+# this route requires one or more zid arguments: getSeatsBatch?zid=1&zid=2
+# zones the user has no role in are left out, seats are always for the current user
+#
+# roles are checked with a single query for all the zones, seat data of all the zones
+# (which are not cached) is fetched with a single query as well,
+# response has ETag (see getSeats)
+@bp.route("getSeatsBatch")
+def getSeatsBatch():
+
+    zids = sorted(set(flask.request.args.getlist('zid', type=int)))
+
+    if not zids:
+        return {"msg": "No zone requested", "code": 160 }, 400
+
+    rolesQuery = UserToZoneRoles.select(
+                                    UserToZoneRoles.zid,
+                                    UserToZoneRoles.zone_role,
+                                    Zone.zone_group,
+                                    generation.generationQuery()) \
+                                .join(Zone, on=(UserToZoneRoles.zid == Zone.id)) \
+                                .where(UserToZoneRoles.login == flask.g.login) \
+                                .where(UserToZoneRoles.zid.in_(zids)) \
+                                .tuples()
+
+    roles = {}
+    zoneGroups = {}
+    usersGeneration = 0
+    for zid,role,zoneGroup,ug in rolesQuery.iterator():
+        roles[zid] = role
+        zoneGroups[zid] = zoneGroup
+        usersGeneration = ug or 0
+
+    versions = zone_changes.getZoneGroupsVersions(set(zoneGroups.values()))
+
+    groupVersions = {}
+    for zoneGroup,version in versions.values():
+        groupVersions[zoneGroup] = version + groupVersions.get(zoneGroup, 0)
+
+    tr = utils.getTimeRange()
+
+    etag = utils.makeETag(
+        'getSeatsBatch', flask.g.login, usersGeneration, tr['fromTS'], tr['toTS'],
+        [ (zid, roles[zid], groupVersions.get(zoneGroups[zid], 0)) for zid in sorted(roles) ])
+
+    r304 = utils.notModifiedResponse(etag)
+    if r304 is not None:
+        return r304
+
+    cacheKeys = { zid: _seatsCacheKey(zid, tr, versions.get(zid, (None, 0))[1], usersGeneration, roles[zid] == ZONE_ROLE_ADMIN, False) \
+                  for zid in roles }
+    zonesData = { zid: zone_changes.seatsCache.get(key) for zid,key in cacheKeys.items() }
+
+    missing = [ zid for zid,data in zonesData.items() if data is None ]
+
+    if missing:
+
+        # versions have been read before the data, as in getSeats
+        adminZids = [ zid for zid in missing if roles[zid] == ZONE_ROLE_ADMIN ]
+        rows = _getSeatsRows(_zonesSeatsQueries(missing, tr, adminZids))
+
+        for zid,zoneRows in _splitZonesRows(rows, missing).items():
+            zonesData[zid] = _zoneSeatsJSON(zoneRows, tr['fromTS'])
+            zone_changes.seatsCache.set(cacheKeys[zid], zonesData[zid])
+
+    groupsBookings = _zoneGroupsBookingsRows(set(zoneGroups.values()), flask.g.login)
+
+    parts = []
+    for zid in sorted(roles):
+
+        otherRows = { _ROW_OTHER_BOOK: [
+            r[:-1] for r in groupsBookings if r[8] == zoneGroups[zid] and r[5] != zid ] }
+
+        body = _seatsJSONBody(
+            { "version": versions.get(zid, (None, 0))[1] },
+            zonesData[zid],
+            _otherSeatsJSON(otherRows))
+
+        parts.append(b'"%d":%b' % (zid, body))
+
+    resR = flask.current_app.response_class(
+        response=b'{' + b','.join(parts) + b'}',
+        status=200,
+        mimetype='application/json')
+
+    return utils.setETag(resR, etag)
+
+# All the seat data is fetched with a single UNION ALL query, each row is tagged
+# with its kind, columns have the same types in all parts (required by PostgreSQL):
+#
+#   kind               sid  i1   i2      i3    i4       t1         t2
+#   _ROW_SEAT          sid  zid  x       y     enabled  seat name  NULL
+#   _ROW_ZONE          zid  NULL NULL    NULL  NULL     zone name  NULL
+#   _ROW_ASSIGN        sid  NULL NULL    NULL  NULL     login      user name
+#   _ROW_BOOK          sid  bid  fromTS  toTS  NULL     login      user name
+#   _ROW_OTHER_BOOK    sid  bid  fromTS  toTS  zid      seat name  zone name
+#
+# rows come in no particular order, see _getSeatsRows
+_ROW_SEAT = 1
+_ROW_ZONE = 2
+_ROW_ASSIGN = 3
+_ROW_BOOK = 4
+_ROW_OTHER_BOOK = 5
+
+_NULL = SQL('NULL')
+
+# rows per INSERT statement of bulk inserts (SQLite limits the number of variables)
+_BATCH_INSERT_SIZE = 300
+
+# returns queries for seats, bookings, assignments and users of the zone
+# if sids is given only these seats are returned
+def _zoneSeatsQueries(zid, tr, adminView, sids = None):
+
+    return _zonesSeatsQueries([zid], tr, [zid] if adminView else [], sids)
+
+# the same as _zoneSeatsQueries for several zones at once,
+# disabled seats are returned only in adminZids
+def _zonesSeatsQueries(zids, tr, adminZids, sids = None):
+
+    zids = list(zids)
+    adminZids = [ i for i in zids if i in adminZids ]
+
+    seatsQuery = Seat.select(Value(_ROW_SEAT), Seat.id, Seat.zid, Seat.x, Seat.y,
+                             Case(None, [(Seat.enabled == True, 1)], 0), Seat.name, _NULL) \
+                     .where(Seat.zid.in_(zids))
+
+    zoneQuery = Zone.select(Value(_ROW_ZONE), Zone.id, _NULL, _NULL, _NULL, _NULL, Zone.name, _NULL) \
+                    .where(Zone.id.in_(zids))
+
+    assignQuery = SeatAssign.select(Value(_ROW_ASSIGN), SeatAssign.sid, _NULL, _NULL, _NULL, _NULL, Users.login, Users.name) \
+                            .join(Users, on=(SeatAssign.login == Users.login)) \
+                            .join(Seat, on=(SeatAssign.sid == Seat.id)) \
+                            .where(Seat.zid.in_(zids))
+
+    bookQuery = Book.select(Value(_ROW_BOOK), Book.sid, Book.id, Book.fromts, Book.tots, _NULL, Users.login, Users.name) \
+                    .join(Users, on=(Book.login == Users.login)) \
+                    .join(Seat, on=(Book.sid == Seat.id)) \
+                    .where((Book.fromts < tr['toTS']) & (Book.tots > tr['fromTS']) & Seat.zid.in_(zids))
+
+    if len(adminZids) < len(zids):
+
+        visible = Seat.enabled == True
+        if adminZids:
+            visible = visible | Seat.zid.in_(adminZids)
+
+        seatsQuery = seatsQuery.where(visible)
+        assignQuery = assignQuery.where(visible)
+        bookQuery = bookQuery.where(visible)
+
+    if sids is not None:
+        seatsQuery = seatsQuery.where(Seat.id.in_(sids))
+        assignQuery = assignQuery.where(Seat.id.in_(sids))
+        bookQuery = bookQuery.where(Seat.id.in_(sids))
+
+    return [ seatsQuery, zoneQuery, assignQuery, bookQuery ]
+
+# returns query for login's bookings in other zones of the same zone group
+def _otherZoneSeatsQuery(zid, login):
 
     # User should get all his conflicting bookings even if he is not assigned to the zone
     # this is useful in case of reassignment
     # Also user is not allowed to book in not-assigned zones, but he/she is allowed to delete
     # own bookings from not-assigned zones
-    otherZoneBookQuery = Book.select(Book.sid, Seat.name, Seat.zid, Book.id, Book.fromts, Book.tots) \
-                            .join(Seat, on=(Book.sid == Seat.id)) \
-                            .join(Zone, on=(Seat.zid == Zone.id)) \
-                            .where( (Seat.zid != zid) & (Seat.enabled == True) ) \
-                            .where(Zone.zone_group == ( \
-                                Zone.select(Zone.zone_group).where(Zone.id == zid)) ) \
-                            .where(Book.login == login) \
-                            .order_by(Book.fromts).tuples()
-
-    for b in otherZoneBookQuery.iterator():
-
-        sid = str(b[0])
-
-        if sid not in res['seats']:
-            res['seats'][sid] = {
-                "name": b[1],
-                "zid": b[2],
+    return Book.select(Value(_ROW_OTHER_BOOK), Book.sid, Book.id, Book.fromts, Book.tots, Seat.zid, Seat.name, Zone.name) \
+               .join(Seat, on=(Book.sid == Seat.id)) \
+               .join(Zone, on=(Seat.zid == Zone.id)) \
+               .where( (Seat.zid != zid) & (Seat.enabled == True) ) \
+               .where(Zone.zone_group == ( \
+                   Zone.select(Zone.zone_group).where(Zone.id == zid)) ) \
+               .where(Book.login == login)
+
+# returns rows of login's bookings in all zones of the zone groups,
+# in _ROW_OTHER_BOOK layout plus the zone group, sorted on fromTS
+def _zoneGroupsBookingsRows(zoneGroups, login):
+
+    query = Book.select(Value(_ROW_OTHER_BOOK), Book.sid, Book.id, Book.fromts, Book.tots, Seat.zid, Seat.name, Zone.name, Zone.zone_group) \
+                .join(Seat, on=(Book.sid == Seat.id)) \
+                .join(Zone, on=(Seat.zid == Zone.id)) \
+                .where(Seat.enabled == True) \
+                .where(Zone.zone_group.in_(list(zoneGroups))) \
+                .where(Book.login == login) \
+                .order_by(Book.fromts) \
+                .tuples()
+
+    return [ *query.iterator() ]
+
+# splits rows (see _getSeatsRows) of several zones into { zid: rows }
+def _splitZonesRows(rows, zids):
+
+    res = { zid: { kind: [] for kind in rows } for zid in zids }
+    seatZids = {}
+
+    for r in rows[_ROW_SEAT]:
+        seatZids[r[1]] = r[2]
+        res[r[2]][_ROW_SEAT].append(r)
+
+    for r in rows[_ROW_ZONE]:
+        res[r[1]][_ROW_ZONE].append(r)
+
+    for kind in (_ROW_ASSIGN, _ROW_BOOK):
+        for r in rows[kind]:
+            res[seatZids[r[1]]][kind].append(r)
+
+    return res
+
+# executes queries as a single statement and returns the rows grouped by kind,
+# bookings are sorted on fromTS
+def _getSeatsRows(queries):
+
+    # ORDER BY on the whole union costs more than the rest of the query,
+    # rows of a seat are mostly read in fromTS order anyway (index order), so sort is cheap
+    query = functools.reduce(lambda q1,q2: q1.union_all(q2), queries)
+
+    rows = { kind: [] for kind in (_ROW_SEAT, _ROW_ZONE, _ROW_ASSIGN, _ROW_BOOK, _ROW_OTHER_BOOK) }
+
+    for row in DB.execute(query):
+        rows[row[0]].append(row)
+
+    bookKey = operator.itemgetter(3)
+    rows[_ROW_BOOK].sort(key=bookKey)
+    rows[_ROW_OTHER_BOOK].sort(key=bookKey)
+
+    return rows
+
+# key of the shared part of getSeats in zone_changes.seatsCache, usersGeneration is there
+# as names of users (and zone roles) can change without any change logged in the zone
+def _seatsCacheKey(zid, tr, version, usersGeneration, adminView, columns):
+
+    return (zid, tr['fromTS'], tr['toTS'], version, usersGeneration, adminView, columns)
+
+# returns serialized JSON of the zone part { seats, zones, users } (see getSeats format)
+def _zoneSeatsJSON(rows, baseTS, onlyEmpty = False):
+
+    if onlyEmpty:
+        return { "seats": b'{}', "zones": b'{}', "users": b'{}' }
+
+    seats = {}
+    zones = {}
+    users = {}
+
+    for _,sid,zid,x,y,enabled,name,_ in rows[_ROW_SEAT]:
+        seats[str(sid)] = {
+            "name": name,
+            "x": x,
+            "y": y,
+            "zid": zid,
+            "enabled": enabled != 0,
+            "book": []
+        }
+
+    for _,zid,_,_,_,_,name,_ in rows[_ROW_ZONE]:
+        zones[str(zid)] = name
+
+    for _,sid,_,_,_,_,login,userName in rows[_ROW_ASSIGN]:
+        seat = seats.get(str(sid))
+        if seat is not None:
+            seat.setdefault('assignments', []).append(login)
+            users[login] = userName
+
+    for _,sid,bid,fromTS,toTS,_,login,userName in rows[_ROW_BOOK]:
+        seats[str(sid)]['book'].append({
+            "bid": bid,
+            "login": login,
+            "fromTS": fromTS,
+            "toTS": toTS })
+        users[login] = userName
+
+    return { "seats": orjson.dumps(seats), "zones": orjson.dumps(zones), "users": orjson.dumps(users) }
+
+# returns the other zones part { seats, zones } (see getSeats format)
+def _otherSeatsJSON(rows):
+
+    seats = {}
+    zones = {}
+
+    for _,sid,bid,fromTS,toTS,zid,seatName,zoneName in rows[_ROW_OTHER_BOOK]:
+
+        seat = seats.get(str(sid))
+        if seat is None:
+            seat = seats[str(sid)] = {
+                "name": seatName,
+                "zid": zid,
                 "book": []
             }
-            usedZones.add(b[2])
+            zones[str(zid)] = zoneName
 
-        res['seats'][sid]['book'].append({
-            "bid": b[3],
-            "fromTS": b[4],
-            "toTS": b[5]
+        seat['book'].append({
+            "bid": bid,
+            "fromTS": fromTS,
+            "toTS": toTS
             })
 
-    usedZonesQuery = Zone.select(Zone.id,Zone.name).where(Zone.id.in_(usedZones)).tuples()
-    res['zones'] = {str(i[0]): i[1] for i in usedZonesQuery.iterator()}
+    return { "seats": seats, "zones": zones }
+
+# returns i-th column of rows (as iterator)
+def _column(rows, i, offset = 0):
+
+    if offset:
+        return ( r[i] - offset for r in rows )
+    return map(operator.itemgetter(i), rows)
+
+# returns (header, columns) of the zone part in the columnar format (see getSeats format)
+def _zoneSeatsColumns(rows, baseTS, onlyEmpty = False):
+
+    header = {
+        "baseTS": baseTS,
+        "zones": {},
+        "logins": [],
+        "userNames": [],
+        "seatNames": [],
+        "counts": [0, 0, 0] }
+
+    if onlyEmpty:
+        return header, b''
+
+    seatRows = rows[_ROW_SEAT]
+    assignRows = rows[_ROW_ASSIGN]
+    bookRows = rows[_ROW_BOOK]
+
+    # logins are indexes to the users table, the first occurrence sets the index
+    users = {}
+    assignLogins = []
+    for r in assignRows:
+        idx = users.setdefault(r[6], (len(users), r[7]))[0]
+        assignLogins.append(idx)
+
+    # bookings are the bulk of the data, so they are read in a single pass
+    bookSids = []
+    bookBids = []
+    bookFroms = []
+    bookTos = []
+    bookLogins = []
+    for _,sid,bid,fromTS,toTS,_,login,userName in bookRows:
+        bookSids.append(sid)
+        bookBids.append(bid)
+        bookFroms.append(fromTS - baseTS)
+        bookTos.append(toTS - baseTS)
+        user = users.get(login)
+        if user is None:
+            user = users[login] = (len(users), userName)
+        bookLogins.append(user[0])
+
+    header['zones'] = { str(r[1]): r[6] for r in rows[_ROW_ZONE] }
+    header['logins'] = list(users.keys())
+    header['userNames'] = [ i[1] for i in users.values() ]
+    header['seatNames'] = [ r[6] for r in seatRows ]
+    header['counts'] = [ len(seatRows), len(assignRows), len(bookRows) ]
+
+    return header, utils.int32Columns(
+        _column(seatRows, 1), _column(seatRows, 2), _column(seatRows, 3), _column(seatRows, 4), _column(seatRows, 5),
+        _column(assignRows, 1), assignLogins,
+        bookSids, bookBids, bookFroms, bookTos, bookLogins)
+
+# returns (header, columns) of the other zones part in the columnar format (see getSeats format)
+def _otherSeatsColumns(rows, baseTS):
+
+    bookRows = rows[_ROW_OTHER_BOOK]
+
+    seats = {}
+    zones = {}
+    for _,sid,_,_,_,zid,seatName,zoneName in bookRows:
+        if sid not in seats:
+            seats[sid] = (zid, seatName)
+            zones[str(zid)] = zoneName
+
+    header = {
+        "zones": zones,
+        "otherSeatNames": [ i[1] for i in seats.values() ],
+        "otherCounts": [ len(seats), len(bookRows) ] }
+
+    return header, utils.int32Columns(
+        seats.keys(), [ i[0] for i in seats.values() ],
+        _column(bookRows, 1), _column(bookRows, 2), _column(bookRows, 3, baseTS), _column(bookRows, 4, baseTS))
+
+# size of the chunks sent by the streaming mode of getSeats
+_STREAM_CHUNK_SIZE = 64*1024
+
+def _streamRows(query, batchSize = 1000):
+    """ Iterates over rows of the query without reading the whole result into memory """
+
+    # sqlite3 cursors fetch rows on demand, but PostgreSQL drivers read the whole result
+    # on execute, so a server-side cursor is used there (WITH HOLD, as connections are
+    # in autocommit mode)
+    if not isinstance(DB, peewee.PostgresqlDatabase):
+        yield from DB.execute(query)
+        return
+
+    sql, params = query.sql()
+    cursor = DB.connection().cursor(name=f"warp_stream_{id(query)}", withhold=True)
+    cursor.itersize = batchSize
+
+    try:
+        cursor.execute(sql, params)
+        yield from cursor
+    finally:
+        cursor.close()
 
-    usedUsersQuery = Users.select(Users.login, Users.name).where(Users.login.in_(usedUsers)).tuples()
-    res['users'] = {str(i[0]): i[1] for i in usedUsersQuery.iterator()}
+def _rowsBySid(rows, sidIdx = 1):
+    """ Returns a function returning the list of rows (sorted on sid) of a given sid, """
+    """ it has to be called with ascending sids, rows of skipped sids are dropped """
 
-    resR = flask.current_app.response_class(
-        response=orjson.dumps(res),
-        status=200,
-        mimetype='application/json')
+    groups = itertools.groupby(rows, operator.itemgetter(sidIdx))
+    current = next(groups, None)
+
+    def take(sid):
+        nonlocal current
+
+        while current is not None and current[0] < sid:
+            current = next(groups, None)
+
+        if current is None or current[0] != sid:
+            return []
+
+        res = list(current[1])
+        current = next(groups, None)
+        return res
+
+    return take
+
+# yields JSON of getSeats (see getSeats format) in chunks, seats, assignments and bookings
+# are read from separate cursors sorted on sid and merged, so only one seat at a time
+# (plus users and zones) is kept in memory
+def _streamSeatsJSON(zid, tr, adminView, login, res, sids = None, onlyOtherZone = False):
+
+    users = {}
+    zones = {}
+    returnedSids = set()
+
+    buf = bytearray(b'{"seats":{')
+    sep = b''
+
+    if not onlyOtherZone:
+
+        seatsQuery, zoneQuery, assignQuery, bookQuery = _zoneSeatsQueries(zid, tr, adminView, sids)
+
+        zones.update( (str(r[1]), r[6]) for r in DB.execute(zoneQuery) )
+
+        assignments = _rowsBySid(_streamRows(assignQuery.order_by(SeatAssign.sid)))
+        bookings = _rowsBySid(_streamRows(bookQuery.order_by(Book.sid, Book.fromts)))
+
+        for _,sid,seatZid,x,y,enabled,name,_ in _streamRows(seatsQuery.order_by(Seat.id)):
+
+            seat = {
+                "name": name,
+                "x": x,
+                "y": y,
+                "zid": seatZid,
+                "enabled": enabled != 0,
+                "book": []
+            }
+
+            for _,_,_,_,_,_,assignLogin,userName in assignments(sid):
+                seat.setdefault('assignments', []).append(assignLogin)
+                users[assignLogin] = userName
+
+            for _,_,bid,fromTS,toTS,_,bookLogin,userName in bookings(sid):
+                seat['book'].append({
+                    "bid": bid,
+                    "login": bookLogin,
+                    "fromTS": fromTS,
+                    "toTS": toTS })
+                users[bookLogin] = userName
+
+            if sids is not None:
+                returnedSids.add(sid)
+
+            buf += b'%b"%d":%b' % (sep, sid, orjson.dumps(seat))
+            sep = b','
+
+            if len(buf) >= _STREAM_CHUNK_SIZE:
+                yield bytes(buf)
+                buf.clear()
 
-    return resR
+    otherRows = _streamRows(_otherZoneSeatsQuery(zid, login).order_by(Book.sid, Book.fromts))
+
+    for sid,seatRows in itertools.groupby(otherRows, operator.itemgetter(1)):
+
+        seat = None
+        for _,_,bid,fromTS,toTS,seatZid,seatName,zoneName in seatRows:
+            if seat is None:
+                seat = { "name": seatName, "zid": seatZid, "book": [] }
+                zones[str(seatZid)] = zoneName
+            seat['book'].append({
+                "bid": bid,
+                "fromTS": fromTS,
+                "toTS": toTS
+                })
+
+        buf += b'%b"%d":%b' % (sep, sid, orjson.dumps(seat))
+        sep = b','
+
+    if sids is not None:
+        res = { **res, "removed": [ str(i) for i in sids if i not in returnedSids ] }
+
+    # the beginning of the object is already sent, so the rest is merged to a closed seats object
+    buf += b'},' + _mergeJSONObjects(
+        b'{"zones":%b,"users":%b}' % (orjson.dumps(zones), orjson.dumps(users)),
+        orjson.dumps(res))[1:]
+
+    yield bytes(buf)
+
+# returns the whole getSeats JSON (bytes) from res (version, delta, ...),
+# the zone part (_zoneSeatsJSON) and the other zones part (_otherSeatsJSON)
+def _seatsJSONBody(res, zoneData, otherData):
+
+    return _mergeJSONObjects(
+        orjson.dumps(res),
+        b'{"seats":%b,"zones":%b,"users":%b}' % (
+            _mergeJSONObjects(zoneData['seats'], orjson.dumps(otherData['seats'])),
+            _mergeJSONObjects(zoneData['zones'], orjson.dumps(otherData['zones'])),
+            zoneData['users']))
+
+def _mergeJSONObjects(*objects):
+    """ Merges serialized JSON objects with disjoint keys without parsing them """
+
+    members = [ o[1:-1] for o in objects if o != b'{}' ]
+    return b'{' + b','.join(members) + b'}'
 
 
 applySchema = {
@@ -214,9 +774,24 @@ applySchema = {
                         },
                         "required": [ "fromTS", "toTS"]
                     }
+                },
+                "recurrence": {
+                    "type": "object",
+                    "properties": {
+                        "weekdays": {"type": "integer", "minimum": 1, "maximum": 127},
+                        "fromTime": {"type": "integer", "minimum": 0, "maximum": 24*3600},
+                        "toTime": {"type": "integer", "minimum": 0, "maximum": 24*3600},
+                        "fromDate": {"type": "integer"},
+                        "toDate": {"type": "integer"}
+                    },
+                    "required": [ "weekdays", "fromTime", "toTime", "fromDate", "toDate" ]
                 }
             },
-            "required": [ "sid", "dates"],
+            "required": [ "sid" ],
+            "oneOf": [
+                {"required": [ "dates" ]},
+                {"required": [ "recurrence" ]}
+            ]
         },
         "remove": {
             "type": "array",
@@ -249,9 +824,24 @@ applySchema = {
 #           { fromTS: timestamp, toTS: timestamp },
 #           { fromTS: timestamp, toTS: timestamp },
 #       ]
+#       recurrence: {       #instead of dates, a series expanded on the server (see utils.expandRecurrence)
+#           weekdays: mask,                 # bit N is weekday N, 0 is Sunday (as weekdayN in getNextWeek)
+#           fromTime: seconds, toTime: seconds,     # time of the day
+#           fromDate: timestamp, toDate: timestamp  # midnights of the first and the last day
+#       }
 #   },
 #   remove: [ bid, bid, bid]
 # }
+#
+# when the booking overlaps (code 109), the response contains the conflicting dates:
+#   conflicts: [
+#       { fromTS: timestamp, toTS: timestamp,       # requested date
+#         bookings: [ { bid: bid, sid: sid, login: login, fromTS: timestamp, toTS: timestamp }, ... ] }
+#   ]
+# bookings is empty for dates with fromTS >= toTS, dates overlapping each other conflict as well
+#
+# with recurrence, conflicting occurrences don't fail the request, the rest is booked and
+# conflicts_in_book (in the same format as conflicts above) is returned
 @bp.route("apply", methods=["POST"])
 @utils.validateJSONInput(applySchema)
 def apply():
@@ -283,34 +873,47 @@ def apply():
 
     if seatsReqZoneAdmin:
 
+        seatZids = Seat.select(Seat.zid).distinct() \
+                       .where(Seat.id.in_(seatsReqZoneAdmin)) \
+                       .tuples()
+        seatZids = [ i[0] for i in seatZids.iterator() ]
+
         count = Seat.select(COUNT_STAR) \
-                    .join(UserToZoneRoles, on=(Seat.zid == UserToZoneRoles.zid)) \
-                    .where(UserToZoneRoles.login == flask.g.login) \
                     .where(Seat.id.in_(seatsReqZoneAdmin)) \
-                    .where(UserToZoneRoles.zone_role <= ZONE_ROLE_ADMIN) \
                     .scalar()
 
-        if count != len(seatsReqZoneAdmin):
+        roles = zone_roles.getRoles([ (flask.g.login, z) for z in seatZids ])
+        adminZids = { z for (_,z),role in roles.items() if role <= ZONE_ROLE_ADMIN }
+
+        if count != len(seatsReqZoneAdmin) or not adminZids.issuperset(seatZids):
             return {"msg": "Forbidden", "code": 102 }, 403
 
     if 'book' in apply_data:
 
-        if not flask.g.isAdmin:     # TODO: should admin be allowed to do that?
-            for b in apply_data['book']['dates']:
-                if b['fromTS'] < ts["fromTS"] or b['fromTS'] > ts["toTS"] \
-                    or b['toTS'] < ts["fromTS"] or b['toTS'] > ts["toTS"]:
-                    return {"msg": "Forbidden", "code": 103}, 403
+        if 'recurrence' in apply_data['book']:
+            bookDates = utils.expandRecurrence(apply_data['book']['recurrence'])
+            if bookDates is None:
+                return {"msg": "Error", "code": 111}, 400
+        else:
+            bookDates = apply_data['book']['dates']
+
+        if not flask.g.isAdmin and bookDates:     # TODO: should admin be allowed to do that?
+            fromTSs = [ b['fromTS'] for b in bookDates ]
+            toTSs = [ b['toTS'] for b in bookDates ]
+            if min(fromTSs) < ts["fromTS"] or max(fromTSs) > ts["toTS"] \
+                or min(toTSs) < ts["fromTS"] or max(toTSs) > ts["toTS"]:
+                return {"msg": "Forbidden", "code": 103}, 403
 
         sid = apply_data['book']['sid']
         login = apply_data['book'].get('login', flask.g.login)
 
-        seat = Seat.select(Seat.enabled) \
-                    .join(UserToZoneRoles, on=(Seat.zid == UserToZoneRoles.zid)) \
-                    .where( (Seat.id == sid) & (UserToZoneRoles.login == login)) \
+        seat = Seat.select(Seat.enabled, Seat.zid, Zone.zone_group) \
+                    .join(Zone, on=(Seat.zid == Zone.id)) \
+                    .where(Seat.id == sid) \
                     .first()
 
         # login not in the zone
-        if seat is None:
+        if seat is None or zone_roles.getZoneRole(seat['zid'], login) is None:
             return {"msg": "Forbidden", "code": 104}, 403
 
         # seat is disabled
@@ -324,6 +927,31 @@ def apply():
         if (assignedQ.scalar() is not None and assignedToMeQ.scalar() is None):
             return {"msg": "Forbidden", "code": 106}, 403
 
+        # bookings to be removed don't conflict, as remove is executed before book
+        conflictsEngine = booking_conflicts.loadForDates(
+                            [ (seat['zone_group'], sid, login, bookDates) ],
+                            ignoreBids=apply_data.get('remove', ()))
+
+        if 'recurrence' in apply_data['book']:
+
+            # occurrences are checked one by one, so only the conflicting ones are left out
+            bookConflicts = []
+            freeDates = []
+            for d in bookDates:
+                conflicts = conflictsEngine.check(seat['zone_group'], sid, login, [d])
+                if conflicts:
+                    bookConflicts.extend(conflicts)
+                else:
+                    freeDates.append(d)
+
+            bookDates = freeDates
+
+        else:
+
+            conflicts = conflictsEngine.check(seat['zone_group'], sid, login, bookDates)
+            if conflicts:
+                return {"msg": "Error", "code": 109, "conflicts": conflicts }, 400
+
     # -------------------------------------
     # APPLY CHANGES
     # -------------------------------------
@@ -338,14 +966,17 @@ def apply():
             if 'enable' in apply_data:
 
                 Seat.update({Seat.enabled: True}).where(Seat.id.in_(apply_data['enable'])).execute()
+                zone_changes.logSeatsChange(apply_data['enable'], zone_changes.CHANGE_ENABLE)
 
             if 'disable' in apply_data:
 
                 Seat.update({Seat.enabled: False}).where(Seat.id.in_(apply_data['disable'])).execute()
+                zone_changes.logSeatsChange(apply_data['disable'], zone_changes.CHANGE_DISABLE)
 
             if 'assign' in apply_data:
 
                 SeatAssign.delete().where(SeatAssign.sid == apply_data['assign']['sid']).execute()
+                zone_changes.logSeatsChange([apply_data['assign']['sid']], zone_changes.CHANGE_ASSIGN)
 
                 if len(apply_data['assign']['logins']):
 
@@ -362,14 +993,20 @@ def apply():
             # remove must be executed before book
             if 'remove' in apply_data:
 
+                removeQ = Book.select(Book.sid, Book.fromts, Book.tots).where(Book.id.in_(apply_data['remove'])).tuples()
+                removed = [ *removeQ.iterator() ]
+                zone_changes.logSeatsChange({ i[0] for i in removed }, zone_changes.CHANGE_BOOK)
+
                 stmt = Book.delete().where(Book.id.in_(apply_data['remove']))
                 rowCount = stmt.execute()
 
                 if rowCount != len(apply_data['remove']):
                     raise ApplyError("Number of affected row is different then in remove.",108)
 
+                occupancy.refreshOccupancy(removed)
+
             # then we create new reservations
-            if 'book' in apply_data:
+            if 'book' in apply_data and bookDates:
 
                 sid = apply_data['book']['sid']
                 login = apply_data['book'].get('login', flask.g.login)
@@ -379,21 +1016,27 @@ def apply():
                         Book.sid: sid,
                         Book.fromts: x['fromTS'],
                         Book.tots: x['toTS']
-                    } for x in apply_data['book']['dates'] ]
+                    } for x in bookDates ]
 
                 stmt = Book.insert(insertData)
 
+                # conflicts are checked above, this is for bookings made in the meantime
                 try:
                     stmt.execute()
                 except peewee.IntegrityError:
                     raise ApplyError("Overlapping time",109)
 
+                zone_changes.logSeatsChange([sid], zone_changes.CHANGE_BOOK)
+                occupancy.refreshOccupancy( (sid, x['fromTS'], x['toTS']) for x in bookDates )
 
     except ApplyError as err:
         return {"msg": "Error", "code": err.args[1] }, 400
 
     ret = { "msg": "ok" }
 
+    if 'book' in apply_data and 'recurrence' in apply_data['book'] and bookConflicts:
+        ret["conflicts_in_book"] = bookConflicts
+
 
     # -------------------------------------
     # CALCULATE CONFLICTS
@@ -439,6 +1082,536 @@ def apply():
     return ret, 200
 
 
+_applyBatchSidsOp = {
+    "type": "object",
+    "properties": {
+        "op": {"enum": [ "enable", "disable" ]},
+        "sids": {
+            "type": "array",
+            "minItems": 1,
+            "items": {"type": "integer"}
+        }
+    },
+    "required": [ "op", "sids" ]
+}
+
+applyBatchSchema = {
+    "$schema": "https://json-schema.org/draft/2020-12/schema",
+    "type": "object",
+    "properties": {
+        "atomic": {"type": "boolean"},
+        "operations": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "oneOf": [
+                    _applyBatchSidsOp,
+                    {
+                        "type": "object",
+                        "properties": {
+                            "op": {"const": "assign"},
+                            "sid": {"type": "integer"},
+                            "logins": {
+                                "type": "array",
+                                "items": {"type": "string"}
+                            }
+                        },
+                        "required": [ "op", "sid", "logins" ]
+                    },
+                    {
+                        "type": "object",
+                        "properties": {
+                            "op": {"const": "book"},
+                            "login": {"type": "string"},
+                            "sid": {"type": "integer"},
+                            "dates": applySchema['properties']['book']['properties']['dates']
+                        },
+                        "required": [ "op", "sid", "dates" ]
+                    },
+                    {
+                        "type": "object",
+                        "properties": {
+                            "op": {"const": "remove"},
+                            "bids": {
+                                "type": "array",
+                                "minItems": 1,
+                                "items": {"type": "integer"}
+                            }
+                        },
+                        "required": [ "op", "bids" ]
+                    }
+                ]
+            }
+        }
+    },
+    "required": [ "operations" ]
+}
+
+# format:
+# {
+#   atomic: true|false,         # optional, if true nothing is applied when any operation fails
+#   operations: [
+#       { op: "enable", sids: [ sid, sid, ... ] },
+#       { op: "disable", sids: [ sid, sid, ... ] },
+#       { op: "assign", sid: sid, logins: [ login, login, ... ] },
+#       { op: "book", login: login, sid: sid, dates: [ { fromTS: timestamp, toTS: timestamp }, ... ] },
+#       { op: "remove", bids: [ bid, bid, ... ] },
+#       ...
+#   ]
+# }
+#
+# operations are checked with the same rules (and error codes) as in apply, operations which
+# fail are skipped (or nothing is applied if atomic is true), the rest is applied in a single
+# transaction in the same order as in apply: enable, disable, assign, remove, book
+# (so bookings can be moved, and booked on seats enabled / assigned in the same batch)
+#
+# response:
+# {
+#   msg: "ok",
+#   results: [                  # one for each operation
+#       { msg: "ok", conflicts: [ ... ] },          # conflicts only for disable and assign (if any)
+#       { msg: "Forbidden", code: 102 },
+#       { msg: "Error", code: 109, conflicts: [ ... ] },
+#       ...
+#   ]
+# }
+# conflicts of disable and assign are the same as conflicts_in_disable and conflicts_in_assign in apply,
+# conflicts of book are the same as in apply, bookings from the same batch have op (index) instead of bid
+@bp.route("applyBatch", methods=["POST"])
+@utils.validateJSONInput(applyBatchSchema)
+def applyBatch():
+
+    jsonData = flask.request.get_json()
+    operations = jsonData['operations']
+    ts = utils.getTimeRange()
+
+    # None means the operation is fine so far
+    results = [ None ] * len(operations)
+
+    def fail(i, msg, code, **kwargs):
+        if results[i] is None:
+            results[i] = { "msg": msg, "code": code, **kwargs }
+
+    def opsOf(*kinds):
+        return [ (i,op) for i,op in enumerate(operations) if op['op'] in kinds and results[i] is None ]
+
+    # -------------------------------------
+    # PERMISSIONS CHECK
+    # -------------------------------------
+
+    removeBids = { bid for _,op in opsOf('remove') for bid in op['bids'] }
+    removeRows = {}
+
+    if removeBids:
+        removeQ = Book.select(Book.id, Book.sid, Book.login, Book.fromts, Book.tots) \
+                      .where(Book.id.in_(list(removeBids))) \
+                      .tuples()
+        removeRows = { r[0]: r for r in removeQ.iterator() }
+
+    sids = set()
+    logins = { flask.g.login }
+    for op in operations:
+        if op['op'] in ('enable', 'disable'):
+            sids.update(op['sids'])
+        elif op['op'] in ('assign', 'book'):
+            sids.add(op['sid'])
+            logins.add(op.get('login', flask.g.login))
+    sids.update( r[1] for r in removeRows.values() )
+
+    # seats with roles of the caller and of the logins to book for, all in one query
+    seatsQuery = Seat.select(Seat.id, Seat.enabled, Zone.zone_group, UserToZoneRoles.login, UserToZoneRoles.zone_role) \
+                     .join(Zone, on=(Seat.zid == Zone.id)) \
+                     .join(UserToZoneRoles, join_type=JOIN.LEFT_OUTER,
+                           on=((Seat.zid == UserToZoneRoles.zid) & UserToZoneRoles.login.in_(list(logins)))) \
+                     .where(Seat.id.in_(list(sids))) \
+                     .tuples()
+
+    seats = {}
+    for sid,enabled,zoneGroup,login,role in seatsQuery.iterator():
+        seat = seats.setdefault(sid, { "enabled": bool(enabled), "zoneGroup": zoneGroup, "roles": {} })
+        if login is not None:
+            seat['roles'][login] = role
+
+    def isZoneAdmin(sid):
+        role = seats.get(sid, {"roles": {}})['roles'].get(flask.g.login)
+        return role is not None and role <= ZONE_ROLE_ADMIN
+
+    for i,op in opsOf('enable', 'disable'):
+        if not all( isZoneAdmin(sid) for sid in op['sids'] ):
+            fail(i, "Forbidden", 102)
+
+    for i,op in opsOf('assign'):
+        if not isZoneAdmin(op['sid']):
+            fail(i, "Forbidden", 102)
+
+    for i,op in opsOf('remove'):
+        for bid in op['bids']:
+            row = removeRows.get(bid)
+            if row is None:
+                fail(i, "Error", 108)
+            elif row[2] != flask.g.login and not isZoneAdmin(row[1]):
+                fail(i, "Forbidden", 102)
+
+    for i,op in opsOf('book'):
+        if 'login' in op and not isZoneAdmin(op['sid']):
+            fail(i, "Forbidden", 102)
+
+    # all the logins to assign have to exist
+    assignLogins = { l for _,op in opsOf('assign') for l in op['logins'] }
+    if assignLogins:
+        usersQuery = Users.select(Users.login).where(Users.login.in_(list(assignLogins))).tuples()
+        existingLogins = { i[0] for i in usersQuery.iterator() }
+        for i,op in opsOf('assign'):
+            if len(set(op['logins'])) != len(op['logins']) or not existingLogins.issuperset(op['logins']):
+                fail(i, "Error", 107)
+
+    # -------------------------------------
+    # BOOKING RULES
+    # state of the seats after enable, disable and assign operations of the batch
+    # -------------------------------------
+
+    enabled = { sid: seat['enabled'] for sid,seat in seats.items() }
+    for _,op in opsOf('enable'):
+        enabled.update( (sid, True) for sid in op['sids'] )
+    for _,op in opsOf('disable'):
+        enabled.update( (sid, False) for sid in op['sids'] )
+
+    assignments = {}
+    bookSids = { op['sid'] for _,op in opsOf('book') }
+    if bookSids:
+        assignQuery = SeatAssign.select(SeatAssign.sid, SeatAssign.login) \
+                                .where(SeatAssign.sid.in_(list(bookSids))) \
+                                .tuples()
+        for sid,login in assignQuery.iterator():
+            assignments.setdefault(sid, set()).add(login)
+    for _,op in opsOf('assign'):
+        assignments[op['sid']] = set(op['logins'])
+
+    for i,op in opsOf('book'):
+
+        sid = op['sid']
+        login = op.get('login', flask.g.login)
+
+        if not flask.g.isAdmin:
+            for b in op['dates']:
+                if b['fromTS'] < ts["fromTS"] or b['fromTS'] > ts["toTS"] \
+                    or b['toTS'] < ts["fromTS"] or b['toTS'] > ts["toTS"]:
+                    fail(i, "Forbidden", 103)
+
+        if sid not in seats or login not in seats[sid]['roles']:
+            fail(i, "Forbidden", 104)
+        elif not enabled[sid]:
+            fail(i, "Forbidden", 105)
+        elif assignments.get(sid) and login not in assignments[sid]:
+            fail(i, "Forbidden", 106)
+
+    # overlaps (see booking_conflicts), bookings removed by the batch don't conflict,
+    # bookings of the batch are checked against each other as well
+    bookOps = opsOf('book')
+    removedBids = { bid for _,op in opsOf('remove') for bid in op['bids'] }
+
+    conflictsEngine = booking_conflicts.loadForDates(
+        [ (seats[op['sid']]['zoneGroup'], op['sid'], op.get('login', flask.g.login), op['dates']) for _,op in bookOps ],
+        ignoreBids=removedBids)
+
+    for i,op in bookOps:
+
+        conflicts = conflictsEngine.check(
+            seats[op['sid']]['zoneGroup'], op['sid'], op.get('login', flask.g.login), op['dates'], { "op": i })
+
+        if conflicts:
+            fail(i, "Error", 109, conflicts=conflicts)
+
+    failed = any( r is not None for r in results )
+    if failed and jsonData.get('atomic'):
+        results = [ r or { "msg": "Not applied" } for r in results ]
+        return {"msg": "Error", "code": 110, "results": results }, 400
+
+    # -------------------------------------
+    # APPLY CHANGES
+    # -------------------------------------
+
+    class ApplyError(Exception):
+        pass
+
+    enableSids = { sid for _,op in opsOf('enable') for sid in op['sids'] }
+    disableSids = { sid for _,op in opsOf('disable') for sid in op['sids'] }
+    assignData = { op['sid']: op['logins'] for _,op in opsOf('assign') }
+    removeBids = [ bid for _,op in opsOf('remove') for bid in op['bids'] ]
+    bookData = [ {
+            Book.login: op.get('login', flask.g.login),
+            Book.sid: op['sid'],
+            Book.fromts: d['fromTS'],
+            Book.tots: d['toTS']
+        } for _,op in opsOf('book') for d in op['dates'] ]
+
+    try:
+
+        with DB.atomic():
+
+            if enableSids:
+                Seat.update({Seat.enabled: True}).where(Seat.id.in_(list(enableSids))).execute()
+                zone_changes.logSeatsChange(enableSids, zone_changes.CHANGE_ENABLE)
+
+            if disableSids:
+                Seat.update({Seat.enabled: False}).where(Seat.id.in_(list(disableSids))).execute()
+                zone_changes.logSeatsChange(disableSids, zone_changes.CHANGE_DISABLE)
+
+            if assignData:
+
+                SeatAssign.delete().where(SeatAssign.sid.in_(list(assignData))).execute()
+                zone_changes.logSeatsChange(assignData.keys(), zone_changes.CHANGE_ASSIGN)
+
+                insertData = [ {
+                        SeatAssign.sid: sid,
+                        SeatAssign.login: l
+                    } for sid,logins in assignData.items() for l in logins ]
+
+                for j in range(0, len(insertData), _BATCH_INSERT_SIZE):
+                    SeatAssign.insert(insertData[j:j+_BATCH_INSERT_SIZE]).execute()
+
+            # remove must be executed before book
+            if removeBids:
+
+                removed = [ removeRows[bid][1:2] + removeRows[bid][3:5] for bid in removeBids ]
+                zone_changes.logSeatsChange({ i[0] for i in removed }, zone_changes.CHANGE_BOOK)
+
+                rowCount = Book.delete().where(Book.id.in_(removeBids)).execute()
+
+                # removed in the meantime
+                if rowCount != len(set(removeBids)):
+                    raise ApplyError("Number of affected row is different then in remove.", 108)
+
+                occupancy.refreshOccupancy(removed)
+
+            if bookData:
+
+                try:
+                    for j in range(0, len(bookData), _BATCH_INSERT_SIZE):
+                        Book.insert(bookData[j:j+_BATCH_INSERT_SIZE]).execute()
+                except peewee.IntegrityError:
+                    # booked in the meantime, the trigger is the last line of defense
+                    raise ApplyError("Overlapping time", 109)
+
+                zone_changes.logSeatsChange({ b[Book.sid] for b in bookData }, zone_changes.CHANGE_BOOK)
+                occupancy.refreshOccupancy( (b[Book.sid], b[Book.fromts], b[Book.tots]) for b in bookData )
+
+    except ApplyError as err:
+        return {"msg": "Error", "code": err.args[1] }, 400
+
+    # -------------------------------------
+    # CALCULATE CONFLICTS
+    # -------------------------------------
+
+    conflictSids = disableSids | set(assignData)
+    conflictRows = []
+
+    if conflictSids:
+        query = Book.select(Book.sid, Book.fromts, Book.tots, Users.login, Users.name) \
+                    .join(Users, on=(Book.login == Users.login)) \
+                    .where((Book.fromts < ts['toTS']) & (Book.tots > ts['fromTS'])) \
+                    .where(Book.sid.in_(list(conflictSids))) \
+                    .tuples()
+        conflictRows = [ *query.iterator() ]
+
+    def okWithConflicts(rowFilter):
+        conflicts = [ {
+                "sid": sid,
+                "fromTS": fromTS,
+                "toTS": toTS,
+                "login": login,
+                "username": name
+            } for sid,fromTS,toTS,login,name in conflictRows if rowFilter(sid, login) ]
+
+        if conflicts:
+            return { "msg": "ok", "conflicts": conflicts }
+        return None
+
+    for i,op in opsOf('disable'):
+        opSids = set(op['sids'])
+        results[i] = okWithConflicts(lambda sid,login: sid in opSids)
+
+    for i,op in opsOf('assign'):
+        if op['logins']:
+            results[i] = okWithConflicts(lambda sid,login: sid == op['sid'] and login not in op['logins'])
+
+    results = [ r or { "msg": "ok" } for r in results ]
+
+    return { "msg": "ok", "results": results }, 200
+
+
+findFreeSchema = {
+    "$schema": "https://json-schema.org/draft/2020-12/schema",
+    "type": "object",
+    "properties": {
+        "zone_group": {"type": ["string","integer"]},
+        "zids": {
+            "type": "array",
+            "items": {
+                "type": "integer"
+            }
+        },
+        "login": {"type": "string"},
+        "dates": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "properties": {
+                    "fromTS": {"type" : "integer"},
+                    "toTS": {"type" : "integer"}
+                },
+                "required": [ "fromTS", "toTS"]
+            }
+        },
+        "filters": {
+            "type": "object",
+            "properties": {
+                "name": {"type": "string"},
+                "assigned": {"type": "boolean"}
+            }
+        }
+    },
+    "required": [ "dates" ],
+    "oneOf": [
+        {"required": [ "zone_group" ]},
+        {"required": [ "zids" ]}
+    ]
+}
+
+# Returns seats which can be booked (via apply) for all the dates
+# the same rules as in apply are used: login has to have a role in the zone,
+# seat must be enabled and not assigned to other users, login must not have
+# other bookings at that time in the zone group (bookings are exclusive in the group)
+#
+# format:
+# {
+#   zone_group: "group",    # either zone_group or zids
+#   zids: [ zid, zid, ...],
+#   login: login,           # optional, requires ZONE_ROLE_ADMIN in the zones
+#   dates: [
+#       { fromTS: timestamp, toTS: timestamp },
+#   ],
+#   filters: {              # optional
+#       name: "text",       # seat name contains text
+#       assigned: true,     # only seats assigned to login (false - only not assigned seats)
+#   }
+# }
+#
+# response (zones are sorted by number of free seats, seats by assignment and name):
+# {
+#   zones: [
+#       { zid: zid, name: "Zone name", zone_group: "group",
+#         seats: [ { sid: sid, name: "name", x: 10, y: 10, assigned: true|false }, ... ] },
+#       ...
+#   ],
+#   conflicts: [            # login's bookings which prevent booking in their zone group
+#       { bid: bid, sid: sid, zid: zid, fromTS: timestamp, toTS: timestamp }, ...
+#   ]
+# }
+@bp.route("findFree", methods=["POST"])
+@utils.validateJSONInput(findFreeSchema)
+def findFree():
+
+    jsonData = flask.request.get_json()
+    ts = utils.getTimeRange()
+
+    login = jsonData.get('login', flask.g.login)
+    ranges = sorted( (d['fromTS'], d['toTS']) for d in jsonData['dates'] )
+
+    # the same dates would be rejected by apply
+    for i,(fromTS,toTS) in enumerate(ranges):
+        if fromTS >= toTS or (i > 0 and fromTS < ranges[i-1][1]):
+            return {"msg": "Error", "code": 150 }, 400
+
+    if not flask.g.isAdmin:
+        for fromTS,toTS in ranges:
+            if fromTS < ts["fromTS"] or fromTS > ts["toTS"] \
+                or toTS < ts["fromTS"] or toTS > ts["toTS"]:
+                return {"msg": "Forbidden", "code": 151}, 403
+
+    zonesQuery = Zone.select(Zone.id) \
+                     .join(UserToZoneRoles, on=(Zone.id == UserToZoneRoles.zid)) \
+                     .where(UserToZoneRoles.login == login)
+
+    if 'zone_group' in jsonData:
+        zonesQuery = zonesQuery.where(Zone.zone_group == jsonData['zone_group'])
+    else:
+        zonesQuery = zonesQuery.where(Zone.id.in_(jsonData['zids']))
+
+    # booking with login requires zone admin (as in apply)
+    if 'login' in jsonData:
+        adminZonesQuery = UserToZoneRoles.select(UserToZoneRoles.zid) \
+                                         .where(UserToZoneRoles.login == flask.g.login) \
+                                         .where(UserToZoneRoles.zone_role <= ZONE_ROLE_ADMIN)
+        zonesQuery = zonesQuery.where(Zone.id.in_(adminZonesQuery))
+
+    overlaps = [ (Book.fromts < toTS) & (Book.tots > fromTS) for fromTS,toTS in ranges ]
+    overlapCond = functools.reduce(lambda c1,c2: c1 | c2, overlaps)
+
+    conflictsQuery = Book.select(Book.id, Book.sid, Seat.zid, Book.fromts, Book.tots, Zone.zone_group) \
+                         .join(Seat, on=(Book.sid == Seat.id)) \
+                         .join(Zone, on=(Seat.zid == Zone.id)) \
+                         .where(Book.login == login) \
+                         .where(Zone.zone_group.in_(Zone.select(Zone.zone_group).where(Zone.id.in_(zonesQuery)))) \
+                         .where(overlapCond) \
+                         .tuples()
+
+    conflicts = []
+    blockedGroups = set()
+    for bid,sid,zid,fromTS,toTS,zoneGroup in conflictsQuery.iterator():
+        conflicts.append({ "bid": bid, "sid": sid, "zid": zid, "fromTS": fromTS, "toTS": toTS })
+        blockedGroups.add(zoneGroup)
+
+    assignedToLoginQ = SeatAssign.select(SQL_ONE).where( (SeatAssign.sid == Seat.id) & (SeatAssign.login == login) )
+    assignedQ = SeatAssign.select(SQL_ONE).where(SeatAssign.sid == Seat.id)
+
+    seatsQuery = Seat.select(Seat.id, Seat.name, Seat.x, Seat.y, Seat.zid, Zone.name, Zone.zone_group,
+                             fn.EXISTS(assignedToLoginQ)) \
+                     .join(Zone, on=(Seat.zid == Zone.id)) \
+                     .where(Seat.zid.in_(zonesQuery)) \
+                     .where(Seat.enabled == True) \
+                     .where(fn.EXISTS(assignedToLoginQ) | ~fn.EXISTS(assignedQ))
+
+    if blockedGroups:
+        seatsQuery = seatsQuery.where(Zone.zone_group.not_in(list(blockedGroups)))
+
+    filters = jsonData.get('filters', {})
+    if 'name' in filters:
+        seatsQuery = seatsQuery.where(Seat.name.contains(filters['name']))
+    if filters.get('assigned') is True:
+        seatsQuery = seatsQuery.where(fn.EXISTS(assignedToLoginQ))
+    elif filters.get('assigned') is False:
+        seatsQuery = seatsQuery.where(~fn.EXISTS(assignedQ))
+
+    busySids = occupancy.getBusySids(seatsQuery.columns(Seat.id), ranges)
+
+    zones = {}
+    for sid,name,x,y,zid,zoneName,zoneGroup,assigned in seatsQuery.tuples().iterator():
+
+        if sid in busySids:
+            continue
+
+        zone = zones.get(zid)
+        if zone is None:
+            zone = zones[zid] = { "zid": zid, "name": zoneName, "zone_group": zoneGroup, "seats": [] }
+
+        zone['seats'].append({ "sid": sid, "name": name, "x": x, "y": y, "assigned": bool(assigned) })
+
+    for zone in zones.values():
+        zone['seats'].sort(key=lambda s: (not s['assigned'], s['name'] or ''))
+
+    res = {
+        "zones": sorted(zones.values(), key=lambda z: (-len(z['seats']), z['name'] or '')),
+        "conflicts": conflicts
+    }
+
+    return flask.current_app.response_class(
+        response=orjson.dumps(res),
+        status=200,
+        mimetype='application/json')
+
+
 #Format
 # {
 #   data: {
@@ -453,24 +1626,94 @@ def apply():
 @bp.route("getUsers/<zid>")
 def getUsers(zid):
 
-    zoneUsers = UserToZoneRoles.select(Users.login, Users.name, UserToZoneRoles.zone_role) \
+    zoneRole = zone_roles.getZoneRole(zid, flask.g.login)
+    usersGeneration = zone_roles.currentGeneration()
+
+    if zoneRole is None:
+        return {"msg": "Forbidden", "code": 121 }, 403
+
+    if zoneRole > ZONE_ROLE_ADMIN:
+        return {"msg": "Forbidden", "code": 120 }, 403
+
+    # users of the zone change only with users, groups or roles, which all bump the generation
+    etag = utils.makeETag('getUsers', zid, usersGeneration)
+
+    r304 = utils.notModifiedResponse(etag)
+    if r304 is not None:
+        return r304
+
+    zoneUsers = UserToZoneRoles.select(Users.login, Users.name) \
                                .join(Users, on=(UserToZoneRoles.login == Users.login) ) \
                                .where(UserToZoneRoles.zid == zid)
 
-    res = {}
+    res = { u['login']: u['name'] for u in zoneUsers.iterator() }
 
-    for u in zoneUsers.iterator():
+    resR = flask.current_app.response_class(
+        response=orjson.dumps(res),
+        status=200,
+        mimetype='application/json')
 
-        if u['login'] == flask.g.login:
-            if u['zone_role'] > ZONE_ROLE_ADMIN:
-                return {"msg": "Forbidden", "code": 120 }, 403
+    return utils.setETag(resR, etag)
 
-        res[ u['login'] ] = u['name']
 
-    if flask.g.login not in res:
-        return {"msg": "Forbidden", "code": 121 }, 403
+# Server-Sent Events stream of the zone changes, format of each event:
+#   id: version
+#   event: book|enable|disable|assign|zone
+#   data: { "sid": sid, "version": version }     # sid is null for zone event
+#
+# events are read from zone_change log, so changes from all workers are streamed
+# the stream is closed after ZONE_EVENTS_TIMEOUT seconds, EventSource reconnects
+# automatically with Last-Event-ID header, so no event is lost
+#
+# this route accepts the following optional arguments:
+#   since=version - stream events after the version (by default after the current one)
+@bp.route("events/<int:zid>")
+def events(zid):
+
+    if not flask.current_app.config['ZONE_EVENTS']:
+        return {"msg": "Not found", "code": 140 }, 404
+
+    zoneRole = UserToZoneRoles.select(UserToZoneRoles.zone_role) \
+                              .where( (UserToZoneRoles.zid == zid) & (UserToZoneRoles.login == flask.g.login) ) \
+                              .scalar()
+
+    if zoneRole is None:
+        return {"msg": "Forbidden", "code": 141 }, 403
+
+    lastVersion = flask.request.headers.get('Last-Event-ID', type=int)
+    if lastVersion is None:
+        lastVersion = flask.request.args.get('since', type=int)
+    if lastVersion is None:
+        lastVersion = zone_changes.getZoneVersion(zid)
+
+    timeout = flask.current_app.config['ZONE_EVENTS_TIMEOUT']
+    pollInterval = flask.current_app.config['ZONE_EVENTS_POLL_INTERVAL']
+
+    def stream(lastVersion):
+
+        deadline = time.monotonic() + timeout
+
+        # reconnect right after the stream is closed
+        yield "retry: 1000\n\n"
+
+        while True:
+
+            for version, sid, kind in zone_changes.getChangesSince(zid, lastVersion):
+                data = orjson.dumps({ "sid": sid, "version": version }).decode()
+                yield f"id: {version}\nevent: {kind}\ndata: {data}\n\n"
+                lastVersion = version
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            zone_changes.waitForChange(min(pollInterval, remaining))
 
     return flask.current_app.response_class(
-        response=orjson.dumps(res),
+        response=flask.stream_with_context(stream(lastVersion)),
         status=200,
-        mimetype='application/json')
+        mimetype='text/event-stream',
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        })
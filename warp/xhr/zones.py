@@ -9,6 +9,8 @@ from warp.db import *
 from warp import utils
 from warp.utils_tabulator import *
 from warp import blob_storage
+from warp import generation
+from warp import zone_changes
 
 bp = flask.Blueprint('zones', __name__, url_prefix='zones')
 
@@ -70,6 +72,8 @@ def delete():
     except IntegrityError:
         return {"msg": "Error", "code":  220}, 400
 
+    zone_changes.invalidateSeatsCache([id])
+
     return {"msg": "ok" }, 200
 
 addOrEditSchema = {
@@ -217,6 +221,8 @@ def assign():
                 if rowCount != len(jsonData['remove']):
                     raise ApplyError("Wrong number of affected rows", 224)
 
+            zone_changes.logZoneChange(zid)
+
 
     except IntegrityError as err:
         return {"msg": "Error", "code": 225 }, 400
@@ -387,30 +393,73 @@ def modify():
                 if totalCount != len(jsonData['addOrUpdate']):
                     raise ApplyError("Wrong number of affected rows", 238)
 
+            zone_changes.logZoneChange(zid)
+
     except ApplyError as err:
         return {"msg": "Error", "code": err.args[1] }, 400
 
     return {"msg": "ok"}, 200
 
 
+# format (JSON):
+#   { sid: { name: "name", x: 10, y: 10 }, ... }
+# format (columns, if Accept: application/vnd.warp.columns, see utils.packColumns):
+#   header: { names: [ name, ... ], count: N }
+#   columns: sid, x, y
+#
+# response has ETag, If-None-Match is answered with 304 before seats are read
 @bp.route("getSeats/<int:zid>")
 def getSeats(zid):
 
     if not flask.g.isAdmin:
         return {"msg": "Forbidden", "code": 250 }, 403
 
+    columns = utils.acceptsColumns()
+
+    # layout is changed only by modify, which bumps the zone version,
+    # deleting the zone bumps the generation
+    versions = Zone.select(zone_changes.zoneVersionQuery(zid), generation.generationQuery()) \
+                   .where(Zone.id == zid) \
+                   .scalar(as_tuple = True)
+
+    # versions are only valid for the current day (see zone_changes)
+    etag = utils.makeETag('zonesGetSeats', zid, versions, utils.today(), columns)
+
+    r304 = utils.notModifiedResponse(etag)
+    if r304 is not None:
+        r304.vary.add('Accept')
+        return r304
+
     query = Seat.select(Seat.id, Seat.name, Seat.x, Seat.y) \
                 .where(Seat.zid == zid)
 
-    res = {
-        str(i['id']): {
-            "name": i['name'],
-            "x": i['x'],
-            "y": i['y']
-            } for i in query.iterator()
-    }
+    if columns:
+
+        rows = [ *query.tuples().iterator() ]
+        sids,names,xs,ys = list(zip(*rows)) or [()] * 4
+
+        resR = flask.current_app.response_class(
+            response=utils.packColumns(
+                { "names": names, "count": len(rows) },
+                utils.int32Columns(sids, xs, ys)),
+            status=200,
+            mimetype=utils.COLUMNS_MIMETYPE)
+
+    else:
+
+        res = {
+            str(i['id']): {
+                "name": i['name'],
+                "x": i['x'],
+                "y": i['y']
+                } for i in query.iterator()
+        }
+
+        resR = flask.current_app.response_class(
+            response=orjson.dumps(res),
+            status=200,
+            mimetype='application/json')
+
+    resR.vary.add('Accept')
 
-    return flask.current_app.response_class(
-        response=orjson.dumps(res),
-        status=200,
-        mimetype='application/json')
+    return utils.setETag(resR, etag)
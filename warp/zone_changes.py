@@ -0,0 +1,225 @@
+import flask
+from peewee import Value, fn
+import threading
+
+from warp.db import *
+from warp import utils
+
+# Every write which changes the content of zone/getSeats is logged in zone_change table.
+# The id of the newest entry of a zone is used as the zone version. Entries with
+# sid = NULL mean that the whole zone has to be reloaded (e.g. layout or roles changed).
+#
+# Ids are allocated on insert, not on commit, so the zone rows are locked before logging
+# (see _lockZones), then the ids within a zone are in the commit order and a change can't
+# appear in the log below a version a client has already seen. It holds only per zone,
+# so the version of a zone group is the sum of the versions of its zones.
+#
+# The log is only kept for the current day, as the time range returned by getSeats
+# changes at midnight anyway, so older versions always require a full reload.
+#
+# The same log is used to push events to the open zone pages (see xhr/zone.py:events),
+# so it works across workers, changeEvent only wakes up streams in the current worker
+# (after the commit, see _notifyChange).
+
+CHANGE_BOOK = 'book'
+CHANGE_ENABLE = 'enable'
+CHANGE_DISABLE = 'disable'
+CHANGE_ASSIGN = 'assign'
+CHANGE_ZONE = 'zone'
+
+changeEvent = threading.Condition()
+
+def logSeatsChange(sids, kind = CHANGE_BOOK):
+    """ Logs a change of the given seats, zones are taken from the seat table """
+
+    if not sids:
+        return
+
+    with DB.atomic():
+
+        zidsQuery = Seat.select(Seat.zid).distinct() \
+                        .where(Seat.id.in_(list(sids))) \
+                        .tuples()
+        zids = [ i[0] for i in zidsQuery.iterator() ]
+
+        _lockZones(zids)
+        _pruneLog()
+
+        seatQuery = Seat.select(Seat.zid, Seat.id, Value(kind), Value(utils.now())) \
+                        .where(Seat.id.in_(list(sids)))
+
+        ZoneChange.insert(seatQuery, columns=[ZoneChange.zid, ZoneChange.sid, ZoneChange.kind, ZoneChange.ts]) \
+                  .execute()
+
+    invalidateSeatsCache(zids)
+    _notifyChange()
+
+
+def logZoneChange(zids):
+    """ Logs a change of the whole zone(s), clients will do a full reload """
+
+    if isinstance(zids, int):
+        zids = [zids]
+
+    if not zids:
+        return
+
+    now = utils.now()
+
+    with DB.atomic():
+
+        _lockZones(zids)
+        _pruneLog()
+
+        ZoneChange.insert([ {
+                ZoneChange.zid: zid,
+                ZoneChange.sid: None,
+                ZoneChange.kind: CHANGE_ZONE,
+                ZoneChange.ts: now
+            } for zid in zids ]).execute()
+
+    invalidateSeatsCache(zids)
+    _notifyChange()
+
+
+def zoneVersionQuery(zid):
+    """ Returns a query of the zone version, can be used as a scalar subquery """
+
+    return ZoneChange.select(fn.MAX(ZoneChange.id)) \
+                     .where(ZoneChange.zid == zid)
+
+
+def zoneGroupVersionQuery(zid):
+    """ Returns a query of the version of the zone group of zid, the sum of versions of its zones """
+    """ (bookings from other zones of the group are part of getSeats) """
+
+    versionsQuery = ZoneChange.select(fn.MAX(ZoneChange.id).alias('version')) \
+                              .join(Zone, on=(ZoneChange.zid == Zone.id)) \
+                              .where(Zone.zone_group == ( \
+                                  Zone.select(Zone.zone_group).where(Zone.id == zid)) ) \
+                              .group_by(ZoneChange.zid)
+
+    return versionsQuery.select_from(fn.SUM(versionsQuery.c.version))
+
+
+def getZoneVersion(zid):
+
+    return zoneVersionQuery(zid).scalar() or 0
+
+
+def getZoneGroupsVersions(zoneGroups):
+    """ Returns { zid: (zone group, version) } of the zones in the zone groups, """
+    """ zones without any logged change are left out (their version is 0) """
+
+    if not zoneGroups:
+        return {}
+
+    query = ZoneChange.select(ZoneChange.zid, Zone.zone_group, fn.MAX(ZoneChange.id)) \
+                      .join(Zone, on=(ZoneChange.zid == Zone.id)) \
+                      .where(Zone.zone_group.in_(list(zoneGroups))) \
+                      .group_by(ZoneChange.zid, Zone.zone_group) \
+                      .tuples()
+
+    return { zid: (zoneGroup, version) for zid,zoneGroup,version in query.iterator() }
+
+
+# returns (version, set of changed sids) or None if the full reload is required
+def getSeatsChangedSince(zid, since):
+
+    if not since:
+        return None
+
+    query = ZoneChange.select(ZoneChange.id, ZoneChange.sid) \
+                      .where(ZoneChange.zid == zid) \
+                      .where(ZoneChange.id >= since) \
+                      .where(ZoneChange.ts >= utils.today()) \
+                      .order_by(ZoneChange.id) \
+                      .tuples()
+
+    rows = [ *query.iterator() ]
+
+    # the version client has is not in the log anymore
+    if not rows or rows[0][0] != since:
+        return None
+
+    sids = set()
+    for _,sid in rows[1:]:
+        if sid is None:
+            return None
+        sids.add(sid)
+
+    return (rows[-1][0], sids)
+
+
+# returns list of (version, sid, kind) logged after the version
+def getChangesSince(zid, since):
+
+    query = ZoneChange.select(ZoneChange.id, ZoneChange.sid, ZoneChange.kind) \
+                      .where(ZoneChange.zid == zid) \
+                      .where(ZoneChange.id > since) \
+                      .order_by(ZoneChange.id) \
+                      .tuples()
+
+    return [ *query.iterator() ]
+
+
+def waitForChange(timeout):
+    """ Blocks until a change is logged in this worker or timeout (in seconds) passes """
+
+    with changeEvent:
+        changeEvent.wait(timeout)
+
+
+def _notifyChange():
+    """ Wakes up the streams of this worker, if called inside of a transaction of the request, """
+    """ only after the request is done (i.e. committed), otherwise the streams may read """
+    """ the log before the change is visible and then sleep over it """
+
+    if DB.in_transaction() and flask.has_request_context():
+        if not flask.g.get('zoneChangeNotify'):
+            flask.g.zoneChangeNotify = True
+            flask.after_this_request(_notifyAfterRequest)
+        return
+
+    with changeEvent:
+        changeEvent.notify_all()
+
+def _notifyAfterRequest(response):
+
+    with changeEvent:
+        changeEvent.notify_all()
+
+    return response
+
+
+def _lockZones(zids):
+    """ Locks the zone rows until the end of the transaction, so the changes of a zone """
+    """ are logged in the commit order (SQLite has only one writer anyway) """
+
+    if zids and DB.for_update:
+        Zone.select(Zone.id) \
+            .where(Zone.id.in_(sorted(set(zids)))) \
+            .order_by(Zone.id) \
+            .for_update() \
+            .execute()
+
+
+def _pruneLog():
+
+    ZoneChange.delete() \
+              .where(ZoneChange.ts < utils.today()) \
+              .execute()
+
+
+# Serialized (orjson) shared part of zone/getSeats, see xhr/zone.py
+# key is (zid, fromTS, toTS, version, adminView), so writes in other workers
+# invalidate it as well by bumping the version
+seatsCache = utils.LRUCache('ZONE_SEATS_CACHE_SIZE')
+
+def invalidateSeatsCache(zids = None):
+
+    if zids is None:
+        seatsCache.invalidate()
+    else:
+        zids = set(zids)
+        seatsCache.invalidate(lambda key: key[0] in zids)
@@ -0,0 +1,83 @@
+import flask
+from sqlalchemy import func
+
+from warp.db import *
+from warp import generation
+from warp import utils
+
+# Per-worker cache of zone roles, (login, zid) -> zone_role (None if the login has no role in the zone).
+#
+# Entries are tagged with GENERATION_USERS counter, which is bumped by DB triggers on every
+# change of users, groups, zone roles and zones (see generation.py), an entry is used only
+# if the counter hasn't changed since the entry was read, so all workers stay consistent
+# without any messaging between them. The counter is read at most once per request,
+# if it is not maintained (see generation.py), the roles are always read from the database.
+
+_cache = utils.LRUCache('ZONE_ROLES_CACHE_SIZE')
+
+def currentGeneration(value = None):
+    """ Returns GENERATION_USERS as read in the current request (None if not maintained) """
+    """ value can be passed if it was already read with another query """
+
+    if value is not None:
+        flask.g.usersGeneration = value
+    elif 'usersGeneration' not in flask.g:
+        flask.g.usersGeneration = generation.getGeneration()
+
+    return flask.g.usersGeneration
+
+
+def getRoles(pairs):
+    """ Returns { (login, zid): zone_role } of (login, zid) pairs which have a role """
+
+    gen = currentGeneration()
+
+    res = {}
+    missing = []
+
+    for key in pairs:
+        entry = _cache.get(key) if gen is not None else None
+        if entry is not None and entry[0] == gen:
+            if entry[1] is not None:
+                res[key] = entry[1]
+        else:
+            missing.append(key)
+
+    if missing:
+
+        logins = list({ l for l,_ in missing })
+        zids = list({ z for _,z in missing })
+
+        # the same as user_to_zone_roles (see schema), restricted to the logins and zones
+        direct = db.session.query(ZoneAssign.login.label('login'), ZoneAssign.zid.label('zid'), ZoneAssign.zone_role.label('zone_role')) \
+                           .filter(ZoneAssign.login.in_(logins), ZoneAssign.zid.in_(zids))
+        viaGroups = db.session.query(GroupClosure.member, ZoneAssign.zid, ZoneAssign.zone_role) \
+                              .join(ZoneAssign, ZoneAssign.login == GroupClosure.ancestor) \
+                              .filter(GroupClosure.member.in_(logins), ZoneAssign.zid.in_(zids))
+        expanded = direct.union_all(viaGroups).subquery()
+
+        query = db.session.query(expanded.c.login, expanded.c.zid, func.min(expanded.c.zone_role)) \
+                          .join(User, User.login == expanded.c.login) \
+                          .filter(User.account_type < ACCOUNT_TYPE_GROUP) \
+                          .group_by(expanded.c.login, expanded.c.zid)
+        found = { (l, z): r for l,z,r in query.all() }
+
+        for key in missing:
+            role = found.get(key)
+            if gen is not None:
+                _cache.set(key, (gen, role))
+            if role is not None:
+                res[key] = role
+
+    return res
+
+
+def getZoneRole(zid, login):
+    """ Returns zone_role of the login in the zone or None """
+
+    try:
+        zid = int(zid)
+    except ValueError:
+        return None
+
+    return getRoles([ (login, zid) ]).get( (login, zid) )